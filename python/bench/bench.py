@@ -0,0 +1,779 @@
+# Load generator and latency benchmark for the protocol servers.
+#
+#   python bench/bench.py                     # every server
+#   python bench/bench.py p1_prime p9_job     # some of them
+#   python bench/bench.py --out new.json --compare old.json
+#
+# Each server is started in a subprocess on localhost, then hammered by concurrent
+# clients speaking its protocol. Results (throughput, p50/p99/p999 latency) are
+# printed as JSON so that runs can be compared across commits.
+
+import argparse
+import asyncio
+import json
+import random
+import struct
+import sys
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from lib_bench import *
+
+Ctx = Dict[str, Any] # port, clients, requests, rec, and anything a benchmark adds
+
+async def open_tcp(ctx: Ctx):
+	return await with_timeout(asyncio.open_connection("127.0.0.1", ctx["port"]))
+
+def pipelined_batches(ctx: Ctx) -> int:
+	# Pipelined benchmarks send requests/10 batches of depth requests per client
+	return max(1, ctx["requests"] // 10)
+
+
+## p0: echo
+
+async def bench_echo(ctx: Ctx):
+	rec: Recorder = ctx["rec"]
+	payload = random.randbytes(1024)
+	async def client(_i: int):
+		reader, writer = await open_tcp(ctx)
+		for _ in range(ctx["requests"]):
+			start = time.perf_counter()
+			writer.write(payload)
+			await with_timeout(reader.readexactly(len(payload)))
+			rec.record(start)
+		writer.close()
+	await run_clients(ctx["clients"], client, rec)
+
+async def bench_echo_upload(ctx: Ctx):
+	# Each client uploads requests/10 MiB as fast as it can while reading the echo back
+	# at its own pace. Every MiB is one op, timed from when it was written.
+	rec: Recorder = ctx["rec"]
+	chunk = random.randbytes(1024 * 1024)
+	n_chunks = max(1, ctx["requests"] // 10)
+	ctx["bytes"] = ctx["clients"] * n_chunks * len(chunk)
+	async def client(_i: int):
+		reader, writer = await open_tcp(ctx)
+		sent_at = []
+		async def upload():
+			for _ in range(n_chunks):
+				sent_at.append(time.perf_counter())
+				writer.write(chunk)
+				await writer.drain()
+		async def download():
+			for i in range(n_chunks):
+				await with_timeout(reader.readexactly(len(chunk)))
+				rec.record(sent_at[i])
+		await asyncio.gather(upload(), download())
+		writer.close()
+	await run_clients(ctx["clients"], client, rec)
+
+async def bench_echo_connect(ctx: Ctx):
+	# Every op is a new connection: connect, bounce a few bytes, close
+	rec: Recorder = ctx["rec"]
+	async def client(_i: int):
+		for _ in range(ctx["requests"]):
+			start = time.perf_counter()
+			reader, writer = await open_tcp(ctx)
+			writer.write(b"ping")
+			await with_timeout(reader.readexactly(4))
+			writer.close()
+			rec.record(start)
+	await run_clients(ctx["clients"], client, rec)
+
+
+## p1: isPrime JSON lines
+
+async def bench_prime(ctx: Ctx):
+	rec: Recorder = ctx["rec"]
+	async def client(i: int):
+		reader, writer = await open_tcp(ctx)
+		rng = random.Random(i)
+		for _ in range(ctx["requests"]):
+			n = rng.randrange(1, 10**6)
+			start = time.perf_counter()
+			writer.write(json.dumps({ "method": "isPrime", "number": n }).encode() + b"\n")
+			res = json.loads(await with_timeout(reader.readline()))
+			if "prime" not in res:
+				rec.error()
+			rec.record(start)
+		writer.close()
+	await run_clients(ctx["clients"], client, rec)
+
+async def bench_prime_pipelined(ctx: Ctx):
+	# Batches of depth requests written at once, each reply timed from its batch's write
+	rec: Recorder = ctx["rec"]
+	async def client(i: int):
+		reader, writer = await open_tcp(ctx)
+		rng = random.Random(i)
+		for _ in range(pipelined_batches(ctx)):
+			batch = b"".join(json.dumps({ "method": "isPrime", "number": rng.randrange(1, 10**6) }).encode() + b"\n"
+				for _ in range(ctx["depth"]))
+			start = time.perf_counter()
+			writer.write(batch)
+			for _ in range(ctx["depth"]):
+				res = json.loads(await with_timeout(reader.readline()))
+				if "prime" not in res:
+					rec.error()
+				rec.record(start)
+		writer.close()
+	await run_clients(ctx["clients"], client, rec)
+
+
+## p2: 9-byte price messages
+
+async def bench_prices(ctx: Ctx):
+	rec: Recorder = ctx["rec"]
+	inserts_per_query = 8
+	async def client(i: int):
+		reader, writer = await open_tcp(ctx)
+		ts = 0
+		for _ in range(ctx["requests"]):
+			start = time.perf_counter()
+			for _ in range(inserts_per_query):
+				ts += 1
+				writer.write(struct.pack("!cii", b"I", ts, 100 + ts % 50))
+			writer.write(struct.pack("!cii", b"Q", ts - 100, ts))
+			await with_timeout(reader.readexactly(4))
+			rec.record(start)
+		writer.close()
+	await run_clients(ctx["clients"], client, rec)
+
+
+## p3: budgetchat
+
+async def bench_chat(ctx: Ctx):
+	# Every client sends `requests` messages, and every delivery to another client
+	# counts as one op, timed from when it was sent.
+	rec: Recorder = ctx["rec"]
+	n = ctx["clients"]
+	conns = []
+	for i in range(n):
+		reader, writer = await open_tcp(ctx)
+		await with_timeout(reader.readline()) # welcome
+		writer.write(f"bench{i}\n".encode())
+		await with_timeout(reader.readline()) # room contents
+		conns.append((reader, writer))
+	# Every client gets told about those who joined after it
+	for i, (reader, _) in enumerate(conns):
+		for _ in range(n - 1 - i):
+			await with_timeout(reader.readline())
+	
+	sent_at: Dict[str, float] = {}
+	async def sender(i: int):
+		writer = conns[i][1]
+		for j in range(ctx["requests"]):
+			msg = f"m{i}x{j}"
+			sent_at[msg] = time.perf_counter()
+			writer.write(msg.encode() + b"\n")
+			await writer.drain()
+			await asyncio.sleep(0)
+	async def receiver(i: int):
+		reader = conns[i][0]
+		for _ in range((n - 1) * ctx["requests"]):
+			line = (await with_timeout(reader.readline())).decode()
+			rec.record(sent_at[line.split()[-1]])
+	async def client(i: int):
+		await asyncio.gather(sender(i), receiver(i))
+	await run_clients(n, client, rec)
+	for _, writer in conns:
+		writer.close()
+
+async def bench_chat_room(ctx: Ctx):
+	# A room of `room` members, the first `clients` of which each send requests/10
+	# messages. Every delivery to a member counts as one op, timed from when it was
+	# sent, so this measures the fan-out rather than the senders.
+	rec: Recorder = ctx["rec"]
+	n = max(ctx["room"], ctx["clients"])
+	n_msgs = max(1, ctx["requests"] // 10)
+	sent_at: Dict[str, float] = {}
+	conns = []
+	for i in range(n):
+		reader, writer = await open_tcp(ctx)
+		await with_timeout(reader.readline()) # welcome
+		writer.write(f"bench{i}\n".encode())
+		await with_timeout(reader.readline()) # room contents
+		conns.append((reader, writer))
+	
+	async def member(i: int):
+		reader, writer = conns[i]
+		expected = ctx["clients"] * n_msgs - (n_msgs if i < ctx["clients"] else 0)
+		while expected > 0:
+			line = await with_timeout(reader.readline())
+			if not line.startswith(b"["): # someone joined
+				continue
+			rec.record(sent_at[line.split()[-1].decode()])
+			expected -= 1
+	async def sender(i: int):
+		writer = conns[i][1]
+		for j in range(n_msgs):
+			msg = f"m{i}x{j}"
+			sent_at[msg] = time.perf_counter()
+			writer.write(msg.encode() + b"\n")
+			await writer.drain()
+			await asyncio.sleep(0)
+	
+	async def client(i: int):
+		if i < ctx["clients"]:
+			await asyncio.gather(sender(i), member(i))
+		else:
+			await member(i)
+	await run_clients(n, client, rec)
+	for _, writer in conns:
+		writer.close()
+
+
+## p4: UDP key-value store
+
+class DgramClient(asyncio.DatagramProtocol):
+	queue: asyncio.Queue
+	
+	def __init__(self):
+		self.queue = asyncio.Queue()
+	
+	def datagram_received(self, data: bytes, addr):
+		self.queue.put_nowait(data)
+
+async def open_udp(ctx: Ctx) -> tuple[asyncio.DatagramTransport, DgramClient]:
+	loop = asyncio.get_running_loop()
+	return await loop.create_datagram_endpoint(DgramClient, remote_addr=("127.0.0.1", ctx["port"]))
+
+async def bench_db(ctx: Ctx):
+	rec: Recorder = ctx["rec"]
+	async def client(i: int):
+		trans, prot = await open_udp(ctx)
+		for j in range(ctx["requests"]):
+			key = f"k{i}x{j % 100}".encode()
+			trans.sendto(key + b"=" + str(j).encode())
+			start = time.perf_counter()
+			trans.sendto(key)
+			try:
+				res = await with_timeout(prot.queue.get(), 1)
+			except asyncio.TimeoutError:
+				rec.error() # lost datagram
+				continue
+			if not res.startswith(key + b"="):
+				rec.error()
+			rec.record(start)
+		trans.close()
+	await run_clients(ctx["clients"], client, rec)
+
+async def bench_db_burst(ctx: Ctx):
+	# Datagrams from many distinct addresses: each client sends requests/50 bursts of
+	# `burst` retrieves, each from a new socket, and waits for all the replies. Every
+	# reply is one op, timed from its request.
+	rec: Recorder = ctx["rec"]
+	async def client(i: int):
+		for j in range(max(1, ctx["requests"] // 50)):
+			socks = [await open_udp(ctx) for _ in range(ctx["burst"])]
+			async def retrieve(k: int, trans: asyncio.DatagramTransport, prot: DgramClient):
+				key = f"k{i}x{j}x{k}".encode()
+				start = time.perf_counter()
+				trans.sendto(key)
+				try:
+					res = await with_timeout(prot.queue.get(), 1)
+				except asyncio.TimeoutError:
+					rec.error() # lost datagram
+					return
+				if res != key + b"=":
+					rec.error()
+				rec.record(start)
+			await asyncio.gather(*(retrieve(k, trans, prot) for k, (trans, prot) in enumerate(socks)))
+			for trans, _ in socks:
+				trans.close()
+	await run_clients(ctx["clients"], client, rec)
+
+
+## p5: budgetchat proxy, against a local stand-in for the chat server
+
+UPSTREAM_DELAY = 0.02 # seconds the stand-in takes to welcome a client, like a remote server would
+SESSION_GAP = 0.05 # seconds between the sessions of a client
+STREAM_LINE_BYTES = 10 * 1024 * 1024
+
+class ChatStandIn:
+	# Welcomes clients after UPSTREAM_DELAY, then echoes everything back
+	def __init__(self):
+		self.handlers: set[asyncio.Task] = set()
+		self.writers: set[asyncio.StreamWriter] = set()
+	
+	async def close(self):
+		for writer in self.writers:
+			writer.close()
+		await asyncio.gather(*self.handlers)
+	
+	async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+		task = asyncio.current_task()
+		assert task is not None
+		self.handlers.add(task)
+		task.add_done_callback(self.handlers.discard)
+		self.writers.add(writer)
+		try:
+			await asyncio.sleep(UPSTREAM_DELAY)
+			writer.write(b"Welcome to budgetchat! What shall I call you?\n")
+			while len(data := await reader.read(64 * 1024)) > 0:
+				writer.write(data)
+				await writer.drain()
+		except ConnectionError:
+			pass
+		self.writers.discard(writer)
+		writer.close()
+
+async def bench_proxy(ctx: Ctx):
+	# Each op is a session through the proxy, timed until the welcome arrives (time to
+	# first byte), then sending a Boguscoin address and waiting for its echo
+	rec: Recorder = ctx["rec"]
+	async def client(i: int):
+		for j in range(max(1, ctx["requests"] // 10)):
+			start = time.perf_counter()
+			reader, writer = await open_tcp(ctx)
+			await with_timeout(reader.readline())
+			rec.record(start)
+			writer.write(f"bench{i}\npay 7iKDZEwPZSqIvDnHvVN2r0hUWXD5rHX{j:02} now\n".encode())
+			assert (await with_timeout(reader.readline())).startswith(b"bench")
+			assert b"7YWHMfk9JZe0LM0g1ZauHuiSxhI" in await with_timeout(reader.readline())
+			writer.close()
+			await asyncio.sleep(SESSION_GAP)
+	await run_clients(ctx["clients"], client, rec)
+
+async def bench_proxy_stream(ctx: Ctx):
+	# Each op is a 10 MB line full of Boguscoin addresses and without newlines until
+	# its end, sent through the proxy while reading it back, timed until the echo of
+	# its end (the proxy rewrites it both ways)
+	rec: Recorder = ctx["rec"]
+	word = b"7iKDZEwPZSqIvDnHvVN2r0hUWXD5rHX "
+	chunk = word * (64 * 1024 // len(word))
+	n_chunks = STREAM_LINE_BYTES // len(chunk)
+	n_lines = max(1, ctx["requests"] // 100)
+	rewritten = len(chunk) // len(word) * len(b"7YWHMfk9JZe0LM0g1ZauHuiSxhI ")
+	ctx["bytes"] = ctx["clients"] * n_lines * n_chunks * len(chunk)
+	async def client(_i: int):
+		reader, writer = await open_tcp(ctx)
+		await with_timeout(reader.readline())
+		for _ in range(n_lines):
+			start = time.perf_counter()
+			async def upload():
+				for _ in range(n_chunks):
+					writer.write(chunk)
+					await writer.drain()
+				writer.write(b"\n")
+			async def download():
+				await with_timeout(reader.readexactly(n_chunks * rewritten + 1))
+			await asyncio.gather(upload(), download())
+			rec.record(start)
+		writer.close()
+	await run_clients(ctx["clients"], client, rec)
+
+async def setup_proxy(ctx: Ctx):
+	ctx["upstream"] = ChatStandIn()
+	ctx["upstream_server"] = await asyncio.start_server(ctx["upstream"].handle, "127.0.0.1", ctx["port"] + 1)
+
+
+## p6: speed cameras and ticket dispatchers
+
+async def read_str(reader: asyncio.StreamReader) -> bytes:
+	n = (await reader.readexactly(1))[0]
+	return await reader.readexactly(n)
+
+async def bench_speed(ctx: Ctx):
+	# Each client owns a road with two cameras 10 miles apart and a dispatcher. Every
+	# op is a car seen by both cameras a minute apart, timed from the second
+	# sighting until the dispatcher gets the ticket.
+	rec: Recorder = ctx["rec"]
+	async def client(i: int):
+		road = i + 1
+		cams = []
+		for mile in (0, 10):
+			reader, writer = await open_tcp(ctx)
+			writer.write(struct.pack("!BHHH", 0x80, road, mile, 60))
+			cams.append(writer)
+		disp_reader, disp_writer = await open_tcp(ctx)
+		disp_writer.write(struct.pack("!BBH", 0x81, 1, road))
+		
+		for j in range(ctx["requests"]):
+			plate = f"B{i}X{j}".encode()
+			ts = j * 1000
+			cams[0].write(struct.pack("!BB", 0x20, len(plate)) + plate + struct.pack("!I", ts))
+			await cams[0].drain()
+			start = time.perf_counter()
+			cams[1].write(struct.pack("!BB", 0x20, len(plate)) + plate + struct.pack("!I", ts + 60))
+			msg_ty = (await with_timeout(disp_reader.readexactly(1)))[0]
+			if msg_ty != 0x21:
+				rec.error()
+				return
+			got_plate = await read_str(disp_reader)
+			await disp_reader.readexactly(16)
+			if got_plate != plate:
+				rec.error()
+			rec.record(start)
+		for writer in cams + [disp_writer]:
+			writer.close()
+	await run_clients(ctx["clients"], client, rec)
+
+
+## p7: line reversal over LRCP
+
+async def bench_olleh(ctx: Ctx):
+	# Minimal LRCP client: one session per client, one line in flight at a time,
+	# acking whatever comes back.
+	rec: Recorder = ctx["rec"]
+	async def client(i: int):
+		trans, prot = await open_udp(ctx)
+		sid = 1000 + i
+		trans.sendto(f"/connect/{sid}/".encode())
+		await with_timeout(prot.queue.get())
+		sent = 0
+		received = 0
+		for j in range(ctx["requests"]):
+			line = f"hello{i}x{j}\n"
+			start = time.perf_counter()
+			trans.sendto(f"/data/{sid}/{sent}/{line}/".encode())
+			sent += len(line)
+			while True:
+				fields = (await with_timeout(prot.queue.get())).decode().split("/")
+				if fields[1] == "data" and int(fields[3]) == received:
+					received += len(fields[4])
+					trans.sendto(f"/ack/{sid}/{received}/".encode())
+					if fields[4].endswith("\n"):
+						break
+			rec.record(start)
+		trans.sendto(f"/close/{sid}/".encode())
+		trans.close()
+	await run_clients(ctx["clients"], client, rec)
+
+
+## p8: insecure sockets layer
+
+def rev_bits(b: int) -> int:
+	return int(f"{b:08b}"[::-1], 2)
+
+ISL_CIPHER = bytes([0x02, 0x7b, 0x05, 0x01, 0x00]) # xor(123), addpos, reversebits
+
+def isl_encode(pos: int, b: int) -> int:
+	return rev_bits(((b ^ 123) + pos) % 256)
+
+def isl_decode(pos: int, b: int) -> int:
+	return ((rev_bits(b) - pos) % 256) ^ 123
+
+async def bench_isl(ctx: Ctx):
+	rec: Recorder = ctx["rec"]
+	request = b"10x toy car,15x dog on a string,4x inflatable motorcycle\n"
+	expected = b"15x dog on a string\n"
+	async def client(_i: int):
+		reader, writer = await open_tcp(ctx)
+		writer.write(ISL_CIPHER)
+		in_pos = out_pos = 0
+		for _ in range(ctx["requests"]):
+			start = time.perf_counter()
+			writer.write(bytes(isl_encode(out_pos + k, b) for k, b in enumerate(request)))
+			out_pos += len(request)
+			res = await with_timeout(reader.readexactly(len(expected)))
+			res = bytes(isl_decode(in_pos + k, b) for k, b in enumerate(res))
+			in_pos += len(expected)
+			if res != expected:
+				rec.error()
+			rec.record(start)
+		writer.close()
+	await run_clients(ctx["clients"], client, rec)
+
+
+## p9: job centre
+
+async def bench_job(ctx: Ctx):
+	# Each op is one request (put, get or delete), on a queue per client
+	rec: Recorder = ctx["rec"]
+	async def client(i: int):
+		reader, writer = await open_tcp(ctx)
+		async def request(req: Dict[str, Any]) -> Dict[str, Any]:
+			start = time.perf_counter()
+			writer.write(json.dumps(req).encode() + b"\n")
+			res = json.loads(await with_timeout(reader.readline()))
+			rec.record(start)
+			if res.get("status") == "error":
+				rec.error()
+			return res
+		queue = f"q{i}"
+		for j in range(ctx["requests"] // 3):
+			await request({ "request": "put", "queue": queue, "job": { "n": j }, "pri": j % 10 })
+			res = await request({ "request": "get", "queues": [queue] })
+			await request({ "request": "delete", "id": res["id"] })
+		writer.close()
+	await run_clients(ctx["clients"], client, rec)
+
+async def bench_job_pipelined(ctx: Ctx):
+	# Batches of depth puts, then as many gets, then deletes of the jobs got, each
+	# batch written at once
+	rec: Recorder = ctx["rec"]
+	async def client(i: int):
+		reader, writer = await open_tcp(ctx)
+		async def requests(reqs: list[Dict[str, Any]]) -> list[Dict[str, Any]]:
+			start = time.perf_counter()
+			writer.write(b"".join(json.dumps(req).encode() + b"\n" for req in reqs))
+			results = []
+			for _ in reqs:
+				res = json.loads(await with_timeout(reader.readline()))
+				rec.record(start)
+				if res.get("status") == "error":
+					rec.error()
+				results.append(res)
+			return results
+		queue = f"q{i}"
+		depth = ctx["depth"]
+		for _ in range(max(1, pipelined_batches(ctx) // 3)):
+			await requests([{ "request": "put", "queue": queue, "job": { "n": j }, "pri": j % 10 } for j in range(depth)])
+			got = await requests([{ "request": "get", "queues": [queue] }] * depth)
+			await requests([{ "request": "delete", "id": res["id"] } for res in got if "id" in res])
+		writer.close()
+	await run_clients(ctx["clients"], client, rec)
+
+
+## p10: version control
+
+async def bench_vcs(ctx: Ctx):
+	# PUT and GET of small files, with a LIST every 10 files
+	rec: Recorder = ctx["rec"]
+	async def client(i: int):
+		reader, writer = await open_tcp(ctx)
+		rng = random.Random(i)
+		async def ready():
+			line = await with_timeout(reader.readline())
+			if line != b"READY\n":
+				rec.error()
+		await ready()
+		for j in range(ctx["requests"]):
+			path = f"/bench{i}/f{j % 50}"
+			start = time.perf_counter()
+			if j % 10 == 9:
+				writer.write(f"LIST /bench{i}\n".encode())
+				count = int((await with_timeout(reader.readline())).split()[1])
+				for _ in range(count):
+					await reader.readline()
+			elif j % 2 == 0:
+				data = "".join(rng.choice("abcdefgh \n") for _ in range(64)).encode()
+				writer.write(f"PUT {path} {len(data)}\n".encode() + data)
+				await with_timeout(reader.readline())
+			else:
+				writer.write(f"GET {path}\n".encode())
+				status = (await with_timeout(reader.readline())).split()
+				if status[0] == b"OK":
+					await reader.readexactly(int(status[1]))
+			await ready()
+			rec.record(start)
+		writer.close()
+	await run_clients(ctx["clients"], client, rec)
+
+
+## p11: pest control, against a local stand-in for the authority server
+
+def pest_msg(msg_ty: int, content: bytes) -> bytes:
+	msg = bytearray([msg_ty]) + struct.pack(">I", len(content) + 6) + content
+	msg.append(-sum(msg) % 256)
+	return bytes(msg)
+
+def pest_str(s: str) -> bytes:
+	return struct.pack(">I", len(s)) + s.encode("ascii")
+
+PEST_HELLO = pest_msg(0x50, pest_str("pestcontrol") + struct.pack(">I", 1))
+
+async def read_pest_msg(reader: asyncio.StreamReader) -> tuple[int, bytes]:
+	msg_ty, length = struct.unpack(">BI", await reader.readexactly(5))
+	content = await reader.readexactly(length - 5)
+	return msg_ty, content[:-1]
+
+class Authority:
+	# Answers DialAuthority with a fixed target for a single species, and pushes to
+	# policy_created[site] whenever a policy gets created there.
+	def __init__(self):
+		self.policy_created: Dict[int, asyncio.Queue] = {}
+		self.next_policy = 1
+		self.handlers: set[asyncio.Task] = set()
+		self.writers: set[asyncio.StreamWriter] = set()
+	
+	async def close(self):
+		# Closing the connections makes the handlers see EOF and return
+		for writer in self.writers:
+			writer.close()
+		await asyncio.gather(*self.handlers)
+	
+	async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+		task = asyncio.current_task()
+		assert task is not None
+		self.handlers.add(task)
+		task.add_done_callback(self.handlers.discard)
+		self.writers.add(writer)
+		writer.write(PEST_HELLO)
+		site = None
+		try:
+			while True:
+				msg_ty, content = await read_pest_msg(reader)
+				if msg_ty == 0x53: # DialAuthority
+					site = struct.unpack(">I", content)[0]
+					writer.write(pest_msg(0x54, struct.pack(">II", site, 1)
+						+ pest_str("bench") + struct.pack(">II", 10, 20)))
+				elif msg_ty == 0x55: # CreatePolicy
+					writer.write(pest_msg(0x57, struct.pack(">I", self.next_policy)))
+					self.next_policy += 1
+					assert site is not None
+					self.policy_created.setdefault(site, asyncio.Queue()).put_nowait(time.perf_counter())
+				elif msg_ty == 0x56: # DeletePolicy
+					writer.write(pest_msg(0x52, b""))
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+		self.writers.discard(writer)
+		writer.close()
+
+async def bench_pest(ctx: Ctx):
+	# Each op is a site visit that flips the single species between too few and too
+	# many, timed until the authority sees the new policy.
+	rec: Recorder = ctx["rec"]
+	authority: Authority = ctx["authority"]
+	async def client(i: int):
+		site = 1000 + i
+		created = authority.policy_created.setdefault(site, asyncio.Queue())
+		reader, writer = await open_tcp(ctx)
+		writer.write(PEST_HELLO)
+		await with_timeout(read_pest_msg(reader))
+		for j in range(ctx["requests"]):
+			count = 5 if j % 2 == 0 else 30
+			start = time.perf_counter()
+			writer.write(pest_msg(0x58, struct.pack(">II", site, 1) + pest_str("bench") + struct.pack(">I", count)))
+			await with_timeout(created.get())
+			rec.record(start)
+		writer.close()
+	await run_clients(ctx["clients"], client, rec)
+
+async def setup_pest(ctx: Ctx):
+	authority = Authority()
+	ctx["authority"] = authority
+	ctx["authority_server"] = await asyncio.start_server(authority.handle, "127.0.0.1", ctx["port"] + 1)
+
+
+Bench = tuple[str, Callable[[Ctx], Awaitable[None]]] # (server script, benchmark)
+BENCHMARKS: Dict[str, Bench] = {
+	"p0_echo": ("p0_echo.py", bench_echo),
+	"p0_echo_upload": ("p0_echo.py", bench_echo_upload),
+	"p0_echo_connect": ("p0_echo.py", bench_echo_connect),
+	"p1_prime": ("p1_prime.py", bench_prime),
+	"p1_prime_pipelined": ("p1_prime.py", bench_prime_pipelined),
+	"p2_prices": ("p2_prices.py", bench_prices),
+	"p3_chat": ("p3_chat.py", bench_chat),
+	"p3_chat_room": ("p3_chat.py", bench_chat_room),
+	"p4_db": ("p4_db.py", bench_db),
+	"p4_db_burst": ("p4_db.py", bench_db_burst),
+	"p5_proxy": ("p5_proxy.py", bench_proxy),
+	"p5_proxy_stream": ("p5_proxy.py", bench_proxy_stream),
+	"p6_speed": ("p6_speed.py", bench_speed),
+	"p7_olleh": ("p7_olleh.py", bench_olleh),
+	"p8_isl": ("p8_isl.py", bench_isl),
+	"p9_job": ("p9_job_slow.py", bench_job),
+	"p9_job_pipelined": ("p9_job_slow.py", bench_job_pipelined),
+	"p10_vcs": ("p10_vcs.py", bench_vcs),
+	"p11_pest": ("p11_pest.py", bench_pest),
+}
+SETUP: Dict[str, Callable[[Ctx], Awaitable[None]]] = {
+	"p5_proxy": setup_proxy,
+	"p5_proxy_stream": setup_proxy,
+	"p11_pest": setup_pest,
+}
+SERVER_ENV: Dict[str, Callable[[Ctx], Dict[str, str]]] = {
+	"p5_proxy": lambda ctx: { "PROXY_UPSTREAM_HOST": "localhost", "PROXY_UPSTREAM_PORT": str(ctx["port"] + 1) },
+	"p5_proxy_stream": lambda ctx: { "PROXY_UPSTREAM_HOST": "localhost", "PROXY_UPSTREAM_PORT": str(ctx["port"] + 1) },
+	"p11_pest": lambda ctx: { "PEST_AS_HOST": "127.0.0.1", "PEST_AS_PORT": str(ctx["port"] + 1) },
+}
+
+async def run_bench(name: str, args: argparse.Namespace) -> Dict[str, Any]:
+	script, bench = BENCHMARKS[name]
+	ctx: Ctx = { "port": args.port, "clients": args.clients, "requests": args.requests, "depth": args.depth,
+		"room": args.room, "burst": args.burst, "rec": Recorder() }
+	if name in SETUP:
+		await SETUP[name](ctx)
+	env = SERVER_ENV[name](ctx) if name in SERVER_ENV else {}
+	if args.workers is not None:
+		env["ASERVE_WORKERS"] = str(args.workers)
+	if args.loop is not None:
+		env["ASERVE_LOOP"] = args.loop
+	env.update(args.env)
+	server = ServerProcess(script, args.port, env)
+	await server.start()
+	try:
+		start = time.perf_counter()
+		await bench(ctx)
+		elapsed = time.perf_counter() - start
+	finally:
+		server.stop()
+		if "authority_server" in ctx:
+			ctx["authority_server"].close()
+			await ctx["authority"].close()
+		if "upstream_server" in ctx:
+			ctx["upstream_server"].close()
+			await ctx["upstream"].close()
+	if args.keep_logs:
+		print(f"{name}: server log in {server.log.name}", file=sys.stderr)
+	else:
+		server.cleanup()
+	params = { "clients": args.clients, "requests": args.requests }
+	if name.endswith("_pipelined"):
+		params["depth"] = args.depth
+	if name.endswith("_room"):
+		params["room"] = args.room
+	if name.endswith("_burst"):
+		params["burst"] = args.burst
+	if args.workers is not None:
+		params["workers"] = args.workers
+	if args.loop is not None:
+		params["loop"] = args.loop
+	if len(args.env) > 0:
+		params["env"] = args.env
+	res = summarize(ctx["rec"], elapsed, params, server.cpu_seconds)
+	if server.peak_rss_mib is not None:
+		res["server_peak_rss_mib"] = server.peak_rss_mib
+	if "bytes" in ctx: # benchmarks measuring bandwidth
+		res["mib_per_sec"] = round(ctx["bytes"] / elapsed / (1024 * 1024), 1)
+	return res
+
+async def main(args: argparse.Namespace):
+	names = args.names or list(BENCHMARKS.keys())
+	results = {}
+	for name in names:
+		print(f"{name}...", file=sys.stderr)
+		results[name] = await run_bench(name, args)
+		res = results[name]
+		print(f"  {res['ops_per_sec']} ops/s, p50 {res['latency_ms']['p50']}ms,"
+			+ f" p99 {res['latency_ms']['p99']}ms, {res['errors']} errors, server CPU {res['server_cpu_seconds']}s"
+			+ (f", {res['mib_per_sec']} MiB/s" if "mib_per_sec" in res else "")
+			+ (f", server peak RSS {res['server_peak_rss_mib']} MiB" if "server_peak_rss_mib" in res else ""), file=sys.stderr)
+	return { **run_info(), "results": results }
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark the protocol servers on localhost")
+	parser.add_argument("names", nargs="*", metavar="name",
+		help=f"benchmarks to run, among {', '.join(BENCHMARKS.keys())} (default: all)")
+	parser.add_argument("-c", "--clients", type=int, default=8, help="concurrent clients")
+	parser.add_argument("-n", "--requests", type=int, default=500, help="ops per client")
+	parser.add_argument("-d", "--depth", type=int, default=1000, help="requests per batch in pipelined benchmarks")
+	parser.add_argument("-r", "--room", type=int, default=1000, help="members of the room in p3_chat_room")
+	parser.add_argument("-b", "--burst", type=int, default=500, help="source addresses per burst in p4_db_burst")
+	parser.add_argument("-p", "--port", type=int, default=BENCH_PORT)
+	parser.add_argument("-w", "--workers", type=int, help="worker processes for the servers that allow it")
+	parser.add_argument("-l", "--loop", choices=["auto", "uvloop", "asyncio"],
+		help="event loop used by the servers (default: $ASERVE_LOOP or auto)")
+	parser.add_argument("-e", "--env", action="append", default=[], metavar="NAME=VALUE",
+		help="environment variable for the servers, e.g. ECHO_PASSTHROUGH=0 (repeatable)")
+	parser.add_argument("-o", "--out", help="write the JSON results to this file instead of stdout")
+	parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+	parser.add_argument("--keep-logs", action="store_true", help="keep the server logs")
+	args = parser.parse_args()
+	try:
+		args.env = dict(var.split("=", 1) for var in args.env)
+	except ValueError:
+		parser.error("--env takes NAME=VALUE")
+	for name in args.names:
+		if name not in BENCHMARKS:
+			parser.error(f"unknown benchmark '{name}'")
+	
+	report = asyncio.run(main(args))
+	if args.out is not None:
+		with open(args.out, "w") as f:
+			json.dump(report, f, indent="\t")
+	else:
+		print(json.dumps(report, indent="\t"))
+	if args.compare is not None:
+		compare(load_json(args.compare), report)
@@ -0,0 +1,133 @@
+# Measures how p3_chat's throughput scales with worker processes sharing the room
+# through the broker.
+#
+#   python bench/bench_chat_scaling.py
+#   python bench/bench_chat_scaling.py -w 1 2 4 8 --room 2000 --procs 8
+#
+# For each worker count, a room of --room members is spread over --procs load
+# generator processes, so that reading the fan-out is not limited to one core.
+# Once everyone has joined, --clients members send --messages messages each. Every
+# delivery counts as one op, timed from when it was sent (clocks are compared across
+# processes, through the system-wide monotonic clock).
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import sys
+import time
+from typing import Any, Dict
+
+from lib_bench import *
+
+def members_of(k: int, args: argparse.Namespace) -> range:
+	return range(k, args.room, args.procs)
+
+async def load(k: int, args: argparse.Namespace, barrier, results):
+	rec = Recorder()
+	conns = {}
+	readers = []
+	
+	async def member(i: int, reader: asyncio.StreamReader):
+		expected = args.clients * args.messages - (args.messages if i < args.clients else 0)
+		while expected > 0:
+			line = await with_timeout(reader.readline())
+			if not line.startswith(b"["): # someone joined or left
+				continue
+			rec.latencies.append(time.monotonic() - float(line.rsplit(b"@", 1)[1]))
+			expected -= 1
+	
+	async def sender(i: int):
+		writer = conns[i][1]
+		for j in range(args.messages):
+			writer.write(f"m{i}x{j}@{time.monotonic()}\n".encode())
+			await writer.drain()
+			await asyncio.sleep(0)
+	
+	async def safe(co):
+		try:
+			await co
+		except (asyncio.TimeoutError, OSError, asyncio.IncompleteReadError) as e:
+			print(f"load {k}: {type(e).__name__}: {e}", file=sys.stderr)
+			rec.error()
+	
+	for i in members_of(k, args):
+		reader, writer = await with_timeout(asyncio.open_connection("127.0.0.1", args.port))
+		await with_timeout(reader.readline()) # welcome
+		writer.write(f"bench{i}\n".encode())
+		await with_timeout(reader.readline()) # room contents
+		conns[i] = (reader, writer)
+		readers.append(asyncio.create_task(safe(member(i, reader))))
+	
+	await asyncio.to_thread(barrier.wait)
+	senders = [safe(sender(i)) for i in members_of(k, args) if i < args.clients]
+	await asyncio.gather(*senders, *readers)
+	results.put((rec.latencies, rec.errors, time.monotonic()))
+	for _, writer in conns.values():
+		writer.close()
+
+def load_process(k: int, args: argparse.Namespace, barrier, results):
+	asyncio.run(load(k, args, barrier, results))
+
+def run_workers(workers: int, args: argparse.Namespace) -> Dict[str, Any]:
+	server = ServerProcess("p3_chat.py", args.port, { "ASERVE_WORKERS": str(workers) })
+	asyncio.run(server.start())
+	ctx = multiprocessing.get_context("fork")
+	barrier = ctx.Barrier(args.procs + 1)
+	results = ctx.Queue()
+	procs = [ctx.Process(target=load_process, args=(k, args, barrier, results)) for k in range(args.procs)]
+	try:
+		for proc in procs:
+			proc.start()
+		barrier.wait()
+		start = time.monotonic()
+		rec = Recorder()
+		end = start
+		for _ in procs:
+			latencies, errors, proc_end = results.get()
+			rec.latencies += latencies
+			rec.errors += errors
+			end = max(end, proc_end)
+		for proc in procs:
+			proc.join()
+	finally:
+		for proc in procs:
+			if proc.is_alive():
+				proc.kill()
+		server.stop()
+	if args.keep_logs:
+		print(f"{workers} workers: server log in {server.log.name}", file=sys.stderr)
+	else:
+		server.cleanup()
+	params = { "workers": workers, "room": args.room, "clients": args.clients, "messages": args.messages,
+		"procs": args.procs }
+	return summarize(rec, end - start, params, server.cpu_seconds)
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+	results = {}
+	print(f"{'workers':<8} {'ops/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7} {'server CPU s':>13}", file=sys.stderr)
+	for workers in args.workers:
+		res = run_workers(workers, args)
+		results[str(workers)] = res
+		print(f"{workers:<8} {res['ops_per_sec']:>10} {res['latency_ms']['p50']:>9} {res['latency_ms']['p99']:>9}"
+			+ f" {res['errors']:>7} {res['server_cpu_seconds']:>13}", file=sys.stderr)
+	return { **run_info(), "results": results }
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark p3_chat's scaling over worker processes")
+	parser.add_argument("-w", "--workers", type=int, nargs="+", default=[1, 2, 4], help="worker counts to run")
+	parser.add_argument("-r", "--room", type=int, default=1000, help="members of the room")
+	parser.add_argument("-c", "--clients", type=int, default=8, help="members sending messages")
+	parser.add_argument("-m", "--messages", type=int, default=50, help="messages per sending member")
+	parser.add_argument("--procs", type=int, default=4, help="load generator processes")
+	parser.add_argument("-p", "--port", type=int, default=BENCH_PORT)
+	parser.add_argument("-o", "--out", help="write the JSON results to this file instead of stdout")
+	parser.add_argument("--keep-logs", action="store_true", help="keep the server logs")
+	args = parser.parse_args()
+	
+	report = run(args)
+	if args.out is not None:
+		with open(args.out, "w") as f:
+			json.dump(report, f, indent="\t")
+	else:
+		print(json.dumps(report, indent="\t"))
@@ -0,0 +1,96 @@
+# Measures lib_kvlog, the persistence of p4_db: how long a restart takes to load
+# a store of many keys (snapshot plus log tail), and how many inserts per second go
+# through with the log on and off.
+#
+#   python bench/bench_kvlog.py
+#   python bench/bench_kvlog.py -k 1000000 -i 200000
+#
+# The server itself can be compared with and without persistence through bench.py:
+#
+#   python bench/bench.py p4_db -e DB_DIR=/tmp/p4_db
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Dict
+
+from lib_bench import *
+
+sys.path.insert(0, PYTHON_DIR)
+from lib_kvlog import KvLog
+
+def make_store(dir: str, keys: int, tail: int):
+	# A snapshot of `keys` keys, and a log segment updating `tail` of them
+	log = KvLog(dir)
+	log.load()
+	async def append():
+		for i in range(tail):
+			log.append(f"key{i}".encode(), f"new{i}".encode())
+	asyncio.run(append())
+	log.close()
+	log.values = { f"key{i}".encode(): f"value{i}".encode() for i in range(keys) }
+	log.write_snapshot(0) # the log comes after it
+
+def bench_load(dir: str) -> Dict[str, Any]:
+	gc.collect()
+	start = time.perf_counter()
+	values = KvLog(dir).load()
+	elapsed = time.perf_counter() - start
+	return { "keys": len(values), "seconds": round(elapsed, 3), "keys_per_sec": round(len(values) / elapsed) }
+
+def bench_inserts(dir: str | None, inserts: int) -> Dict[str, Any]:
+	# Inserts as p4_db does them, yielding to the event loop every 100 like datagrams would
+	log = KvLog(dir) if dir is not None else None
+	values = log.load() if log is not None else {}
+	async def insert():
+		for i in range(inserts):
+			key, value = f"key{i % 100_000}".encode(), f"value{i}".encode()
+			values[key] = value
+			if log is not None:
+				log.append(key, value)
+			if i % 100 == 0:
+				await asyncio.sleep(0)
+	start = time.perf_counter()
+	asyncio.run(insert())
+	if log is not None:
+		log.close()
+	elapsed = time.perf_counter() - start
+	return { "inserts": inserts, "seconds": round(elapsed, 3), "inserts_per_sec": round(inserts / elapsed) }
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+	dir = tempfile.mkdtemp(prefix="bench_kvlog_")
+	try:
+		print(f"Writing a store of {args.keys} keys...", file=sys.stderr)
+		make_store(os.path.join(dir, "load"), args.keys, args.tail)
+		load = bench_load(os.path.join(dir, "load"))
+		print(f"load: {load['keys']} keys in {load['seconds']}s ({load['keys_per_sec']} keys/s)", file=sys.stderr)
+		shutil.rmtree(os.path.join(dir, "load"))
+		
+		off = bench_inserts(None, args.inserts)
+		on = bench_inserts(os.path.join(dir, "inserts"), args.inserts)
+		print(f"inserts: {off['inserts_per_sec']}/s in memory, {on['inserts_per_sec']}/s persisted", file=sys.stderr)
+	finally:
+		shutil.rmtree(dir)
+	params = { "keys": args.keys, "tail": args.tail, "inserts": args.inserts }
+	return { **run_info(), "params": params, "results": { "load": load, "inserts_off": off, "inserts_on": on } }
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark p4_db's persistence")
+	parser.add_argument("-k", "--keys", type=int, default=10_000_000, help="keys in the store to load")
+	parser.add_argument("-t", "--tail", type=int, default=100_000, help="records in the log after the snapshot")
+	parser.add_argument("-i", "--inserts", type=int, default=1_000_000, help="inserts to time")
+	parser.add_argument("-o", "--out", help="write the JSON results to this file instead of stdout")
+	args = parser.parse_args()
+	
+	report = run(args)
+	if args.out is not None:
+		with open(args.out, "w") as f:
+			json.dump(report, f, indent="\t")
+	else:
+		print(json.dumps(report, indent="\t"))
@@ -0,0 +1,100 @@
+# Compares lib_kvstore.KvStore, the memory-budgeted store of p4_db, with a plain
+# dict: memory per key, and the latency of lookups and inserts.
+#
+#   python bench/bench_kvstore.py
+#   python bench/bench_kvstore.py -k 100000 --key-size 20 --value-size 200
+#
+# The server itself can be compared with and without the budget through bench.py:
+#
+#   python bench/bench.py p4_db -e DB_MAX_BYTES=0
+
+import argparse
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, MutableMapping
+
+from lib_bench import *
+
+sys.path.insert(0, PYTHON_DIR)
+from lib_kvstore import KvStore
+
+def make_items(args: argparse.Namespace) -> list[tuple[bytes, bytes]]:
+	return [(f"{i:0{args.key_size}}".encode(), f"{i:0{args.value_size}}".encode()) for i in range(args.keys)]
+
+def memory_per_key(make: Callable[[], MutableMapping[bytes, bytes]], args: argparse.Namespace) -> float:
+	# Bytes allocated per key, including the keys and values themselves; of the store's
+	# arena, only the part written to is counted, as the OS only allocates that
+	gc.collect()
+	tracemalloc.start()
+	start, _ = tracemalloc.get_traced_memory()
+	values = make()
+	values.update(make_items(args))
+	size, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	size -= start
+	if isinstance(values, KvStore): # the arena is an mmap, which tracemalloc does not see
+		size += values.used
+	return size / args.keys
+
+def latency_ns(fn: Callable[[bytes], Any], keys: list[bytes]) -> float:
+	start = time.perf_counter()
+	for key in keys:
+		fn(key)
+	return (time.perf_counter() - start) / len(keys) * 1e9
+
+def bench(values: MutableMapping[bytes, bytes], items: list[tuple[bytes, bytes]], lookups: list[bytes]) -> Dict[str, Any]:
+	start = time.perf_counter()
+	for key, val in items:
+		values[key] = val
+	set_ns = (time.perf_counter() - start) / len(items) * 1e9
+	get_ns = latency_ns(values.get, lookups)
+	miss_ns = latency_ns(values.get, [key + b"x" for key in lookups])
+	return { "set_ns": round(set_ns), "get_ns": round(get_ns), "miss_ns": round(miss_ns), "keys": len(values) }
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+	items = make_items(args)
+	rnd = random.Random(0)
+	lookups = [items[rnd.randrange(len(items))][0] for _ in range(args.lookups)]
+	budget = args.budget or 4 * args.keys * (args.key_size + args.value_size + 64)
+	results = {
+		"dict": { **bench({}, items, lookups),
+			"bytes_per_key": round(memory_per_key(dict, args), 1) },
+		"kvstore": { **bench(KvStore(budget), items, lookups),
+			"bytes_per_key": round(memory_per_key(lambda: KvStore(budget), args), 1) },
+	}
+	# A budget for about half the keys, looking up the most recent ones
+	small_budget = args.keys // 2 * (args.key_size + args.value_size + 17) + args.keys * 16
+	store = KvStore(small_budget)
+	recent = [key for key in lookups if key >= items[len(items) * 3 // 4][0]]
+	results["evicting"] = { **bench(store, items, recent), "evictions": store.evictions,
+		"budget": small_budget, "memory_bytes": store.memory_bytes() }
+	
+	print(f"{'':<10} {'bytes/key':>10} {'get ns':>8} {'miss ns':>8} {'set ns':>8}", file=sys.stderr)
+	for name in ("dict", "kvstore", "evicting"):
+		res = results[name]
+		print(f"{name:<10} {res.get('bytes_per_key', ''):>10} {res['get_ns']:>8} {res['miss_ns']:>8} {res['set_ns']:>8}", file=sys.stderr)
+	evicting = results["evicting"]
+	print(f"evicting: kept {evicting['keys']} of {args.keys} keys in {evicting['memory_bytes']} bytes", file=sys.stderr)
+	params = { "keys": args.keys, "key_size": args.key_size, "value_size": args.value_size, "lookups": args.lookups, "budget": budget }
+	return { **run_info(), "params": params, "results": results }
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark p4_db's memory-budgeted store against a dict")
+	parser.add_argument("-k", "--keys", type=int, default=1_000_000, help="keys inserted")
+	parser.add_argument("--key-size", type=int, default=10, help="bytes per key")
+	parser.add_argument("--value-size", type=int, default=20, help="bytes per value")
+	parser.add_argument("-l", "--lookups", type=int, default=1_000_000, help="lookups timed")
+	parser.add_argument("-b", "--budget", type=int, help="bytes for the store (default: plenty for all keys)")
+	parser.add_argument("-o", "--out", help="write the JSON results to this file instead of stdout")
+	args = parser.parse_args()
+	
+	report = run(args)
+	if args.out is not None:
+		with open(args.out, "w") as f:
+			json.dump(report, f, indent="\t")
+	else:
+		print(json.dumps(report, indent="\t"))
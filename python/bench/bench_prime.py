@@ -0,0 +1,105 @@
+# Compares lib_prime.is_prime to the trial division p1_prime used before, per
+# magnitude band, on a mix of random odd numbers and primes.
+#
+#   python bench/bench_prime.py
+#   python bench/bench_prime.py -n 2000 --old-budget 5
+#
+# Trial division gets a time budget per band and is only measured on the numbers
+# it got through, so the large bands stay short. It is not run above 48 bits at all:
+# a single 64-bit prime takes it minutes.
+
+import argparse
+import json
+import random
+import sys
+import time
+from typing import Any, Callable, Dict
+
+from lib_bench import *
+
+sys.path.insert(0, PYTHON_DIR)
+from lib_prime import is_prime
+
+BANDS = [8, 16, 20, 24, 32, 40, 48, 64, 128, 256, 512] # upper bound of each band, in bits
+
+def trial_division(n):
+	if isinstance(n, float) and not n.is_integer():
+		return False
+	if n <= 1: return False
+	if n == 2: return True
+	if n % 2 == 0: return False
+	
+	i = 3
+	while i*i <= n:
+		if n % i == 0:
+			return False
+		i += 2
+	
+	return True
+
+def make_numbers(lo_bits: int, hi_bits: int, count: int, rng: random.Random) -> list[int]:
+	# Half random odd numbers, half primes, shuffled
+	lo = 1 << lo_bits
+	hi = 1 << hi_bits
+	numbers = [rng.randrange(lo, hi) | 1 for _ in range(count - count // 2)]
+	while len(numbers) < count:
+		n = rng.randrange(lo, hi) | 1
+		if is_prime(n):
+			numbers.append(n)
+	rng.shuffle(numbers)
+	return numbers
+
+def time_fn(fn: Callable[[int], bool], numbers: list[int], budget: float | None) -> Dict[str, Any]:
+	start = time.perf_counter()
+	done = 0
+	for n in numbers:
+		fn(n)
+		done += 1
+		if budget is not None and time.perf_counter() - start > budget:
+			break
+	elapsed = time.perf_counter() - start
+	return {
+		"numbers": done,
+		"us_per_number": round(elapsed / done * 1e6, 3),
+		"complete": done == len(numbers),
+	}
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+	rng = random.Random(args.seed)
+	results = {}
+	lo_bits = 1
+	print(f"{'bits':<10} {'old us/n':>12} {'new us/n':>10} {'speedup':>9}", file=sys.stderr)
+	for hi_bits in BANDS:
+		numbers = make_numbers(lo_bits, hi_bits, args.numbers, rng)
+		for n in numbers:
+			assert hi_bits > 32 or is_prime(n) == trial_division(n), n
+		new = time_fn(is_prime, numbers, None)
+		old = time_fn(trial_division, numbers, args.old_budget) if hi_bits <= args.old_max_bits else None
+		
+		band = f"{lo_bits}-{hi_bits}"
+		results[band] = { "new": new, "old": old }
+		if old is not None:
+			partial = "" if old["complete"] else f" ({old['numbers']} numbers)"
+			speedup = f"{old['us_per_number'] / new['us_per_number']:>8.1f}x"
+			print(f"{band:<10} {old['us_per_number']:>12}{partial} {new['us_per_number']:>10} {speedup}", file=sys.stderr)
+		else:
+			print(f"{band:<10} {'-':>12} {new['us_per_number']:>10}", file=sys.stderr)
+		lo_bits = hi_bits
+	params = { "numbers": args.numbers, "old_budget": args.old_budget, "seed": args.seed }
+	return { **run_info(), "params": params, "results": results }
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark primality tests per magnitude band")
+	parser.add_argument("-n", "--numbers", type=int, default=1000, help="numbers per band")
+	parser.add_argument("--old-budget", type=float, default=2, help="seconds trial division gets per band")
+	parser.add_argument("--old-max-bits", type=int, default=48, help="skip trial division above this band")
+	parser.add_argument("--seed", type=int, default=1)
+	parser.add_argument("-o", "--out", help="write the JSON results to this file instead of stdout")
+	args = parser.parse_args()
+	
+	report = run(args)
+	if args.out is not None:
+		with open(args.out, "w") as f:
+			json.dump(report, f, indent="\t")
+	else:
+		print(json.dumps(report, indent="\t"))
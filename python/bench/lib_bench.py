@@ -0,0 +1,153 @@
+import asyncio
+import json
+import os
+import platform
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_PORT = 50_100
+OP_TIMEOUT = 5 # seconds, an op taking longer than this counts as an error
+START_TIMEOUT = 5 # seconds
+
+
+class Recorder:
+	latencies: list[float]
+	errors: int
+	
+	def __init__(self):
+		self.latencies = []
+		self.errors = 0
+	
+	def record(self, start: float):
+		self.latencies.append(time.perf_counter() - start)
+	
+	def error(self):
+		self.errors += 1
+
+def percentile(sorted_values: list[float], p: float) -> float:
+	if len(sorted_values) == 0:
+		return 0
+	i = min(len(sorted_values) - 1, max(0, int(len(sorted_values) * p / 100 + 0.5) - 1))
+	return sorted_values[i]
+
+def summarize(rec: Recorder, elapsed: float, params: Dict[str, Any], server_cpu: float | None = None) -> Dict[str, Any]:
+	lat = sorted(rec.latencies)
+	return {
+		"ops": len(lat),
+		"errors": rec.errors,
+		"seconds": round(elapsed, 4),
+		"server_cpu_seconds": round(server_cpu, 3) if server_cpu is not None else None,
+		"ops_per_sec": round(len(lat) / elapsed, 1) if elapsed > 0 else 0,
+		"latency_ms": {
+			name: round(percentile(lat, p) * 1000, 3)
+			for name, p in [("p50", 50), ("p99", 99), ("p999", 99.9), ("max", 100)]
+		},
+		"params": params,
+	}
+
+
+def peak_rss_mib(pid: int) -> float | None:
+	# Highest resident memory of a running process so far, where /proc tells it
+	try:
+		with open(f"/proc/{pid}/status") as f:
+			for line in f:
+				if line.startswith("VmHWM:"):
+					return round(int(line.split()[1]) / 1024, 1)
+	except OSError:
+		pass
+	return None
+
+class ServerProcess:
+	# Runs one of the servers in a subprocess, logging to a temporary file
+	def __init__(self, script: str, port: int, env: Dict[str, str] = {}):
+		self.script = script
+		self.port = port
+		self.env = env
+		self.log = tempfile.NamedTemporaryFile("w+", prefix=f"bench_{script}_", suffix=".log", delete=False)
+		self.proc = None
+		self.cpu_seconds = None
+		self.peak_rss_mib = None
+	
+	async def start(self):
+		env = { **os.environ, "ASERVE_PORT": str(self.port), **self.env }
+		env.setdefault("ASERVE_LOG", "warn,aserve=info")
+		self.proc = subprocess.Popen([sys.executable, self.script], cwd=PYTHON_DIR, env=env,
+			stdout=self.log, stderr=subprocess.STDOUT)
+		deadline = time.monotonic() + START_TIMEOUT
+		while time.monotonic() < deadline:
+			with open(self.log.name) as f:
+				if "Listening for connections" in f.read():
+					return
+			if self.proc.poll() is not None:
+				break
+			await asyncio.sleep(0.05)
+		self.stop()
+		raise RuntimeError(f"{self.script} did not start, see {self.log.name}")
+	
+	def stop(self):
+		# CPU time the server used overall, from the resource usage of reaped children
+		usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+		if self.proc is not None and self.proc.poll() is None:
+			self.peak_rss_mib = peak_rss_mib(self.proc.pid)
+			self.proc.send_signal(signal.SIGINT)
+			try:
+				self.proc.wait(5)
+			except subprocess.TimeoutExpired:
+				self.proc.kill()
+				self.proc.wait()
+			after = resource.getrusage(resource.RUSAGE_CHILDREN)
+			self.cpu_seconds = after.ru_utime + after.ru_stime - usage.ru_utime - usage.ru_stime
+		self.log.close()
+	
+	def cleanup(self):
+		os.unlink(self.log.name)
+
+
+async def with_timeout(aw: Awaitable, timeout = OP_TIMEOUT):
+	return await asyncio.wait_for(aw, timeout)
+
+async def run_clients(n: int, client: Callable[[int], Awaitable[None]], rec: Recorder):
+	async def safe_client(i: int):
+		try:
+			await client(i)
+		except (asyncio.TimeoutError, OSError, asyncio.IncompleteReadError) as e:
+			print(f"client {i}: {type(e).__name__}: {e}", file=sys.stderr)
+			rec.error()
+	await asyncio.gather(*(safe_client(i) for i in range(n)))
+
+
+def git_commit() -> str | None:
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PYTHON_DIR,
+			capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def run_info() -> Dict[str, Any]:
+	return {
+		"commit": git_commit(),
+		"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+	}
+
+def compare(old: Dict[str, Any], new: Dict[str, Any]):
+	print(f"{'benchmark':<16} {'ops/s old':>12} {'ops/s new':>12} {'ratio':>7} {'p99 old':>10} {'p99 new':>10}",
+		file=sys.stderr)
+	for name, res in new["results"].items():
+		if name not in old["results"]:
+			continue
+		o = old["results"][name]
+		ratio = res["ops_per_sec"] / o["ops_per_sec"] if o["ops_per_sec"] > 0 else float("inf")
+		print(f"{name:<16} {o['ops_per_sec']:>12} {res['ops_per_sec']:>12} {ratio:>7.2f}"
+			+ f" {o['latency_ms']['p99']:>10} {res['latency_ms']['p99']:>10}", file=sys.stderr)
+
+def load_json(path: str) -> Dict[str, Any]:
+	with open(path) as f:
+		return json.load(f)
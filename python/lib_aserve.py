@@ -1,24 +1,43 @@
 import asyncio
 import asyncio.transports
 from collections import deque
+import os
 import signal
 import socket
 import struct
+import sys
 import time
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from functools import lru_cache
+import math
 import traceback
-from typing import Any, Callable, Coroutine, Dict, Generic, Tuple, TypeVar
+from typing import Any, AsyncIterator, Callable, Coroutine, Dict, Generic, Iterable, Iterator, Tuple, TypeVar
 
 from lib_color import *
+import lib_log
+from lib_log import DEBUG, INFO, WARN, ERROR, Lazy, get_logger
+import lib_metrics
 
 
-PORT = 50_000
+PORT = int(os.environ.get("ASERVE_PORT", 50_000))
 TCP_BACKLOG = 5 # max queued connections
 NOW_TIMEOUT = 0.05 # seconds
 UDP_TIMEOUT = 1 # seconds
+TIMER_TICK = 0.01 # seconds, resolution of peer timeouts
+TIMER_SLOTS = 512
+RECV_BUFFER_SIZE = 4 * 1024 # bytes, initial receive buffer of each TCP peer, allocated on its first read
+RECV_BUFFER_MAX = 64 * 1024 # bytes, largest a receive buffer grows to for a fast sender (a frame may need more)
+RECV_MIN_FREE = 4 * 1024 # bytes, minimum space handed to the transport per read
+RECV_HIGH = 1024 * 1024 # bytes buffered before a TCP peer stops being read from
+RECV_LOW = 256 * 1024 # bytes buffered below which reading resumes
+WORKERS_ENV = "ASERVE_WORKERS" # overrides the default number of worker processes
+WORKER_MIN_UPTIME = 1 # seconds, workers exiting sooner are not restarted
+LOOP_ENV = "ASERVE_LOOP" # overrides the event loop: "auto", "uvloop" or "asyncio"
+BROADCAST_MAX_BUFFER = 1024 * 1024 # bytes queued for a broadcast recipient before it counts as slow
 
 
-def listen_ip(sock_type: socket.SocketKind, port: int):
+def listen_ip(sock_type: socket.SocketKind, port: int, reuse_port = False):
 	try:
 		addr_info = socket.getaddrinfo(None, port, family=socket.AF_INET6,
 			type=sock_type, flags=socket.AI_PASSIVE)
@@ -32,16 +51,22 @@ def listen_ip(sock_type: socket.SocketKind, port: int):
 		if sock_type == socket.SOCK_STREAM:
 			# To avoid address reuse timeout when server crashes
 			sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		if reuse_port:
+			# Let several worker processes bind the same port, the kernel balances between them
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 		sock.bind(addr)
-		
+	
 	except OSError as e:
-		print(f"{BRIGHT_RED}Could not create socket on port {port}{RESET}:")
-		print(e)
+		lib_logger.error(f"{BRIGHT_RED}Could not create socket on port {port}{RESET}:", e)
 		exit(1)
 	
 	return sock
 
 Addr = Tuple[str, int, int, int]
+def get_host(addr: Addr | Tuple[str, int]) -> str:
+	host = addr[0]
+	return host[7:] if host.startswith("::ffff:") else host
+
 def get_addr_str(addr: Addr | Tuple[str, int]):
 	if len(addr) == 2: # ipv4:
 		(host, port) = addr
@@ -54,11 +79,41 @@ def get_addr_str(addr: Addr | Tuple[str, int]):
 	else:
 		return f"{host}:{port}"
 
-start_time = time.monotonic()
+lib_logger = get_logger("aserve")
+app_logger = get_logger(os.path.splitext(os.path.basename(sys.argv[0]))[0])
+
 def log(*args):
-	msg = " ".join(map(str, args))
-	timestamp = f"{time.monotonic() - start_time: >6.2f}s"
-	print(f"{DIM_WHITE}{timestamp}{RESET} {msg}{RESET}")
+	app_logger.log(INFO, *args)
+
+connections_total = lib_metrics.counter("aserve_connections_total", "Peers that connected")
+peers_active = lib_metrics.gauge("aserve_peers", "Peers currently connected")
+handler_errors = lib_metrics.counter("aserve_handler_errors_total", "Handlers that raised an exception")
+handler_seconds = lib_metrics.histogram("aserve_handler_seconds", "Time spent in each peer's handler")
+bytes_received = lib_metrics.counter("aserve_bytes_received_total", "Bytes read by handlers")
+msgs_received = lib_metrics.counter("aserve_messages_received_total", "Frames, lines and datagrams read by handlers")
+bytes_sent = lib_metrics.counter("aserve_bytes_sent_total", "Bytes sent to peers")
+msgs_sent = lib_metrics.counter("aserve_messages_sent_total", "Writes and datagrams sent to peers")
+read_pauses_total = lib_metrics.counter("aserve_read_pauses_total", "Times reading from a peer was paused")
+write_pauses_total = lib_metrics.counter("aserve_write_pauses_total", "Times a peer's write buffer went over its limit")
+rejected_total = lib_metrics.counter("aserve_connections_rejected_total", "Connections turned away by admission control", "reason")
+broadcast_dropped_total = lib_metrics.counter("aserve_broadcast_dropped_total", "Broadcast messages dropped for slow peers")
+slow_consumers_total = lib_metrics.counter("aserve_slow_consumers_total", "Peers disconnected for not keeping up with broadcasts")
+
+async def serve_stats(port: int) -> asyncio.Server:
+	# Minimal HTTP endpoint serving the metrics in Prometheus' text format, whatever the path
+	async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+		try:
+			await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+			body = lib_metrics.registry.render().encode("utf-8")
+			writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+				+ f"Content-Length: {len(body)}\r\n\r\n".encode("ascii") + body)
+			await writer.drain()
+		except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+			pass
+		finally:
+			writer.close()
+	sock = listen_ip(socket.SOCK_STREAM, port)
+	return await asyncio.start_server(handle, sock=sock)
 
 def shorten(s):
 	if len(s) > 50:
@@ -99,6 +154,13 @@ class Stream(Generic[T]):
 			self.next.set_result(x)
 			self.next = None
 	
+	def fail(self, exc: Exception):
+		# Make a pending get() raise exc
+		if self.next is not None:
+			if not self.next.done():
+				self.next.set_exception(exc)
+			self.next = None
+	
 	async def get(self) -> T:
 		assert self.next is None
 		if len(self.queue) == 0:
@@ -111,30 +173,248 @@ class Stream(Generic[T]):
 			return self.queue.popleft()
 
 
+class RecvBuffer:
+	buf: bytearray
+	view: memoryview
+	size: int # of the next buffer, doubled up to RECV_BUFFER_MAX when reads fill it
+	start: int # first unread byte
+	end: int # first free byte
+	eof: bool
+	waiter: asyncio.Future | None
+	
+	def __init__(self, size = RECV_BUFFER_SIZE):
+		self.size = size
+		self.buf = bytearray() # idle peers hold no buffer until they send something
+		self.view = memoryview(self.buf)
+		self.start = 0
+		self.end = 0
+		self.eof = False
+		self.waiter = None
+	
+	def __len__(self):
+		return self.end - self.start
+	
+	def get_buffer(self, sizehint: int) -> memoryview:
+		want = max(sizehint, RECV_MIN_FREE)
+		if len(self.buf) - self.end < want:
+			# Frames returned by take() may still be viewing the old buffer, so never
+			# compact in place: move the unread bytes into a fresh buffer instead.
+			unread = len(self)
+			buf = bytearray(max(self.size, unread + want if len(self.buf) == 0 else 2 * (unread + want)))
+			buf[:unread] = self.view[self.start:self.end]
+			self.buf, self.view = buf, memoryview(buf)
+			self.start, self.end = 0, unread
+		return self.view[self.end:]
+	
+	def buffer_updated(self, nbytes: int):
+		self.end += nbytes
+		if self.end == len(self.buf) and self.size < RECV_BUFFER_MAX:
+			self.size *= 2 # more is probably waiting, read it in fewer calls next time
+		self.wake()
+	
+	def put_eof(self):
+		self.eof = True
+		self.wake()
+	
+	def wake(self):
+		if self.waiter is not None:
+			if not self.waiter.done():
+				self.waiter.set_result(None)
+			self.waiter = None
+	
+	def fail(self, exc: Exception):
+		if self.waiter is not None:
+			if not self.waiter.done():
+				self.waiter.set_exception(exc)
+			self.waiter = None
+	
+	async def wait(self):
+		if self.eof:
+			raise EOFError
+		assert self.waiter is None
+		self.waiter = asyncio.get_running_loop().create_future()
+		try:
+			await self.waiter
+		finally:
+			self.waiter = None
+	
+	def find(self, sub: bytes, start: int = 0) -> int:
+		i = self.buf.find(sub, self.start + start, self.end)
+		return -1 if i == -1 else i - self.start
+	
+	def rfind(self, sub: bytes, start: int = 0) -> int:
+		i = self.buf.rfind(sub, self.start + start, self.end)
+		return -1 if i == -1 else i - self.start
+	
+	def count(self, sub: bytes, end: int) -> int:
+		return self.buf.count(sub, self.start, self.start + end)
+	
+	def take(self, n: int) -> memoryview:
+		if n < 0:
+			raise ValueError(f"cannot take {n} bytes")
+		frame = self.view[self.start : self.start + n]
+		self.start += n
+		return frame
+	
+	def unpack(self, st: struct.Struct) -> tuple:
+		tup = st.unpack_from(self.buf, self.start)
+		self.start += st.size
+		return tup
+
+def split_lines(chunk: memoryview) -> Iterator[str]:
+	# Lines of a chunk ending with a newline, decoded at once unless some are invalid,
+	# in which case the ones before the first invalid line are still yielded first
+	try:
+		text = str(chunk, "utf-8")
+	except UnicodeDecodeError:
+		for line in bytes(chunk).split(b"\n")[:-1]:
+			yield str(line, "utf-8")
+	else:
+		yield from text.split("\n")[:-1]
+
+@lru_cache(maxsize=None)
+def compile_struct(fmt: str) -> struct.Struct:
+	return struct.Struct(fmt)
+
+
+class TimerWheel:
+	# Hashed timer wheel holding the deadlines of peers waiting for data. Pushing back
+	# the deadline of a peer that is already in the wheel only updates it, and
+	# cancelling clears it: stale entries are dropped or moved when their slot comes up.
+	loop: asyncio.AbstractEventLoop | None
+	slots: list[list["Peer"]]
+	tick: int # last processed tick
+	size: int
+	handle: asyncio.TimerHandle | None
+	
+	def __init__(self):
+		self.loop = None
+		self.slots = [[] for _ in range(TIMER_SLOTS)]
+		self.tick = 0
+		self.size = 0
+		self.handle = None
+	
+	def schedule(self, peer: "Peer", timeout: float):
+		if self.loop is None:
+			self.loop = asyncio.get_running_loop()
+		peer.deadline = self.loop.time() + timeout
+		if peer.wheel_tick is None or self.tick_of(peer.deadline) < peer.wheel_tick:
+			self.insert(peer)
+	
+	def cancel(self, peer: "Peer"):
+		peer.deadline = None
+	
+	def tick_of(self, deadline: float) -> int:
+		# Deadlines more than one turn away go in the furthest slot and get moved
+		# again from there
+		return min(max(math.ceil(deadline / TIMER_TICK), self.tick + 1), self.tick + TIMER_SLOTS)
+	
+	def insert(self, peer: "Peer"):
+		assert self.loop is not None and peer.deadline is not None
+		if self.size == 0:
+			self.tick = int(self.loop.time() / TIMER_TICK)
+		tick = self.tick_of(peer.deadline)
+		self.slots[tick % TIMER_SLOTS].append(peer)
+		peer.wheel_tick = tick # any entry for this peer in another slot is now stale
+		self.size += 1
+		if self.handle is None:
+			self.handle = self.loop.call_at((self.tick + 1) * TIMER_TICK, self.advance)
+	
+	def advance(self):
+		assert self.loop is not None
+		self.handle = None
+		now = self.loop.time()
+		current = int(now / TIMER_TICK)
+		expired = []
+		while self.tick < current and self.size > 0:
+			self.tick += 1
+			i = self.tick % TIMER_SLOTS
+			slot, self.slots[i] = self.slots[i], []
+			self.size -= len(slot)
+			for peer in slot:
+				if peer.wheel_tick != self.tick:
+					continue
+				peer.wheel_tick = None
+				if peer.deadline is None:
+					continue
+				if peer.deadline <= now:
+					expired.append(peer)
+				else:
+					self.insert(peer)
+		
+		for peer in expired:
+			peer.deadline = None
+			peer.on_timeout()
+		
+		if self.size > 0 and self.handle is None:
+			self.handle = self.loop.call_at((self.tick + 1) * TIMER_TICK, self.advance)
+
+
+class TokenBucket:
+	# Allows rate events per second on average, and bursts of up to burst events
+	rate: float
+	burst: float
+	tokens: float
+	last: float
+	
+	def __init__(self, rate: float, burst: float):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.last = time.monotonic()
+	
+	def take(self) -> bool:
+		now = time.monotonic()
+		self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+		self.last = now
+		if self.tokens < 1:
+			return False
+		self.tokens -= 1
+		return True
+
+
 class Peer:
 	server: "Server"
 	addr: Addr
 	id: int
 	name: str
+	deadline: float | None # when the current read times out
+	wheel_tick: int | None # slot of the timer wheel this peer is in
 	
 	def __init__(self, server: "Server", addr: Addr, prefix = "peer"):
 		self.server = server
 		self.addr = addr
 		self.id = server.new_peer_id()
 		self.name = prefix + str(self.id)
-		self.log(f"{CYAN}Connected to {get_addr_str(addr)}")
+		self.deadline = None
+		self.wheel_tick = None
+		self.lib_log(INFO, f"{CYAN}Connected to", Lazy(get_addr_str, addr))
+	
+	# Each of these checks the level first, so filtered out lines cost nothing
+	# beyond the call itself.
 	
 	def log(self, *args):
-		log(f"{DIM_WHITE}{self.name}{RESET}", *args)
+		if app_logger.enabled(INFO):
+			app_logger.log(INFO, f"{DIM_WHITE}{self.name}{RESET}", *args)
 	
 	def warn(self, *args):
-		self.log(f"{YELLOW}{args[0]}{RESET}", *args[1:])
+		if app_logger.enabled(WARN):
+			app_logger.log(WARN, f"{DIM_WHITE}{self.name}{RESET}", f"{YELLOW}{args[0]}{RESET}", *args[1:])
 	
 	def debug(self, *args):
-		self.log(f"{DIM_WHITE}{args[0]}", *args[1:])
+		if app_logger.enabled(DEBUG):
+			app_logger.log(DEBUG, f"{DIM_WHITE}{self.name}{RESET}", f"{DIM_WHITE}{args[0]}", *args[1:])
 	
 	def end(self, *args):
-		self.log(f"{MAGENTA}{args[0]}{RESET}", *args[1:])
+		if app_logger.enabled(INFO):
+			app_logger.log(INFO, f"{DIM_WHITE}{self.name}{RESET}", f"{MAGENTA}{args[0]}{RESET}", *args[1:])
+	
+	def lib_log(self, level: int, *args):
+		if lib_logger.enabled(level):
+			lib_logger.log(level, f"{DIM_WHITE}{self.name}{RESET}", *args)
+	
+	def on_timeout(self):
+		pass
 	
 	def disconnect(self):
 		pass
@@ -148,30 +428,56 @@ class Server(Generic[PeerT], ABC):
 	last_peer_id: int
 	tasks: set[asyncio.Task]
 	should_stop: asyncio.Future
+	reuse_port: bool
+	stats_port: int | None
+	loop_name: str
+	timers: TimerWheel
+	on_start: Callable[["Server"], Coroutine] | None
+	on_stop: Callable[["Server"], Coroutine] | None
 	
 	def __init__(self, handler: Handler, timeout: float | None):
 		self.handler = handler
 		self.timeout = timeout
 		self.last_peer_id = 0
 		self.tasks = set()
+		self.timers = TimerWheel()
+		self.reuse_port = False
+		self.stats_port = None
+		self.loop_name = "asyncio"
+		self.on_start = None
+		self.on_stop = None
 	
 	async def serve(self, port: int):
+		if self.on_start is not None:
+			await self.on_start(self)
 		await self.open(port)
 		self.start_time = time.monotonic()
-		log(f"{BRIGHT_GREEN}Listening for connections on port {port}")
+		lib_logger.info(f"{BRIGHT_GREEN}Listening for connections on port {port}{RESET} ({self.loop_name})")
+		stats_server = None
+		if self.stats_port is not None:
+			# Not shared between workers, which each only know their own metrics
+			stats_port = self.stats_port + (lib_log.worker_id or 1) - 1
+			stats_server = await serve_stats(stats_port)
+			lib_logger.info(f"{BRIGHT_GREEN}Serving metrics on port {stats_port}")
 		
 		loop = asyncio.get_running_loop()
 		self.should_stop = loop.create_future()
 		def sigint_handler():
-			print()
+			if lib_log.worker_id is None:
+				lib_log.writer.write("") # get past the ^C
 			self.stop()
 		loop.add_signal_handler(signal.SIGINT, sigint_handler)
+		loop.add_signal_handler(signal.SIGTERM, self.stop)
 		await self.should_stop
 		
-		log(f"{BRIGHT_MAGENTA}Stopping server")
+		lib_logger.info(f"{BRIGHT_MAGENTA}Stopping server")
 		for task in self.tasks:
 			task.cancel()
+		if stats_server is not None:
+			stats_server.close()
 		await self.close()
+		if self.on_stop is not None:
+			await self.on_stop(self)
 	
 	def new_peer_id(self) -> int:
 		self.last_peer_id += 1
@@ -179,19 +485,25 @@ class Server(Generic[PeerT], ABC):
 	
 	def new_peer(self, peer: Peer, custom_handler: Handler | None = None):
 		handler = custom_handler if custom_handler is not None else self.handler
+		connections_total.inc()
+		peers_active.inc()
 		async def safe_handler():
+			start = time.monotonic()
 			try:
 				await handler(peer)
 			except EOFError as exc:
 				tb = traceback.TracebackException.from_exception(exc)
-				peer.log(f"{BRIGHT_YELLOW}Unexpected EOF at:")
+				peer.lib_log(WARN, f"{BRIGHT_YELLOW}Unexpected EOF at:")
 				for frame in tb.stack[-8:][::-1]:
-					peer.warn(f"  {frame.filename} l.{frame.lineno} ({frame.name})")
+					peer.lib_log(WARN, f"{YELLOW}  {frame.filename} l.{frame.lineno} ({frame.name})")
 			except Exception:
-				peer.log(f"{BRIGHT_RED}Error:")
-				print(f"{BRIGHT_RED}{traceback.format_exc().rstrip()}")
+				handler_errors.inc()
+				peer.lib_log(ERROR, f"{BRIGHT_RED}Error:")
+				lib_logger.error(f"{BRIGHT_RED}{traceback.format_exc().rstrip()}")
 				self.stop()
 			finally:
+				peers_active.dec()
+				handler_seconds.observe(time.monotonic() - start)
 				peer.disconnect()
 				self.remove_peer(peer)
 		self.run(safe_handler())
@@ -217,88 +529,401 @@ class Server(Generic[PeerT], ABC):
 		pass
 
 
+def run_worker(i: int, run: Callable[[], None]):
+	lib_log.worker_id = i
+	signal.signal(signal.SIGINT, signal.SIG_DFL)
+	signal.signal(signal.SIGTERM, signal.SIG_DFL)
+	code = 0
+	try:
+		run()
+	except SystemExit as e:
+		code = e.code if isinstance(e.code, int) else 1
+	except KeyboardInterrupt:
+		pass # Ctrl+C reaches workers both from the terminal and from the supervisor
+	except BaseException:
+		lib_logger.error(f"{BRIGHT_RED}{traceback.format_exc().rstrip()}")
+		code = 1
+	finally:
+		lib_log.flush()
+		os._exit(code)
+
+def run_workers(workers: int, run: Callable[[], None]):
+	children: Dict[int, Tuple[int, float]] = {} # pid → (worker id, start time)
+	stopping = False
+	exit_code = 0
+	
+	def spawn(i: int):
+		lib_log.flush()
+		pid = os.fork()
+		if pid == 0:
+			run_worker(i, run)
+		children[pid] = (i, time.monotonic())
+	
+	def forward(signum, _frame):
+		nonlocal stopping
+		stopping = True
+		for pid in children:
+			try:
+				os.kill(pid, signum)
+			except ProcessLookupError:
+				pass
+	signal.signal(signal.SIGINT, forward)
+	signal.signal(signal.SIGTERM, forward)
+	
+	lib_logger.info(f"{BRIGHT_GREEN}Starting {workers} worker processes")
+	for i in range(1, workers + 1):
+		spawn(i)
+	
+	while len(children) > 0:
+		pid, status = os.wait()
+		if pid not in children:
+			continue
+		i, started = children.pop(pid)
+		code = os.waitstatus_to_exitcode(status)
+		if stopping:
+			continue
+		if time.monotonic() - started < WORKER_MIN_UPTIME:
+			lib_logger.error(f"{BRIGHT_RED}Worker {i} exited right away (code {code}), stopping")
+			exit_code = 1
+			forward(signal.SIGTERM, None)
+		else:
+			lib_logger.warn(f"{YELLOW}Worker {i} exited (code {code}), restarting")
+			spawn(i)
+	
+	lib_logger.info(f"{BRIGHT_MAGENTA}All workers stopped")
+	if exit_code != 0:
+		exit(exit_code)
+
+# "auto" uses uvloop when it is installed, "uvloop" warns when falling back to asyncio.
+# Returns a loop factory for asyncio.Runner (None for the default loop) and its name.
+def get_loop_factory(loop: str) -> Tuple[Callable[[], asyncio.AbstractEventLoop] | None, str]:
+	if loop == "asyncio":
+		return None, "asyncio"
+	if loop not in ("auto", "uvloop"):
+		raise ValueError(f"Unknown event loop: {loop!r}")
+	try:
+		import uvloop
+	except ImportError:
+		if loop == "uvloop":
+			lib_logger.warn(f"{YELLOW}uvloop is not installed, falling back to asyncio")
+		return None, "asyncio"
+	return uvloop.new_event_loop, f"uvloop {uvloop.__version__}"
+
+def worker_count(workers: int | None = None) -> int:
+	return workers if workers is not None else int(os.environ.get(WORKERS_ENV, 1))
+
+def run_loop(co: Coroutine, debug: bool, loop_factory: Callable[[], asyncio.AbstractEventLoop] | None):
+	with asyncio.Runner(debug=debug, loop_factory=loop_factory) as runner:
+		runner.run(co)
+
+# workers: number of processes sharing the port through SO_REUSEPORT, defaults to
+# $ASERVE_WORKERS or 1. single_worker: the server keeps state shared between peers,
+# so it must run in a single process whatever workers says. stats_port: port to serve
+# metrics on over HTTP, in Prometheus' text format. Each worker serves its own, worker i
+# on stats_port + i - 1, to be scraped as separate targets.
+# loop: event loop implementation, defaults to $ASERVE_LOOP or "auto". on_start:
+# coroutine function called with the server in each worker, before it starts listening.
+# on_stop: same, once it has closed, to release what on_start or the handlers set up
+# (workers exit without running what follows serve_tcp/serve_udp in the script).
+def run_server(server: Server, port: int, debug: bool, workers: int | None, single_worker: bool,
+		stats_port: int | None, loop: str | None, on_start: Callable[[Server], Coroutine] | None,
+		on_stop: Callable[[Server], Coroutine] | None):
+	server.stats_port = stats_port
+	server.on_start = on_start
+	server.on_stop = on_stop
+	loop_factory, server.loop_name = get_loop_factory(loop or os.environ.get(LOOP_ENV, "auto"))
+	workers = worker_count(workers)
+	if workers > 1 and single_worker:
+		lib_logger.warn(f"{YELLOW}Server shares state between peers, ignoring workers={workers}")
+		workers = 1
+	if workers <= 1:
+		run_loop(server.serve(port), debug, loop_factory)
+	else:
+		server.reuse_port = True
+		run_workers(workers, lambda: run_loop(server.serve(port), debug, loop_factory))
+
+
 class TcpPeer(Peer):
 	server: "TcpServer"
-	chunks: Stream[bytes]
+	recv_buf: RecvBuffer
 	trans: asyncio.Transport
+	reading_paused: bool
+	drain_waiter: asyncio.Future | None
+	read_pauses: int
+	write_pauses: int
+	coalesce: bool
+	corked: int
+	out_parts: list[bytes | memoryview]
+	out_strs: list[str]
+	out_len: int # bytes in out_parts and characters in out_strs
+	flush_handle: asyncio.Handle | None
+	admitted: bool # counted against the server's connection limits
+	dropped: int # broadcast messages not sent because the peer was too slow
 	
 	def __init__(self, server: "TcpServer", trans: asyncio.Transport, prefix = "peer"):
 		super().__init__(server, trans.get_extra_info("peername"), prefix)
-		self.chunks = Stream()
+		self.recv_buf = RecvBuffer()
 		self.trans = trans
+		self.reading_paused = False
+		self.drain_waiter = None
+		self.read_pauses = 0
+		self.write_pauses = 0
+		self.coalesce = server.coalesce
+		self.corked = 0
+		self.out_parts = []
+		self.out_strs = []
+		self.out_len = 0
+		self.flush_handle = None
+		self.admitted = False
+		self.dropped = 0
+		if server.send_high is not None:
+			trans.set_write_buffer_limits(server.send_high, server.send_low)
 	
 	def on_eof(self):
-		self.chunks.put_eof()
+		self.recv_buf.put_eof()
 	
 	def is_eof(self) -> bool:
-		return self.chunks.eof
+		return self.recv_buf.eof
 	
-	def on_bytes(self, data: bytes):
-		self.chunks.put(data)
+	def on_bytes(self):
+		high = self.server.recv_high
+		if high is not None and not self.reading_paused and len(self.recv_buf) >= high:
+			self.trans.pause_reading()
+			self.reading_paused = True
+			self.read_pauses += 1
+			self.server.read_pauses += 1
+			read_pauses_total.inc()
 	
-	async def get_bytes(self, now=False) -> bytes:
+	def resume_reading(self):
+		if self.reading_paused:
+			self.reading_paused = False
+			if not self.trans.is_closing():
+				self.trans.resume_reading()
+	
+	def consumed(self, n: int, msgs = 1):
+		bytes_received.inc(n)
+		msgs_received.inc(msgs)
+		if self.reading_paused and len(self.recv_buf) <= self.server.recv_low:
+			self.resume_reading()
+	
+	async def wait_bytes(self, now=False):
+		# Whatever the watermarks say, the handler can't make progress without more
+		# bytes, e.g. when a single frame is larger than recv_high.
+		self.resume_reading()
+		timeout = NOW_TIMEOUT if now else self.server.timeout
+		if timeout is not None:
+			self.server.timers.schedule(self, timeout)
 		try:
-			return await asyncio.wait_for(self.chunks.get(), NOW_TIMEOUT if now else self.server.timeout)
+			await self.recv_buf.wait()
 		except EOFError:
-			self.log(f"{MAGENTA}Peer closed connection")
+			self.lib_log(INFO, f"{MAGENTA}Peer closed connection")
 			raise EOFError
 		except asyncio.TimeoutError:
-			self.log(f"{MAGENTA}Peer timed out")
+			self.lib_log(INFO, f"{MAGENTA}Peer timed out")
 			self.disconnect()
 			raise EOFError
+		finally:
+			self.server.timers.cancel(self)
 	
-	async def get_bytes_until(self, stop_at: Callable[[bytearray], int], now=False):
-		buffer = bytearray()
-		while (i := stop_at(buffer)) == -1:
-			buffer.extend(await self.get_bytes(now))
-		buffer = bytes(buffer)
-		if i == len(buffer):
-			return buffer
-		else:
-			msg, rest = buffer[:i], buffer[i:]
-			self.chunks.put_back(rest)
-			return msg
+	def on_timeout(self):
+		self.recv_buf.fail(asyncio.TimeoutError())
+	
+	# The get_* methods below return memoryviews into the receive buffer rather
+	# than copies. They stay valid after further reads, but should be converted
+	# to bytes before being stored long-term, to avoid pinning the whole buffer.
+	
+	async def get_bytes(self, now=False) -> memoryview:
+		while len(self.recv_buf) == 0:
+			await self.wait_bytes(now)
+		frame = self.recv_buf.take(len(self.recv_buf))
+		self.consumed(len(frame))
+		return frame
 	
-	async def get_n_bytes(self, n: int, now=False) -> bytes:
-		return await self.get_bytes_until(lambda b: -1 if len(b) < n else n, now)
+	async def get_n_bytes(self, n: int, now=False) -> memoryview:
+		if n < 0:
+			raise ValueError(f"cannot read {n} bytes")
+		while len(self.recv_buf) < n:
+			await self.wait_bytes(now)
+		frame = self.recv_buf.take(n)
+		self.consumed(n)
+		return frame
 	
 	async def get_struct(self, fmt: str, now=False) -> Any:
-		b = await self.get_n_bytes(struct.calcsize(fmt), now)
-		tup = struct.unpack(fmt, b)
+		st = compile_struct(fmt)
+		while len(self.recv_buf) < st.size:
+			await self.wait_bytes(now)
+		tup = self.recv_buf.unpack(st)
+		self.consumed(st.size)
 		return tup[0] if len(tup) == 1 else tup
 	
-	async def get_raw_line(self, now=False) -> bytes:
-		def find_nl(b):
-			i = b.find(b"\n")
-			return -1 if i == -1 else i + 1
-		line = await self.get_bytes_until(find_nl, now)
+	async def get_structs(self, fmt: str, now=False) -> Iterator[tuple]:
+		# Waits for at least one record, then unpacks all the complete records
+		# received so far in a single pass
+		st = compile_struct(fmt)
+		while len(self.recv_buf) < st.size:
+			await self.wait_bytes(now)
+		n = len(self.recv_buf) // st.size
+		chunk = self.recv_buf.take(n * st.size)
+		self.consumed(n * st.size, n)
+		return st.iter_unpack(chunk)
+	
+	async def get_raw_line(self, now=False) -> memoryview:
+		scanned = 0
+		while (i := self.recv_buf.find(b"\n", scanned)) == -1:
+			scanned = len(self.recv_buf)
+			await self.wait_bytes(now)
+		line = self.recv_buf.take(i + 1)
+		self.consumed(i + 1)
 		return line
 	
 	async def get_line(self, now=False) -> str:
 		line = await self.get_raw_line(now)
-		return line[:-1].decode("utf-8")
+		return str(line[:-1], "utf-8")
 	
-	def send_bytes(self, data: bytes):
-		self.trans.write(data)
+	async def lines(self, now=False) -> AsyncIterator[str]:
+		# Like calling get_line() until EOF, but all the complete lines received so far
+		# are decoded in one go and yielded without suspending, so with coalesce set the
+		# replies to a chunk of pipelined lines leave in a single write. Before each
+		# chunk, waits for the write buffer to drain if it went over its limit.
+		scanned = 0
+		while True:
+			i = self.recv_buf.rfind(b"\n", scanned)
+			if i == -1:
+				scanned = len(self.recv_buf)
+				try:
+					await self.wait_bytes(now)
+				except EOFError:
+					return
+				continue
+			scanned = 0
+			if self.drain_waiter is not None:
+				try:
+					await self.drain()
+				except EOFError:
+					return
+			n_lines = self.recv_buf.count(b"\n", i + 1)
+			chunk = self.recv_buf.take(i + 1)
+			self.consumed(i + 1, n_lines)
+			for line in split_lines(chunk):
+				yield line
+	
+	# With coalesce set (or inside cork()), writes are collected in out_parts and sent
+	# together by flush(), which runs at the end of the current loop iteration (or
+	# when leaving cork()). Consecutive strings are joined before being encoded.
+	
+	def buffering(self) -> bool:
+		return self.coalesce or self.corked > 0
+	
+	def send_bytes(self, data: bytes | memoryview):
+		msgs_sent.inc()
+		if self.buffering():
+			self.join_strs()
+			self.out_parts.append(data)
+			self.out_len += len(data)
+			self.schedule_flush()
+		else:
+			bytes_sent.inc(len(data))
+			self.trans.write(data)
 	def send_str(self, s: str):
-		self.send_bytes(s.encode("utf-8"))
+		if self.buffering():
+			msgs_sent.inc()
+			self.out_strs.append(s)
+			self.out_len += len(s)
+			self.schedule_flush()
+		else:
+			self.send_bytes(s.encode("utf-8"))
 	def send_line(self, s: str):
-		self.send_str(s + "\n")
+		if self.buffering():
+			msgs_sent.inc()
+			self.out_strs.append(s)
+			self.out_strs.append("\n")
+			self.out_len += len(s) + 1
+			self.schedule_flush()
+		else:
+			self.send_bytes((s + "\n").encode("utf-8"))
 	def send_eof(self):
+		self.flush()
 		self.trans.write_eof()
 	
+	def join_strs(self):
+		if len(self.out_strs) > 0:
+			self.out_parts.append("".join(self.out_strs).encode("utf-8"))
+			self.out_strs.clear()
+	
+	def schedule_flush(self):
+		if self.flush_handle is None and self.corked == 0:
+			self.flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+	
+	def flush(self):
+		if self.flush_handle is not None:
+			self.flush_handle.cancel()
+			self.flush_handle = None
+		self.join_strs()
+		if len(self.out_parts) == 0:
+			return
+		bytes_sent.inc(sum(len(part) for part in self.out_parts))
+		if not self.trans.is_closing():
+			self.trans.writelines(self.out_parts)
+		self.out_parts.clear()
+		self.out_len = 0
+	
+	@contextmanager
+	def cork(self):
+		# Hold back all writes until the end of the block, then send them at once
+		self.corked += 1
+		try:
+			yield
+		finally:
+			self.corked -= 1
+			if self.corked == 0:
+				self.flush()
+	
+	def on_pause_writing(self):
+		self.write_pauses += 1
+		self.server.write_pauses += 1
+		write_pauses_total.inc()
+		self.drain_waiter = asyncio.get_running_loop().create_future()
+	
+	def on_resume_writing(self):
+		if self.drain_waiter is not None:
+			self.drain_waiter.set_result(None)
+			self.drain_waiter = None
+	
+	async def drain(self):
+		# Wait until the transport's write buffer is back under its low watermark
+		self.flush()
+		if self.drain_waiter is not None:
+			await asyncio.shield(self.drain_waiter)
+		if self.trans.is_closing():
+			raise EOFError
+	
 	def send_struct(self, fmt: str, *v: Any):
-		self.send_bytes(struct.pack(fmt, *v))
+		self.send_bytes(compile_struct(fmt).pack(*v))
+	
+	def write_buffer_size(self) -> int:
+		# Bytes written but not sent yet, whether still coalesced or in the transport
+		return self.out_len + self.trans.get_write_buffer_size()
 	
 	def disconnect(self):
+		self.flush()
 		self.trans.close()
+	
+	def abort(self):
+		# Drop whatever is left to send and reset the connection
+		if self.flush_handle is not None:
+			self.flush_handle.cancel()
+			self.flush_handle = None
+		self.out_parts.clear()
+		self.out_strs.clear()
+		self.out_len = 0
+		self.trans.abort()
 
 
 TcpHandler = Callable[[TcpPeer], Coroutine]
 
-class TcpProtocol(asyncio.Protocol):
+class TcpProtocol(asyncio.BufferedProtocol):
 	server: "TcpServer"
-	peer: TcpPeer
+	peer: TcpPeer | None # None if the connection was rejected
 	
 	def __init__(self, server: "TcpServer", custom_handler: Handler | None = None, peer_prefix = "peer"):
 		self.server = server
@@ -306,28 +931,148 @@ class TcpProtocol(asyncio.Protocol):
 		self.peer_prefix = peer_prefix
 	
 	def connection_made(self, trans: asyncio.Transport):
+		if self.custom_handler is None: # outgoing connections are not subject to limits
+			reason = self.server.admit(trans.get_extra_info("peername"))
+			if reason is not None:
+				self.peer = None
+				self.server.reject(trans, reason)
+				return
 		self.peer = TcpPeer(self.server, trans, self.peer_prefix)
+		self.peer.admitted = self.custom_handler is None
 		self.server.new_peer(self.peer, self.custom_handler)
 	
 	def eof_received(self):
 		self.peer.on_eof()
 		return True # allow half-duplex shutdown
 	
+	def get_buffer(self, sizehint: int) -> memoryview:
+		return self.peer.recv_buf.get_buffer(sizehint)
+	
+	def buffer_updated(self, nbytes: int):
+		self.peer.recv_buf.buffer_updated(nbytes)
+		self.peer.on_bytes()
+	
+	def pause_writing(self):
+		self.peer.on_pause_writing()
+	
+	def resume_writing(self):
+		self.peer.on_resume_writing()
+	
+	def connection_lost(self, exc: Exception | None):
+		if self.peer is None: # rejected
+			return
+		if exc is not None:
+			self.peer.lib_log(WARN, f"{YELLOW}Connection lost:{RESET}", exc)
+		self.peer.on_eof() # also wakes up the handler if the connection was aborted on our side
+		self.peer.on_resume_writing() # wake up drain() so it can raise
+
+class PassthroughProtocol(asyncio.Protocol):
+	# Sends whatever it receives right back from data_received: no peer, handler task,
+	# receive buffer or future per chunk. Reading pauses while the transport's write
+	# buffer is over its high watermark, so that a client uploading without reading
+	# is held back by TCP instead of having its data pile up in memory.
+	server: "TcpServer"
+	trans: asyncio.Transport | None # None if the connection was rejected
+	addr: Addr
+	name: str
+	write_pauses: int
+	
+	def __init__(self, server: "TcpServer"):
+		self.server = server
+		self.trans = None
+		self.write_pauses = 0
+	
+	def connection_made(self, trans: asyncio.Transport):
+		self.addr = trans.get_extra_info("peername")
+		reason = self.server.admit(self.addr)
+		if reason is not None:
+			self.server.reject(trans, reason)
+			return
+		self.trans = trans
+		self.name = "peer" + str(self.server.new_peer_id())
+		connections_total.inc()
+		peers_active.inc()
+		if self.server.send_high is not None:
+			trans.set_write_buffer_limits(self.server.send_high, self.server.send_low)
+		self.lib_log(INFO, f"{CYAN}Connected to", Lazy(get_addr_str, self.addr))
+	
+	def lib_log(self, level: int, *args):
+		if lib_logger.enabled(level):
+			lib_logger.log(level, f"{DIM_WHITE}{self.name}{RESET}", *args)
+	
 	def data_received(self, data: bytes):
-		self.peer.on_bytes(data)
+		bytes_received.inc(len(data))
+		bytes_sent.inc(len(data))
+		self.trans.write(data)
+	
+	def eof_received(self):
+		self.lib_log(INFO, f"{MAGENTA}Peer closed connection")
+		return False # close once everything received was sent back
+	
+	def pause_writing(self):
+		self.write_pauses += 1
+		self.server.write_pauses += 1
+		write_pauses_total.inc()
+		self.trans.pause_reading()
+	
+	def resume_writing(self):
+		self.trans.resume_reading()
 	
 	def connection_lost(self, exc: Exception | None):
+		if self.trans is None: # rejected
+			return
 		if exc is not None:
-			self.peer.warn("Connection lost:", exc)
-			self.peer.on_eof()
+			self.lib_log(WARN, f"{YELLOW}Connection lost:{RESET}", exc)
+		if self.write_pauses > 0:
+			self.lib_log(WARN, f"{YELLOW}Throttled {self.write_pauses} times on write")
+		peers_active.dec()
+		self.server.release(self.addr)
 
 class TcpServer(Server[TcpPeer]):
 	server: asyncio.Server
 	backlog: int
+	recv_high: int | None
+	recv_low: int
+	send_high: int | None
+	send_low: int | None
+	read_pauses: int
+	write_pauses: int
+	coalesce: bool
+	passthrough: bool
+	max_peers: int | None
+	max_peers_per_ip: int | None
+	accept_bucket: TokenBucket | None
+	reject_msg: bytes | None
+	peer_count: int
+	peers_per_ip: Dict[str, int]
+	rejections: Dict[str, int] # reason → count
 	
-	def __init__(self, handler: TcpHandler, timeout: float | None, backlog: int):
+	def __init__(self, handler: TcpHandler, timeout: float | None, backlog: int,
+			recv_high: int | None = RECV_HIGH, recv_low: int = RECV_LOW,
+			send_high: int | None = None, send_low: int | None = None, coalesce = False,
+			max_peers: int | None = None, max_peers_per_ip: int | None = None,
+			accept_rate: float | None = None, accept_burst: int | None = None,
+			reject_msg: bytes | None = None, passthrough = False):
 		super().__init__(handler, timeout)
+		self.coalesce = coalesce
+		self.passthrough = passthrough
 		self.backlog = backlog
+		self.recv_high = recv_high
+		self.recv_low = recv_low
+		self.send_high = send_high
+		self.send_low = send_low
+		self.read_pauses = 0
+		self.write_pauses = 0
+		self.max_peers = max_peers
+		self.max_peers_per_ip = max_peers_per_ip
+		self.accept_bucket = None
+		if accept_rate is not None:
+			burst = accept_burst if accept_burst is not None else max(1, math.ceil(accept_rate))
+			self.accept_bucket = TokenBucket(accept_rate, burst)
+		self.reject_msg = reject_msg
+		self.peer_count = 0
+		self.peers_per_ip = {}
+		self.rejections = {}
 	
 	async def add_external_peer(self, host, port, family, prefix: str, handler: TcpHandler) -> TcpPeer:
 		loop = asyncio.get_running_loop()
@@ -335,16 +1080,120 @@ class TcpServer(Server[TcpPeer]):
 		return prot.peer
 	
 	async def open(self, port: int):
-		sock = listen_ip(socket.SOCK_STREAM, port)
+		sock = listen_ip(socket.SOCK_STREAM, port, self.reuse_port)
 		loop = asyncio.get_running_loop()
-		self.server = await loop.create_server(lambda: TcpProtocol(self), sock=sock, backlog=self.backlog)
+		if self.passthrough:
+			factory = lambda: PassthroughProtocol(self)
+		else:
+			factory = lambda: TcpProtocol(self)
+		self.server = await loop.create_server(factory, sock=sock, backlog=self.backlog)
 	
 	async def close(self):
 		self.server.close()
 		await self.server.wait_closed()
+		if self.read_pauses > 0 or self.write_pauses > 0:
+			lib_logger.warn(f"{YELLOW}Throttled peers {self.read_pauses} times on read, {self.write_pauses} times on write")
+		if len(self.rejections) > 0:
+			counts = ", ".join(f"{n} ({reason})" for reason, n in self.rejections.items())
+			lib_logger.warn(f"{YELLOW}Rejected connections:{RESET}", counts)
+	
+	def admit(self, addr: Addr) -> str | None:
+		# Returns why the connection should be rejected, or None after counting it in
+		host = get_host(addr)
+		if self.max_peers is not None and self.peer_count >= self.max_peers:
+			return "max_peers"
+		if self.max_peers_per_ip is not None and self.peers_per_ip.get(host, 0) >= self.max_peers_per_ip:
+			return "max_peers_per_ip"
+		if self.accept_bucket is not None and not self.accept_bucket.take():
+			return "accept_rate"
+		self.peer_count += 1
+		self.peers_per_ip[host] = self.peers_per_ip.get(host, 0) + 1
+		return None
+	
+	def reject(self, trans: asyncio.Transport, reason: str):
+		self.rejections[reason] = self.rejections.get(reason, 0) + 1
+		rejected_total.labels(reason).inc()
+		if lib_logger.enabled(DEBUG):
+			lib_logger.debug(f"{YELLOW}Rejected", get_addr_str(trans.get_extra_info("peername")), f"({reason})")
+		if self.reject_msg is not None:
+			trans.write(self.reject_msg)
+			trans.close()
+		else:
+			trans.abort() # reset the connection right away
+	
+	def remove_peer(self, peer: TcpPeer):
+		if peer.read_pauses > 0 or peer.write_pauses > 0:
+			peer.lib_log(WARN, f"{YELLOW}Throttled {peer.read_pauses} times on read, {peer.write_pauses} times on write")
+		if peer.dropped > 0:
+			peer.lib_log(WARN, f"{YELLOW}Dropped {peer.dropped} broadcast messages")
+		if peer.admitted:
+			self.release(peer.addr)
+	
+	def release(self, addr: Addr):
+		# Uncounts a peer that admit() let in
+		self.peer_count -= 1
+		host = get_host(addr)
+		self.peers_per_ip[host] -= 1
+		if self.peers_per_ip[host] == 0:
+			del self.peers_per_ip[host]
+
+# recv_high/recv_low: bytes buffered per peer at which reading from it is paused/resumed
+# (recv_high=None disables read throttling). send_high/send_low: write buffer limits
+# used by TcpPeer.drain(), asyncio's defaults if None. coalesce: buffer each peer's
+# writes until the end of the event loop iteration and send them in one go.
+# max_peers/max_peers_per_ip: limits on concurrent peers, overall and per source IP.
+# accept_rate/accept_burst: token bucket limiting new connections per second (the
+# burst defaults to one second's worth). Connections over a limit are reset, or sent
+# reject_msg and closed if given, without ever reaching the handler. passthrough: send
+# back everything received as soon as it is, instead of running the handler (echo).
+def serve_tcp(handler: TcpHandler, port=PORT, timeout: float | None = None, backlog=TCP_BACKLOG, debug=False,
+		recv_high: int | None = RECV_HIGH, recv_low: int = RECV_LOW,
+		send_high: int | None = None, send_low: int | None = None, coalesce = False,
+		max_peers: int | None = None, max_peers_per_ip: int | None = None,
+		accept_rate: float | None = None, accept_burst: int | None = None, reject_msg: bytes | None = None,
+		passthrough = False, workers: int | None = None, single_worker=False, stats_port: int | None = None,
+		loop: str | None = None, on_start: Callable[[TcpServer], Coroutine] | None = None,
+		on_stop: Callable[[TcpServer], Coroutine] | None = None):
+	server = TcpServer(handler, timeout, backlog, recv_high, recv_low, send_high, send_low, coalesce,
+		max_peers, max_peers_per_ip, accept_rate, accept_burst, reject_msg, passthrough)
+	run_server(server, port, debug, workers, single_worker, stats_port, loop, on_start, on_stop)
+
 
-def serve_tcp(handler: TcpHandler, port=PORT, timeout: float | None = None, backlog=TCP_BACKLOG, debug=False):
-	asyncio.run(TcpServer(handler, timeout, backlog).serve(port), debug=debug)
+class Broadcast:
+	# Sends the same message to many peers, encoded once: every recipient gets the
+	# same bytes object. Recipients with more than max_buffer bytes still waiting to
+	# be sent are slow consumers, which either miss the message (policy "drop") or
+	# get disconnected (policy "disconnect"), so that one stalled client cannot make
+	# the server buffer everything said in the room for it.
+	max_buffer: int
+	policy: str
+	
+	def __init__(self, max_buffer = BROADCAST_MAX_BUFFER, policy = "disconnect"):
+		if policy not in ("drop", "disconnect"):
+			raise ValueError(f"Unknown slow consumer policy: {policy}")
+		self.max_buffer = max_buffer
+		self.policy = policy
+	
+	def send_bytes(self, peers: Iterable[TcpPeer], data: bytes, except_peer: TcpPeer | None = None):
+		for peer in peers:
+			if peer is except_peer or peer.trans.is_closing():
+				continue
+			if peer.write_buffer_size() + len(data) > self.max_buffer:
+				self.on_slow(peer)
+			else:
+				peer.send_bytes(data)
+	
+	def send_line(self, peers: Iterable[TcpPeer], s: str, except_peer: TcpPeer | None = None):
+		self.send_bytes(peers, (s + "\n").encode("utf-8"), except_peer)
+	
+	def on_slow(self, peer: TcpPeer):
+		if self.policy == "drop":
+			peer.dropped += 1
+			broadcast_dropped_total.inc()
+		else:
+			slow_consumers_total.inc()
+			peer.lib_log(WARN, f"{YELLOW}Disconnecting slow consumer with", peer.write_buffer_size(), "bytes queued")
+			peer.abort()
 
 
 class UdpPeer(Peer):
@@ -360,13 +1209,25 @@ class UdpPeer(Peer):
 		self.dgrams.put(data)
 	
 	async def get_dgram(self) -> bytes:
+		if self.server.timeout is not None:
+			self.server.timers.schedule(self, self.server.timeout)
 		try:
-			return await asyncio.wait_for(self.dgrams.get(), self.server.timeout)
+			dgram = await self.dgrams.get()
 		except asyncio.TimeoutError:
-			self.log(f"{MAGENTA}Peer timed out.")
+			self.lib_log(INFO, f"{MAGENTA}Peer timed out.")
 			raise EOFError
+		finally:
+			self.server.timers.cancel(self)
+		bytes_received.inc(len(dgram))
+		msgs_received.inc()
+		return dgram
+	
+	def on_timeout(self):
+		self.dgrams.fail(asyncio.TimeoutError())
 	
 	def send_dgram(self, data: bytes):
+		bytes_sent.inc(len(data))
+		msgs_sent.inc()
 		self.server.trans.sendto(data, self.addr)
 	
 	def disconnect(self):
@@ -384,7 +1245,7 @@ class UdpServer(Server, asyncio.DatagramProtocol):
 		self.peers = {}
 	
 	async def open(self, port: int):
-		sock = listen_ip(socket.SOCK_DGRAM, port)
+		sock = listen_ip(socket.SOCK_DGRAM, port, self.reuse_port)
 		loop = asyncio.get_running_loop()
 		await loop.create_datagram_endpoint(lambda: self, sock=sock)
 	
@@ -402,8 +1263,40 @@ class UdpServer(Server, asyncio.DatagramProtocol):
 	
 	def connection_lost(self, exc: Exception | None):
 		if exc is not None:
-			log(f"{BRIGHT_RED}Connection lost: {exc}")
+			lib_logger.error(f"{BRIGHT_RED}Connection lost: {exc}")
+			self.stop()
+
+# Called with each datagram, its source address and a function sending a reply to it
+DgramHandler = Callable[[bytes, Addr, Callable[[bytes], None]], None]
+
+class StatelessUdpServer(UdpServer):
+	# Calls a plain function for every datagram, straight from datagram_received: no
+	# peer, handler task or timeout per source address, for protocols where each
+	# datagram stands on its own. A burst from many addresses costs no more than
+	# the same burst from one.
+	handler: DgramHandler
+	
+	def datagram_received(self, data: bytes, addr: Addr):
+		bytes_received.inc(len(data))
+		msgs_received.inc()
+		try:
+			self.handler(data, addr, lambda res: self.send_dgram(res, addr))
+		except Exception:
+			handler_errors.inc()
+			lib_logger.error(f"{BRIGHT_RED}Error handling datagram from", get_addr_str(addr))
+			lib_logger.error(f"{BRIGHT_RED}{traceback.format_exc().rstrip()}")
 			self.stop()
+	
+	def send_dgram(self, data: bytes, addr: Addr):
+		bytes_sent.inc(len(data))
+		msgs_sent.inc()
+		self.trans.sendto(data, addr)
 
-def serve_udp(handler: UdpHandler, port=PORT, timeout: float | None = UDP_TIMEOUT, debug=False):
-	asyncio.run(UdpServer(handler, timeout).serve(port), debug=debug)
+# stateless: handler is a DgramHandler, called synchronously for every datagram
+# (timeout does not apply). Otherwise each source address gets a UdpPeer and a task.
+def serve_udp(handler: UdpHandler | DgramHandler, port=PORT, timeout: float | None = UDP_TIMEOUT, debug=False,
+		stateless=False, workers: int | None = None, single_worker=False, stats_port: int | None = None,
+		loop: str | None = None, on_start: Callable[["UdpServer"], Coroutine] | None = None,
+		on_stop: Callable[["UdpServer"], Coroutine] | None = None):
+	server = StatelessUdpServer(handler, None) if stateless else UdpServer(handler, timeout)
+	run_server(server, port, debug, workers, single_worker, stats_port, loop, on_start, on_stop)
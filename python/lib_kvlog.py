@@ -0,0 +1,251 @@
+import asyncio
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate, islice
+import mmap
+import os
+import signal
+import struct
+import sys
+from typing import MutableMapping, Sequence
+import zlib
+
+from lib_color import *
+import lib_log
+from lib_log import get_logger
+
+
+BATCH_HEADER = struct.Struct("<4sIII") # magic, records, payload bytes, CRC-32 of the payload
+BATCH_MAGIC = b"KVB1"
+SNAPSHOT_HEADER = struct.Struct("<8sQ") # magic, first log segment not covered
+SNAPSHOT_MAGIC = b"KVSNAP1\0"
+SNAPSHOT_BATCH = 1 << 20 # records per batch in snapshots
+FLUSH_INTERVAL = 0.01 # seconds, appends made within it are written and fsynced together
+SNAPSHOT_LOG_BYTES = 64 * 1024 * 1024 # log size past which a snapshot is taken
+
+logger = get_logger("kvlog")
+
+# Persistence for a dict of bytes to bytes, as a write-ahead log and snapshots.
+#
+# Both are made of batches: a header, the lengths of all keys and values as an
+# array of 32-bit ints, then all keys and values back to back. This makes loading
+# a batch a few calls into C code over an mmap of the file, instead of a Python loop
+# per record. Appends are buffered and written as one batch per FLUSH_INTERVAL,
+# with a single fsync (group commit), in a thread so that the event loop goes on.
+# The threads are KvLog's own: writes must keep going while the event loop shuts
+# down, after its default executor is gone.
+#
+# The log is split in segments, log.<n>. Once the current one grows past
+# SNAPSHOT_LOG_BYTES, writes move on to the next and a forked process writes the
+# whole dict as it was at that point to a snapshot, relying on copy-on-write for a
+# consistent view without pausing the server. The snapshot records the first segment
+# it does not cover, older ones are deleted once it is in place. Replaying records
+# also found in the snapshot is harmless: the same values get set again.
+
+def encode_batch(keys: Sequence[bytes], values: Sequence[bytes]) -> bytes:
+	lengths = array("I", (len(x) for pair in zip(keys, values) for x in pair))
+	if sys.byteorder == "big":
+		lengths.byteswap()
+	payload = b"".join([lengths.tobytes(), *(x for pair in zip(keys, values) for x in pair)])
+	return BATCH_HEADER.pack(BATCH_MAGIC, len(keys), len(payload), zlib.crc32(payload)) + payload
+
+def decode_batches(data: mmap.mmap | bytes, start: int, values: MutableMapping[bytes, bytes]) -> int:
+	# Sets the records of all complete and intact batches from start on, returns where
+	# the last one ended: anything after it is a torn write
+	end = start
+	while end + BATCH_HEADER.size <= len(data):
+		magic, count, size, crc = BATCH_HEADER.unpack_from(data, end)
+		payload_start = end + BATCH_HEADER.size
+		if magic != BATCH_MAGIC or payload_start + size > len(data):
+			break
+		payload = memoryview(data)[payload_start : payload_start + size]
+		try:
+			if zlib.crc32(payload) != crc:
+				break
+			lengths = array("I")
+			lengths.frombytes(payload[: 8 * count])
+		finally:
+			payload.release()
+		if sys.byteorder == "big":
+			lengths.byteswap()
+		offsets = list(accumulate(lengths, initial=payload_start + 8 * count))
+		get = data.__getitem__
+		keys = map(get, map(slice, offsets[0:-1:2], offsets[1::2]))
+		vals = map(get, map(slice, offsets[1::2], offsets[2::2]))
+		values.update(zip(keys, vals))
+		end = payload_start + size
+	return end
+
+
+class KvLog:
+	dir: str
+	flush_interval: float
+	snapshot_bytes: int
+	segment: int # number of the segment being written
+	fd: int | None
+	log_bytes: int # bytes in the current segment
+	pending_keys: list[bytes]
+	pending_values: list[bytes]
+	flush_handle: asyncio.TimerHandle | None
+	writing: asyncio.Future | None # batch being written and fsynced
+	snapshotting: asyncio.Future | None
+	executor: ThreadPoolExecutor # one thread writing the log, one waiting for snapshots
+	values: MutableMapping[bytes, bytes]
+	
+	def __init__(self, dir: str, flush_interval = FLUSH_INTERVAL, snapshot_bytes = SNAPSHOT_LOG_BYTES):
+		self.dir = dir
+		self.flush_interval = flush_interval
+		self.snapshot_bytes = snapshot_bytes
+		self.fd = None
+		self.pending_keys = []
+		self.pending_values = []
+		self.flush_handle = None
+		self.writing = None
+		self.snapshotting = None
+		self.executor = ThreadPoolExecutor(2, "kvlog")
+	
+	def path(self, name: str) -> str:
+		return os.path.join(self.dir, name)
+	
+	def segments(self) -> list[int]:
+		return sorted(int(name[4:]) for name in os.listdir(self.dir)
+			if name.startswith("log.") and name[4:].isdigit())
+	
+	def load(self, values: MutableMapping[bytes, bytes] | None = None) -> MutableMapping[bytes, bytes]:
+		# Reads the snapshot and the log segments after it into values (a new dict by
+		# default), then opens a new segment
+		os.makedirs(self.dir, exist_ok=True)
+		self.values = values if values is not None else {}
+		first_segment = 0
+		snapshot_path = self.path("snapshot")
+		if os.path.exists(snapshot_path):
+			with open(snapshot_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+				magic, first_segment = SNAPSHOT_HEADER.unpack_from(mm)
+				if magic != SNAPSHOT_MAGIC:
+					raise ValueError(f"{snapshot_path} is not a snapshot")
+				if decode_batches(mm, SNAPSHOT_HEADER.size, self.values) != len(mm):
+					raise ValueError(f"{snapshot_path} is corrupted")
+		snapshot_keys = len(self.values)
+		
+		segments = [n for n in self.segments() if n >= first_segment]
+		for n in segments:
+			path = self.path(f"log.{n}")
+			if os.path.getsize(path) == 0:
+				continue
+			with open(path, "r+b") as f:
+				with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+					end = decode_batches(mm, 0, self.values)
+					size = len(mm)
+				if end < size:
+					logger.warn(f"{YELLOW}Dropping {size - end} bytes of torn writes at the end of {path}")
+					f.truncate(end)
+		logger.info(f"Loaded {snapshot_keys} keys from the snapshot and {len(self.values) - snapshot_keys}"
+			+ f" more from {len(segments)} log segments")
+		
+		self.segment = max([first_segment - 1, *segments]) + 1
+		self.open_segment()
+		return self.values
+	
+	def open_segment(self):
+		if self.fd is not None:
+			os.close(self.fd)
+		self.fd = os.open(self.path(f"log.{self.segment}"), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+		self.log_bytes = 0
+	
+	def append(self, key: bytes, value: bytes):
+		self.pending_keys.append(key)
+		self.pending_values.append(value)
+		if self.flush_handle is None and self.writing is None:
+			self.flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+	
+	def flush(self):
+		# Starts writing everything appended since the last batch
+		self.flush_handle = None
+		if len(self.pending_keys) == 0 or self.writing is not None:
+			return
+		batch = encode_batch(self.pending_keys, self.pending_values)
+		self.pending_keys, self.pending_values = [], []
+		self.writing = asyncio.get_running_loop().run_in_executor(self.executor, self.write, self.fd, batch)
+		self.writing.add_done_callback(self.on_written)
+	
+	@staticmethod
+	def write(fd: int, batch: bytes) -> int:
+		os.write(fd, batch)
+		os.fsync(fd)
+		return len(batch)
+	
+	def on_written(self, writing: asyncio.Future):
+		self.writing = None
+		if writing.exception() is not None:
+			logger.error(f"{BRIGHT_RED}Could not write to the log:", writing.exception())
+			return
+		self.log_bytes += writing.result()
+		if self.log_bytes >= self.snapshot_bytes and self.snapshotting is None:
+			self.snapshot()
+		if len(self.pending_keys) > 0: # appended while writing, already waited long enough
+			self.flush()
+	
+	def snapshot(self):
+		# Moves on to a new segment and snapshots the dict in a forked process
+		self.segment += 1
+		self.open_segment()
+		lib_log.flush()
+		pid = os.fork()
+		if pid == 0:
+			# Forked from the running event loop: drop its signal handlers and wakeup fd
+			signal.set_wakeup_fd(-1)
+			signal.signal(signal.SIGINT, signal.SIG_DFL)
+			signal.signal(signal.SIGTERM, signal.SIG_DFL)
+			code = 0
+			try:
+				self.write_snapshot(self.segment)
+			except BaseException as exc:
+				logger.error(f"{BRIGHT_RED}Could not write snapshot:", exc)
+				code = 1
+			finally:
+				lib_log.flush()
+				os._exit(code)
+		logger.info(f"Writing snapshot of {len(self.values)} keys (process {pid})")
+		self.snapshotting = asyncio.get_running_loop().run_in_executor(self.executor, self.wait_snapshot, pid, self.segment)
+		self.snapshotting.add_done_callback(self.on_snapshot)
+	
+	def write_snapshot(self, first_segment: int):
+		tmp_path = self.path("snapshot.tmp")
+		with open(tmp_path, "wb") as f:
+			f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, first_segment))
+			items = iter(self.values.items())
+			while len(batch := list(islice(items, SNAPSHOT_BATCH))) > 0:
+				keys, values = zip(*batch)
+				f.write(encode_batch(keys, values))
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_path, self.path("snapshot"))
+		dir_fd = os.open(self.dir, os.O_RDONLY)
+		try:
+			os.fsync(dir_fd)
+		finally:
+			os.close(dir_fd)
+	
+	def wait_snapshot(self, pid: int, first_segment: int):
+		# In a thread, so that it also completes while the event loop shuts down
+		_, status = os.waitpid(pid, 0)
+		if os.waitstatus_to_exitcode(status) != 0:
+			logger.error(f"{BRIGHT_RED}Snapshot failed, keeping the log")
+			return
+		for n in self.segments():
+			if n < first_segment:
+				os.unlink(self.path(f"log.{n}"))
+		logger.info(f"Snapshot written, log segments before {first_segment} deleted")
+	
+	def on_snapshot(self, _done: asyncio.Future):
+		self.snapshotting = None
+	
+	def close(self):
+		# Once the event loop is closed: waits for the threads, then writes what was
+		# appended since the last batch
+		self.executor.shutdown()
+		if len(self.pending_keys) > 0:
+			self.write(self.fd, encode_batch(self.pending_keys, self.pending_values))
+			self.pending_keys, self.pending_values = [], []
+		os.close(self.fd)
+		self.fd = None
@@ -0,0 +1,291 @@
+from array import array
+import mmap
+import struct
+from typing import Iterable, Iterator, MutableMapping
+
+import lib_metrics
+
+
+ENTRY_HEADER = struct.Struct("<IBII") # key hash, flags, value length, key length, then the key and value
+KEY_LENGTH = struct.Struct("<I")
+FLAGS_AT = 4
+KEY_LENGTH_AT = 9 # the key follows it
+REFERENCED = 1 # flags: read or overwritten since written or since the clock hand last passed
+PINNED = 2 # never evicted
+PADDING = 4 # not an entry, the rest of the arena up to its end is unused
+INDEX_SHARE = 1 / 4 # part of the budget for the index, the rest goes to the arena
+INDEX_LOAD = 0.7 # fraction of index slots used before it grows or keys are evicted
+INDEX_MIN_SLOTS = 1024
+EMPTY = 0xFFFFFFFF # index slot without a key
+HASH_MASK = 0xFFFFFFFF # hashes are truncated to 32 bits, offsets are 32-bit too
+SLOT_BYTES = 8
+
+evictions_total = lib_metrics.counter("kvstore_evictions_total", "Keys evicted to stay within the memory budget")
+
+# A dict of bytes to bytes held within a fixed memory budget.
+#
+# Instead of two bytes objects and a dict entry per key (about 100 bytes of overhead,
+# plus the lengths), entries are packed into a single anonymous mmap, the arena: a
+# 13-byte header, the key and the value. Its pages are only allocated as they are
+# first written to, so memory grows with the data up to the budget. The index is an
+# open-addressing hash table with linear probing, made of two arrays of the keys'
+# hashes and their entries' offsets, both 32-bit. Overall, a key costs its lengths
+# plus 13 bytes in the arena and 8 bytes per index slot, of which there are up to
+# twice as many as keys. The arena is limited to 4 GiB.
+#
+# The arena is a ring: entries are written at the head and space is reclaimed at the
+# tail, skipping entries that were overwritten since. This is also how eviction
+# works, as a CLOCK: when the tail reaches an entry that was used since it was
+# written or last passed, it gets a second chance and is moved to the head instead of
+# being evicted. New entries start unreferenced, so that a scan of keys that are
+# never read again does not push out the others. Pinned entries are always moved.
+# The index grows up to its share of the budget, past that keys are evicted the same
+# way to make room in it.
+
+class KvStore(MutableMapping[bytes, bytes]):
+	arena: mmap.mmap
+	view: memoryview
+	capacity: int # bytes in the arena
+	head: int # where the next entry is written
+	tail: int # oldest entry
+	used: int # bytes from the tail to the head, including overwritten entries
+	hashes: array
+	offsets: array # offset of each index slot's entry, or EMPTY
+	mask: int # index slots - 1
+	max_slots: int
+	count: int
+	evictions: int
+	
+	def __init__(self, budget: int):
+		self.max_slots = INDEX_MIN_SLOTS
+		while self.max_slots * 2 * SLOT_BYTES <= budget * INDEX_SHARE:
+			self.max_slots *= 2
+		self.capacity = min(budget - self.max_slots * SLOT_BYTES, EMPTY)
+		if self.capacity < self.max_slots * SLOT_BYTES:
+			raise ValueError(f"budget of {budget} bytes too small, the index alone takes {self.max_slots * SLOT_BYTES}")
+		# Private, so that a forked snapshot keeps seeing the arena as it was (copy-on-write)
+		self.arena = mmap.mmap(-1, self.capacity, flags=mmap.MAP_PRIVATE)
+		self.view = memoryview(self.arena)
+		self.head = self.tail = self.used = 0
+		self.hashes = array("I", [0]) * INDEX_MIN_SLOTS
+		self.offsets = array("I", [EMPTY]) * INDEX_MIN_SLOTS
+		self.mask = INDEX_MIN_SLOTS - 1
+		self.count = 0
+		self.evictions = 0
+	
+	def __len__(self) -> int:
+		return self.count
+	
+	def stats(self) -> str:
+		return (f"{self.count} keys, {self.evictions} evictions, {self.used / 1024:.1f} of {self.capacity / 1024:.0f} KiB"
+			+ f" of arena used, {self.mask + 1} of {self.max_slots} index slots")
+	
+	def memory_bytes(self) -> int:
+		# What the store holds on to at most, once the arena has been written all over
+		return self.capacity + (self.mask + 1) * SLOT_BYTES
+	
+	def find(self, key: bytes, h: int) -> int:
+		# Index slot of the key, or the empty one where it would go as ~slot
+		arena, hashes, offsets, mask = self.arena, self.hashes, self.offsets, self.mask
+		probe = KEY_LENGTH.pack(len(key)) + key
+		i = h & mask
+		while True:
+			off = offsets[i]
+			if off == EMPTY:
+				return ~i
+			if hashes[i] == h and arena.find(probe, off + KEY_LENGTH_AT, off + KEY_LENGTH_AT + len(probe)) >= 0:
+				return i
+			i = (i + 1) & mask
+	
+	def slot_at(self, h: int, off: int) -> int:
+		# Index slot of the entry at off, or EMPTY if it was overwritten
+		hashes, offsets, mask = self.hashes, self.offsets, self.mask
+		i = h & mask
+		while offsets[i] != EMPTY:
+			if offsets[i] == off and hashes[i] == h:
+				return i
+			i = (i + 1) & mask
+		return EMPTY
+	
+	def get(self, key: bytes, default: bytes | None = None) -> bytes | None:
+		# find() inlined, as the most common operation
+		arena, hashes, offsets, mask = self.arena, self.hashes, self.offsets, self.mask
+		h = hash(key) & HASH_MASK
+		i = h & mask
+		while True:
+			off = offsets[i]
+			if off == EMPTY:
+				return default
+			if hashes[i] == h:
+				_, flags, vlen, klen = ENTRY_HEADER.unpack_from(arena, off)
+				start = off + ENTRY_HEADER.size
+				if klen == len(key) and arena.find(key, start, start + klen) >= 0:
+					if not flags & REFERENCED:
+						arena[off + FLAGS_AT] = flags | REFERENCED
+					return self.view[start + klen : start + klen + vlen].tobytes()
+			i = (i + 1) & mask
+	
+	def __getitem__(self, key: bytes) -> bytes:
+		val = self.get(key)
+		if val is None:
+			raise KeyError(key)
+		return val
+	
+	def __contains__(self, key: bytes) -> bool:
+		return self.find(key, hash(key) & HASH_MASK) >= 0
+	
+	def __setitem__(self, key: bytes, val: bytes):
+		self.set(key, val)
+	
+	def __delitem__(self, key: bytes):
+		# The entry is left in the arena until the tail gets to it
+		i = self.find(key, hash(key) & HASH_MASK)
+		if i < 0:
+			raise KeyError(key)
+		self.remove_slot(i)
+		self.count -= 1
+	
+	def __iter__(self) -> Iterator[bytes]:
+		return self.keys()
+	
+	def set(self, key: bytes, val: bytes, flags: int = 0):
+		h = hash(key) & HASH_MASK
+		i = self.find(key, h)
+		if i >= 0: # same length: overwritten in place
+			off = self.offsets[i]
+			_, old_flags, vlen, klen = ENTRY_HEADER.unpack_from(self.arena, off)
+			if vlen == len(val):
+				start = off + ENTRY_HEADER.size + klen
+				self.arena[off + FLAGS_AT] = old_flags | flags | REFERENCED
+				self.arena[start : start + vlen] = val
+				return
+			flags |= old_flags & PINNED
+		size = ENTRY_HEADER.size + len(key) + len(val)
+		if size > self.capacity:
+			raise ValueError(f"entry of {size} bytes larger than the store")
+		off = self.alloc(size)
+		ENTRY_HEADER.pack_into(self.arena, off, h, flags, len(val), len(key))
+		start = off + ENTRY_HEADER.size
+		self.arena[start : start + len(key)] = key
+		self.arena[start + len(key) : off + size] = val
+		self.head = off + size
+		self.used += size
+		i = self.find(key, h) # alloc may have evicted or moved it
+		if i >= 0:
+			self.offsets[i] = off
+			return
+		if self.count + 1 > (self.mask + 1) * INDEX_LOAD:
+			self.grow()
+			i = self.find(key, h)
+		self.hashes[~i] = h
+		self.offsets[~i] = off
+		self.count += 1
+	
+	def pin(self, key: bytes, val: bytes):
+		self.set(key, val, PINNED)
+	
+	def update(self, items: Iterable[tuple[bytes, bytes]]):
+		for key, val in items:
+			self.set(key, val)
+	
+	def items(self) -> Iterator[tuple[bytes, bytes]]:
+		# Oldest first, the store must not be changed meanwhile
+		off, remaining = self.tail, self.used
+		while remaining > 0:
+			if self.capacity - off < ENTRY_HEADER.size or self.arena[off + FLAGS_AT] & PADDING:
+				remaining -= self.capacity - off
+				off = 0
+				continue
+			h, _, vlen, klen = ENTRY_HEADER.unpack_from(self.arena, off)
+			size = ENTRY_HEADER.size + klen + vlen
+			if self.slot_at(h, off) != EMPTY:
+				start = off + ENTRY_HEADER.size
+				yield self.view[start : start + klen].tobytes(), self.view[start + klen : off + size].tobytes()
+			off += size
+			remaining -= size
+	
+	def keys(self) -> Iterator[bytes]:
+		return (key for key, _ in self.items())
+	
+	def alloc(self, size: int) -> int:
+		# Makes room for size contiguous bytes at the head, and for one more key in the index
+		max_count = self.max_slots * INDEX_LOAD
+		while True:
+			if self.used == 0:
+				self.head = self.tail = 0
+			if self.count >= max_count:
+				self.reclaim()
+			elif self.head > self.tail or self.used == 0:
+				if self.capacity - self.head >= size:
+					return self.head
+				self.pad()
+			elif self.tail - self.head >= size:
+				return self.head
+			else:
+				self.reclaim()
+	
+	def pad(self):
+		# Leaves the end of the arena unused and wraps the head around
+		if self.capacity - self.head >= ENTRY_HEADER.size:
+			ENTRY_HEADER.pack_into(self.arena, self.head, 0, PADDING, 0, 0)
+		self.used += self.capacity - self.head
+		self.head = 0
+	
+	def reclaim(self):
+		# Moves the tail past one entry, evicting it or giving it a second chance
+		tail = self.tail
+		if self.capacity - tail < ENTRY_HEADER.size or self.arena[tail + FLAGS_AT] & PADDING:
+			self.used -= self.capacity - tail
+			self.tail = 0
+			return
+		h, flags, vlen, klen = ENTRY_HEADER.unpack_from(self.arena, tail)
+		size = ENTRY_HEADER.size + klen + vlen
+		i = self.slot_at(h, tail)
+		if i != EMPTY and flags & (REFERENCED | PINNED):
+			if self.head > tail and self.capacity - self.head < size:
+				self.pad()
+			head = self.head
+			self.arena[head : head + size] = self.arena[tail : tail + size] # may overlap, copied first
+			self.arena[head + FLAGS_AT] = flags & ~REFERENCED
+			self.offsets[i] = head
+			self.head = head + size
+			self.used += size
+		elif i != EMPTY:
+			self.remove_slot(i)
+			self.count -= 1
+			self.evictions += 1
+			evictions_total.inc()
+		self.tail = tail + size
+		self.used -= size
+	
+	def remove_slot(self, i: int):
+		# Backward shift deletion: moves up the following keys that would not be found anymore
+		hashes, offsets, mask = self.hashes, self.offsets, self.mask
+		j = i
+		while True:
+			j = (j + 1) & mask
+			if offsets[j] == EMPTY:
+				break
+			k = hashes[j] & mask # where the key would ideally be
+			if (i < j and (k <= i or k > j)) or (j < i and k <= i and k > j):
+				hashes[i] = hashes[j]
+				offsets[i] = offsets[j]
+				i = j
+		offsets[i] = EMPTY
+	
+	def grow(self):
+		slots = (self.mask + 1) * 2
+		if slots > self.max_slots:
+			return
+		old = zip(self.hashes, self.offsets)
+		self.hashes = array("I", [0]) * slots
+		self.offsets = array("I", [EMPTY]) * slots
+		self.mask = slots - 1
+		hashes, offsets, mask = self.hashes, self.offsets, self.mask
+		for h, off in old:
+			if off != EMPTY:
+				i = h & mask
+				while offsets[i] != EMPTY:
+					i = (i + 1) & mask
+				hashes[i] = h
+				offsets[i] = off
@@ -0,0 +1,170 @@
+import atexit
+import os
+import queue
+import sys
+import threading
+import time
+from typing import Any, Callable
+
+from lib_color import *
+
+
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+LEVEL_NAMES = { "debug": DEBUG, "info": INFO, "warn": WARN, "warning": WARN, "error": ERROR }
+
+LOG_ENV = "ASERVE_LOG" # e.g. "info" or "debug,aserve=warn"
+QUEUE_SIZE = 10_000 # lines waiting to be written before new ones are dropped
+BATCH_SIZE = 1_000 # max lines per write
+
+
+start_time = time.monotonic()
+worker_id: int | None = None # set in worker processes
+
+def render(args: tuple) -> str:
+	msg = " ".join(map(str, args))
+	timestamp = f"{time.monotonic() - start_time: >6.2f}s"
+	if worker_id is not None:
+		timestamp += f" w{worker_id}"
+	return f"{DIM_WHITE}{timestamp}{RESET} {msg}{RESET}"
+
+class Lazy:
+	# Log argument whose (expensive) rendering only happens if the line is logged
+	def __init__(self, fn: Callable[..., Any], *args):
+		self.fn = fn
+		self.args = args
+	
+	def __str__(self):
+		return str(self.fn(*self.args))
+
+
+class Writer:
+	queue: queue.Queue
+	thread: threading.Thread | None
+	dropped: int # only written by the logging thread
+	reported: int # only written by the writer thread
+	
+	def __init__(self):
+		self.reset()
+	
+	def reset(self):
+		self.queue = queue.Queue(QUEUE_SIZE)
+		self.thread = None
+		self.dropped = 0
+		self.reported = 0
+	
+	def write(self, line: str):
+		if self.thread is None:
+			self.thread = threading.Thread(target=self.run, name="log writer", daemon=True)
+			self.thread.start()
+		try:
+			self.queue.put_nowait(line)
+		except queue.Full:
+			self.dropped += 1
+	
+	def run(self):
+		while True:
+			line = self.queue.get()
+			stop = line is None
+			lines = [] if stop else [line]
+			while not stop and len(lines) < BATCH_SIZE:
+				try:
+					line = self.queue.get_nowait()
+				except queue.Empty:
+					break
+				if line is None:
+					stop = True
+				else:
+					lines.append(line)
+			
+			dropped = self.dropped
+			if dropped > self.reported:
+				lines.append(render((f"{BRIGHT_YELLOW}Dropped {dropped - self.reported} log lines",)))
+				self.reported = dropped
+			if len(lines) > 0:
+				sys.stdout.write("\n".join(lines) + "\n")
+				sys.stdout.flush()
+			if stop:
+				return
+	
+	def flush(self):
+		# Wait for everything queued so far to be written, then stop the thread
+		if self.thread is None:
+			return
+		self.queue.put(None)
+		self.thread.join()
+		self.thread = None
+
+writer = Writer()
+atexit.register(writer.flush)
+os.register_at_fork(after_in_child=writer.reset)
+
+def flush():
+	writer.flush()
+
+
+default_level = DEBUG
+module_levels: dict[str, int] = {}
+loggers: dict[str, "Logger"] = {}
+
+class Logger:
+	name: str
+	level: int
+	
+	def __init__(self, name: str):
+		self.name = name
+		self.update_level()
+	
+	def update_level(self):
+		self.level = module_levels.get(self.name, default_level)
+	
+	def enabled(self, level: int) -> bool:
+		return level >= self.level
+	
+	def log(self, level: int, *args):
+		if level >= self.level:
+			writer.write(render(args))
+	
+	def debug(self, *args):
+		self.log(DEBUG, *args)
+	
+	def info(self, *args):
+		self.log(INFO, *args)
+	
+	def warn(self, *args):
+		self.log(WARN, *args)
+	
+	def error(self, *args):
+		self.log(ERROR, *args)
+
+def get_logger(name: str) -> Logger:
+	if name not in loggers:
+		loggers[name] = Logger(name)
+	return loggers[name]
+
+def set_level(level: int, module: str | None = None):
+	global default_level
+	if module is None:
+		default_level = level
+	else:
+		module_levels[module] = level
+	for logger in loggers.values():
+		logger.update_level()
+
+def parse_level(s: str) -> int:
+	s = s.strip().lower()
+	return LEVEL_NAMES[s] if s in LEVEL_NAMES else int(s)
+
+def configure(spec: str):
+	for part in spec.split(","):
+		if part.strip() == "":
+			continue
+		if "=" in part:
+			module, level = part.split("=", 1)
+			set_level(parse_level(level), module.strip())
+		else:
+			set_level(parse_level(part))
+
+configure(os.environ.get(LOG_ENV, ""))
@@ -0,0 +1,164 @@
+from bisect import bisect_left
+import heapq
+from typing import Callable, Dict, Iterator, Tuple
+
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60) # seconds
+MAX_SERIES = 50 # per labelled gauge, the smaller ones are summed into OTHER_LABEL
+OTHER_LABEL = "_other"
+
+Sample = Tuple[str, str, float] # (name suffix, labels, value)
+
+def escape_label(value) -> str:
+	return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def fmt_labels(**labels) -> str:
+	if len(labels) == 0:
+		return ""
+	return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in labels.items()) + "}"
+
+class Metric:
+	type = "untyped"
+	name: str
+	help: str
+	
+	def __init__(self, name: str, help: str):
+		self.name = name
+		self.help = help
+	
+	def samples(self) -> Iterator[Sample]:
+		raise NotImplementedError
+	
+	def render(self) -> str:
+		lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+		for suffix, labels, value in self.samples():
+			lines.append(f"{self.name}{suffix}{labels} {value}")
+		return "\n".join(lines)
+
+class Counter(Metric):
+	type = "counter"
+	value: int | float
+	label: str | None
+	children: Dict[str, "Counter"]
+	
+	# With a label, the counter is incremented through labels(), e.g.
+	# rejected.labels("max_peers").inc(), and renders one sample per label value.
+	def __init__(self, name: str, help: str, label: str | None = None):
+		super().__init__(name, help)
+		self.value = 0
+		self.label = label
+		self.children = {}
+	
+	def inc(self, n: int | float = 1):
+		self.value += n
+	
+	def labels(self, value: str) -> "Counter":
+		assert self.label is not None, f"metric {self.name} has no label"
+		if value not in self.children:
+			self.children[value] = Counter(self.name, self.help)
+		return self.children[value]
+	
+	def samples(self):
+		if self.label is None:
+			yield "", "", self.value
+		else:
+			for key, child in self.children.items():
+				yield "", fmt_labels(**{ self.label: key }), child.value
+
+class Gauge(Metric):
+	type = "gauge"
+	value: int | float
+	fn: Callable[[], int | float | Dict[str, int | float]] | None
+	label: str | None
+	
+	max_series: int
+	
+	# If fn is given, it is called on each scrape instead of using value. With a label,
+	# fn returns a dict from label values to values, e.g. a length per queue name. Only
+	# the max_series - 1 largest get their own series, as label values may come from
+	# clients: the rest are summed under OTHER_LABEL.
+	def __init__(self, name: str, help: str, fn = None, label: str | None = None, max_series = MAX_SERIES):
+		super().__init__(name, help)
+		self.value = 0
+		self.fn = fn
+		self.label = label
+		self.max_series = max_series
+	
+	def set(self, value: int | float):
+		self.value = value
+	
+	def inc(self, n: int | float = 1):
+		self.value += n
+	
+	def dec(self, n: int | float = 1):
+		self.value -= n
+	
+	def samples(self):
+		if self.fn is None:
+			yield "", "", self.value
+		elif self.label is None:
+			yield "", "", self.fn()
+		else:
+			values = self.fn()
+			if len(values) > self.max_series:
+				top = dict(heapq.nlargest(self.max_series - 1, values.items(), key=lambda item: item[1]))
+				top[OTHER_LABEL] = top.get(OTHER_LABEL, 0) + sum(values.values()) - sum(top.values())
+				values = top
+			for key, value in values.items():
+				yield "", fmt_labels(**{ self.label: key }), value
+
+class Histogram(Metric):
+	type = "histogram"
+	buckets: tuple
+	counts: list[int] # per bucket, not cumulative, last one is +Inf
+	sum: float
+	count: int
+	
+	def __init__(self, name: str, help: str, buckets = LATENCY_BUCKETS):
+		super().__init__(name, help)
+		self.buckets = tuple(buckets)
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.sum = 0
+		self.count = 0
+	
+	def observe(self, value: float):
+		self.counts[bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+	
+	def samples(self):
+		total = 0
+		for le, n in zip((*self.buckets, "+Inf"), self.counts):
+			total += n
+			yield "_bucket", fmt_labels(le=le), total
+		yield "_sum", "", self.sum
+		yield "_count", "", self.count
+
+
+class Registry:
+	metrics: Dict[str, Metric]
+	
+	def __init__(self):
+		self.metrics = {}
+	
+	def add(self, metric: Metric):
+		if metric.name in self.metrics:
+			existing = self.metrics[metric.name]
+			assert type(existing) == type(metric), f"metric {metric.name} registered twice"
+			return existing
+		self.metrics[metric.name] = metric
+		return metric
+	
+	def render(self) -> str:
+		return "".join(metric.render() + "\n" for metric in self.metrics.values())
+
+registry = Registry()
+
+def counter(name: str, help: str, label: str | None = None) -> Counter:
+	return registry.add(Counter(name, help, label))
+
+def gauge(name: str, help: str, fn = None, label: str | None = None, max_series = MAX_SERIES) -> Gauge:
+	return registry.add(Gauge(name, help, fn, label, max_series))
+
+def histogram(name: str, help: str, buckets = LATENCY_BUCKETS) -> Histogram:
+	return registry.add(Histogram(name, help, buckets))
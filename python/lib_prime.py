@@ -0,0 +1,124 @@
+import math
+
+
+SIEVE_LIMIT = 1 << 20 # numbers below this are looked up in the sieve
+SMALL_PRIME_LIMIT = 1000 # primes below this are tried as factors before anything else
+# (limit, bases): Miller-Rabin to these bases is deterministic for n < limit
+MR_BASES = [
+	(1_373_653, (2, 3)),
+	(25_326_001, (2, 3, 5)),
+	(3_215_031_751, (2, 3, 5, 7)),
+	(2_152_302_898_747, (2, 3, 5, 7, 11)),
+	(3_474_749_660_383, (2, 3, 5, 7, 11, 13)),
+	(341_550_071_728_321, (2, 3, 5, 7, 11, 13, 17)),
+	(3_825_123_056_546_413_051, (2, 3, 5, 7, 11, 13, 17, 19, 23)),
+	(318_665_857_834_031_151_167_461, (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)),
+]
+
+
+def make_sieve(limit: int) -> bytearray:
+	# Odd numbers only: sieve[i] is 1 iff 2i+1 is prime
+	sieve = bytearray([1]) * (limit // 2)
+	sieve[0] = 0
+	for i in range(1, (math.isqrt(limit) - 1) // 2 + 1):
+		if sieve[i]:
+			p = 2 * i + 1
+			start = p * p // 2
+			sieve[start::p] = bytes(len(range(start, len(sieve), p)))
+	return sieve
+
+sieve = make_sieve(SIEVE_LIMIT)
+small_primes = [2] + [2 * i + 1 for i in range(1, SMALL_PRIME_LIMIT // 2) if sieve[i]]
+small_primorial = math.prod(small_primes)
+
+
+def miller_rabin(n: int, bases: tuple) -> bool:
+	# Strong probable prime test of odd n > max(bases) to each of the bases
+	d = n - 1
+	s = (d & -d).bit_length() - 1
+	d >>= s
+	for a in bases:
+		x = pow(a, d, n)
+		if x == 1 or x == n - 1:
+			continue
+		for _ in range(s - 1):
+			x = x * x % n
+			if x == n - 1:
+				break
+		else:
+			return False
+	return True
+
+def jacobi(a: int, n: int) -> int:
+	a %= n
+	result = 1
+	while a != 0:
+		while a & 1 == 0:
+			a >>= 1
+			if n & 7 in (3, 5):
+				result = -result
+		a, n = n, a
+		if a & 3 == 3 and n & 3 == 3:
+			result = -result
+		a %= n
+	return result if n == 1 else 0
+
+def strong_lucas(n: int) -> bool:
+	# Strong Lucas probable prime test of odd n, with Selfridge's parameters
+	if math.isqrt(n) ** 2 == n:
+		return False # no suitable D would ever be found
+	d_ = 5
+	while True:
+		j = jacobi(d_, n)
+		if j == -1:
+			break
+		if j == 0 and abs(d_) != n:
+			return False
+		d_ = -d_ - 2 if d_ > 0 else -d_ + 2
+	p, q = 1, (1 - d_) // 4
+	
+	d = n + 1
+	s = (d & -d).bit_length() - 1
+	d >>= s
+	
+	# U_k, V_k and Q^k for k = the bits of d read so far, starting at k = 1
+	u, v, qk = 1, p, q % n
+	for bit in bin(d)[3:]:
+		u = u * v % n
+		v = (v * v - 2 * qk) % n
+		qk = qk * qk % n
+		if bit == "1":
+			u, v = p * u + v, d_ * u + p * v
+			u = (u + n if u & 1 else u) >> 1 # halve mod n
+			v = (v + n if v & 1 else v) >> 1
+			u %= n
+			v %= n
+			qk = qk * q % n
+	
+	if u == 0 or v == 0:
+		return True
+	for _ in range(s - 1):
+		v = (v * v - 2 * qk) % n
+		if v == 0:
+			return True
+		qk = qk * qk % n
+	return False
+
+def is_prime(n: int | float) -> bool:
+	# Accepts what JSON numbers decode to: non-integer floats, negatives, 0 and 1
+	# are not prime. Exact below 2^64, BPSW above (no known counterexample).
+	if isinstance(n, float):
+		if not n.is_integer():
+			return False
+		n = int(n)
+	if n < SIEVE_LIMIT:
+		if n < 3:
+			return n == 2
+		return n & 1 == 1 and sieve[n >> 1] == 1
+	if math.gcd(n, small_primorial) != 1:
+		return False
+	if n < 1 << 64:
+		for limit, bases in MR_BASES:
+			if n < limit:
+				return miller_rabin(n, bases)
+	return miller_rabin(n, (2,)) and strong_lucas(n)
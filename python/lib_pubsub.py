@@ -0,0 +1,166 @@
+import asyncio
+import os
+import signal
+import socket
+import traceback
+from typing import Callable
+
+from lib_color import *
+import lib_log
+from lib_log import get_logger
+
+
+READ_SIZE = 256 * 1024 # bytes read at once from a broker connection
+BROKER_BACKLOG = 128 # workers connecting before the broker gets to accept them
+
+logger = get_logger("pubsub")
+
+# A local publish/subscribe broker over a Unix domain socket, for servers whose
+# worker processes share state. Messages are lines of text: every line a subscriber
+# publishes is relayed to all subscribers, publisher included, in the order the
+# broker got them, so that all of them see the same sequence of messages. The first
+# line sent by a subscriber is its will, published on its behalf when it disconnects
+# (empty for none), so that the others learn about a worker going away. The first
+# line sent to a subscriber is the number of other subscribers at the time it joined,
+# from which a late one can tell how many it should get its state from.
+
+def split_chunk(pending: bytes, data: bytes) -> tuple[bytes, bytes]:
+	# Complete lines received so far and the incomplete rest
+	data = pending + data
+	i = data.rfind(b"\n") + 1
+	return data[:i], data[i:]
+
+
+class Broker:
+	subscribers: set[asyncio.StreamWriter]
+	messages: int
+	
+	def __init__(self):
+		self.subscribers = set()
+		self.messages = 0
+	
+	async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+		try:
+			will = await reader.readline()
+		except ConnectionError:
+			will = b""
+		writer.write(f"{len(self.subscribers)}\n".encode())
+		self.subscribers.add(writer)
+		pending = b""
+		try:
+			while True:
+				data = await reader.read(READ_SIZE)
+				if len(data) == 0:
+					break
+				lines, pending = split_chunk(pending, data)
+				if len(lines) > 0:
+					self.publish(lines)
+		except ConnectionError:
+			pass
+		finally:
+			self.subscribers.discard(writer)
+			writer.close()
+			if will.strip() != b"":
+				self.publish(will)
+	
+	def publish(self, lines: bytes):
+		# Lines from one read are relayed in one write, the same bytes to everyone
+		self.messages += lines.count(b"\n")
+		for writer in self.subscribers:
+			writer.write(lines)
+	
+	async def serve(self, sock: socket.socket):
+		loop = asyncio.get_running_loop()
+		stop = loop.create_future()
+		loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
+		server = await asyncio.start_unix_server(self.handle, sock=sock)
+		await stop
+		server.close()
+		logger.info(f"{BRIGHT_MAGENTA}Broker stopping{RESET} after relaying {self.messages} messages")
+
+def start_broker(path: str) -> int:
+	# Listens on path, then forks the broker process and returns its pid. Listening
+	# first lets workers connect right away, even before the broker accepts them.
+	if os.path.exists(path):
+		os.unlink(path)
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.bind(path)
+	sock.listen(BROKER_BACKLOG)
+	lib_log.flush()
+	pid = os.fork()
+	if pid == 0:
+		# Ctrl+C stops the workers, the broker only goes away after them
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		code = 0
+		try:
+			asyncio.run(Broker().serve(sock))
+		except BaseException:
+			logger.error(f"{BRIGHT_RED}{traceback.format_exc().rstrip()}")
+			code = 1
+		finally:
+			lib_log.flush()
+			os._exit(code)
+	sock.close()
+	logger.info(f"{BRIGHT_GREEN}Broker listening on {path}")
+	return pid
+
+def stop_broker(pid: int, path: str):
+	try:
+		os.kill(pid, signal.SIGTERM)
+		os.waitpid(pid, 0)
+	except (ProcessLookupError, ChildProcessError):
+		pass # already reaped by the worker supervisor
+	if os.path.exists(path):
+		os.unlink(path)
+
+
+class Subscriber:
+	# A worker's connection to the broker. on_message gets each published line,
+	# without its newline, and on_close is called if the broker goes away.
+	# Lines published during one iteration of the event loop are sent together.
+	on_message: Callable[[str], None]
+	on_close: Callable[[], None]
+	reader: asyncio.StreamReader
+	writer: asyncio.StreamWriter
+	out: list[bytes]
+	flush_handle: asyncio.Handle | None
+	task: asyncio.Task
+	others: int # other subscribers when this one joined
+	
+	def __init__(self, on_message: Callable[[str], None], on_close: Callable[[], None]):
+		self.on_message = on_message
+		self.on_close = on_close
+		self.out = []
+		self.flush_handle = None
+	
+	async def connect(self, path: str, will = ""):
+		self.reader, self.writer = await asyncio.open_unix_connection(path)
+		self.writer.write(will.encode("utf-8") + b"\n")
+		self.others = int(await self.reader.readline())
+		self.task = asyncio.create_task(self.receive())
+	
+	def publish(self, line: str):
+		self.out.append(line.encode("utf-8") + b"\n")
+		if self.flush_handle is None:
+			self.flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+	
+	def flush(self):
+		self.flush_handle = None
+		if not self.writer.is_closing():
+			self.writer.writelines(self.out)
+		self.out.clear()
+	
+	async def receive(self):
+		pending = b""
+		try:
+			while True:
+				data = await self.reader.read(READ_SIZE)
+				if len(data) == 0:
+					break
+				lines, pending = split_chunk(pending, data)
+				for line in lines.decode("utf-8").split("\n")[:-1]:
+					self.on_message(line)
+		except ConnectionError:
+			pass
+		self.writer.close()
+		self.on_close()
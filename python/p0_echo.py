@@ -1,12 +1,17 @@
 from lib_aserve import TcpPeer, serve_tcp
+import os
+
+# Echo from the protocol itself, set ECHO_PASSTHROUGH=0 to go through echo_handler
+PASSTHROUGH = os.environ.get("ECHO_PASSTHROUGH", "1") != "0"
 
 async def echo_handler(peer: TcpPeer):
 	while True:
 		try:
+			await peer.drain()
 			buf = await peer.get_bytes()
 		except EOFError:
 			break
-		peer.log(f"Bounced {len(buf)} bytes")
+		peer.debug("Bounced", len(buf), "bytes")
 		peer.send_bytes(buf)
 
-serve_tcp(echo_handler)
+serve_tcp(echo_handler, passthrough=PASSTHROUGH)
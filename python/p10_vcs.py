@@ -1,4 +1,4 @@
-from lib_aserve import serve_tcp, TcpPeer
+from lib_aserve import Lazy, serve_tcp, TcpPeer
 import string
 
 class MalformedRequest(ValueError): pass
@@ -67,9 +67,10 @@ async def vcs_handler(peer: TcpPeer):
 					dir_name = parts[0]
 					if dir_name not in list:
 						list[dir_name + "/"] = "DIR"
-			send_line(f"OK {len(list)}")
-			for name, value in sorted(list.items(), key=lambda p: p[0]):
-				send_line(f"{name} {value}")
+			with peer.cork():
+				send_line(f"OK {len(list)}")
+				for name, value in sorted(list.items(), key=lambda p: p[0]):
+					send_line(f"{name} {value}")
 		
 		elif cmd == "put":
 			if len(args) != 3:
@@ -81,13 +82,13 @@ async def vcs_handler(peer: TcpPeer):
 				continue
 			dir_path, filename = path
 			try:
-				length = int(args[2])
+				length = max(0, int(args[2]))
 			except ValueError:
 				length = 0
 			data = await peer.get_n_bytes(length)
-			peer.debug("<-", repr(data))
+			peer.debug("<-", Lazy(lambda: repr(bytes(data))))
 			try:
-				data = data.decode("ascii")
+				data = str(data, "ascii")
 			except UnicodeDecodeError:
 				send_line("ERR file is invalid ascii")
 				continue
@@ -141,4 +142,4 @@ async def vcs_handler(peer: TcpPeer):
 			send_line(f"ERR illegal method: {cmd}")
 			return
 
-serve_tcp(vcs_handler)
+serve_tcp(vcs_handler, coalesce=True, single_worker=True)
@@ -1,13 +1,14 @@
 import asyncio
+import os
 from socket import AF_INET
 import struct
 from typing import Callable, Coroutine, Literal
 from collections import defaultdict
 
-from lib_aserve import serve_tcp, TcpPeer, TcpServer, get_addr_str
+from lib_aserve import Lazy, serve_tcp, TcpPeer, TcpServer, get_addr_str
 
-AS_HOST = "pestcontrol.protohackers.com"
-AS_PORT = 20547
+AS_HOST = os.environ.get("PEST_AS_HOST", "pestcontrol.protohackers.com")
+AS_PORT = int(os.environ.get("PEST_AS_PORT", 20547))
 
 
 ## Protocol logic
@@ -46,7 +47,7 @@ class OutMsg:
 			self.wrapped = True
 		
 		b = bytes(self.buf)
-		peer.debug(f"-> {hex_repr(b)}")
+		peer.debug("->", Lazy(hex_repr, b))
 		peer.send_bytes(b)
 
 hello_msg = OutMsg(0x50) # Hello
@@ -59,7 +60,7 @@ class InMsg:
 		self.buf = msg_buf
 		self.i = 0
 	
-	def get_bytes(self, n: int) -> bytes:
+	def get_bytes(self, n: int) -> memoryview:
 		if self.i > len(self.buf) - n:
 			raise ProtoError("content exceeds declared length")
 		b = self.buf[self.i : self.i + n]
@@ -72,7 +73,7 @@ class InMsg:
 	def get_str(self) -> str:
 		size = self.get_u32()
 		b = self.get_bytes(size)
-		return b.decode("ascii")
+		return str(b, "ascii")
 	
 	def check_end(self):
 		if self.i != len(self.buf):
@@ -83,6 +84,8 @@ class InMsg:
 		(msg_ty, msg_len) = await peer.get_struct(">BI")
 		if msg_len >= MAX_LENGTH:
 			raise ProtoError("message is too long")
+		if msg_len < WRAPPER_SIZE:
+			raise ProtoError("message is too short")
 		msg_buf = await peer.get_n_bytes(msg_len - WRAPPER_SIZE)
 		checksum = await peer.get_struct("B")
 		if (msg_ty + sum(struct.pack(">I", msg_len)) + sum(msg_buf) + checksum) % 256 != 0:
@@ -100,7 +103,7 @@ async def prot_handler(peer: TcpPeer, on_msg: Callable[[TcpPeer, InMsg], Corouti
 				got_hello = True
 				protocol, version = msg.get_str(), msg.get_u32()
 				msg.check_end()
-				peer.debug(f"<- Hello {{ protocol: {repr(protocol)}, version: {version} }}")
+				peer.debug(Lazy("<- Hello {{ protocol: {!r}, version: {} }}".format, protocol, version))
 				if protocol != "pestcontrol" or version != 1:
 					raise ProtoError("unexpected protocol or version")
 			else:
@@ -109,7 +112,7 @@ async def prot_handler(peer: TcpPeer, on_msg: Callable[[TcpPeer, InMsg], Corouti
 				if msg.ty == 0x51: # Error
 					err_msg = msg.get_str()
 					msg.check_end()
-					peer.debug(f"<- Error {{ message: {repr(err_msg)} }}")
+					peer.debug(Lazy("<- Error {{ message: {!r} }}".format, err_msg))
 				elif msg.ty == 0x52: # OK
 					msg.check_end()
 				else:
@@ -177,7 +180,7 @@ async def as_handler(peer: TcpPeer, msg: InMsg, site: int):
 				raise ProtoError(f"conflicting target for species '{species}'")
 			targets[species] = (min_pop, max_pop)
 		msg.check_end()
-		peer.debug(f"<- TargetPopulations {{ site: {site2}, populations: {repr(targets)} }}")
+		peer.debug(Lazy("<- TargetPopulations {{ site: {}, populations: {!r} }}".format, site2, targets))
 		assert site == site2
 		
 		target_pops[site2] = targets
@@ -229,7 +232,7 @@ async def client_handler(peer: TcpPeer, msg: InMsg):
 				raise ProtoError(f"conflicting counts for species '{species}'")
 			populations[species] = count
 		msg.check_end()
-		peer.debug(f"<- SiteVisit {{ site: {site}, populations: {repr(populations)} }}")
+		peer.debug(Lazy("<- SiteVisit {{ site: {}, populations: {!r} }}".format, site, populations))
 		
 		as_conn, targets = await get_site_data(peer.server, site)
 		
@@ -263,4 +266,4 @@ async def client_handler(peer: TcpPeer, msg: InMsg):
 	else:
 		raise ProtoError(f"unexpected message type {msg.ty:02x}")
 
-serve_tcp(lambda peer: prot_handler(peer, client_handler))
+serve_tcp(lambda peer: prot_handler(peer, client_handler), single_worker=True)
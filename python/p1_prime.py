@@ -1,52 +1,282 @@
-from lib_aserve import serve_tcp, TcpPeer
+from lib_aserve import Lazy, log, serve_tcp, TcpPeer, TcpServer
+from lib_prime import SIEVE_LIMIT, is_prime
+import lib_metrics
+import asyncio
+from collections import deque, OrderedDict
 import json
+import multiprocessing
+from multiprocessing.connection import Connection
+import os
+import signal
+import sys
 
-def is_prime(n):
-	if isinstance(n, float) and not n.is_integer():
-		return False
-	if n <= 1: return False
-	if n == 2: return True
-	if n % 2 == 0: return False
+OFFLOAD_BITS = int(os.environ.get("PRIME_OFFLOAD_BITS", 256)) # larger numbers are tested in the pool
+TIME_BUDGET = float(os.environ.get("PRIME_TIME_BUDGET", 10)) # seconds per offloaded request, from when it starts running
+POOL_SIZE = int(os.environ.get("PRIME_POOL_SIZE", os.cpu_count() or 1))
+MAX_OFFLOADS = int(os.environ.get("PRIME_MAX_OFFLOADS", 4)) # offloaded requests in flight per peer before it is not read from
+CACHE_BYTES = int(os.environ.get("PRIME_CACHE_BYTES", 16 * 1024 * 1024)) # memory budget of the result cache
+CACHE_ENTRY_OVERHEAD = 100 # bytes per cached number on top of the int itself (dict slot, list node)
+
+class MalformedRequest(ValueError): pass
+
+
+class ResultCache:
+	# Least recently used isPrime answers, shared by all peers. Bounded by an estimate
+	# of the memory it takes rather than by entry count: keys go up to thousands of digits.
+	budget: int
+	size: int
+	entries: OrderedDict # number → prime
+	hits: int
+	misses: int
+	evictions: int
+	
+	def __init__(self, budget: int):
+		self.budget = budget
+		self.size = 0
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
 	
-	i = 3
-	while i*i <= n:
-		if n % i == 0:
-			return False
-		i += 2
+	@staticmethod
+	def cost(n: int) -> int:
+		return sys.getsizeof(n) + CACHE_ENTRY_OVERHEAD
 	
-	return True
+	def get(self, n: int) -> bool | None:
+		prime = self.entries.get(n)
+		if prime is None:
+			self.misses += 1
+			cache_misses.inc()
+			return None
+		self.entries.move_to_end(n)
+		self.hits += 1
+		cache_hits.inc()
+		return prime
+	
+	def put(self, n: int, prime: bool):
+		cost = self.cost(n)
+		if n in self.entries or cost > self.budget:
+			return
+		self.entries[n] = prime
+		self.size += cost
+		while self.size > self.budget:
+			old, _ = self.entries.popitem(last=False)
+			self.size -= self.cost(old)
+			self.evictions += 1
+			cache_evictions.inc()
+	
+	def stats(self) -> str:
+		return (f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions,"
+			+ f" {len(self.entries)} numbers in {self.size / 1024:.1f} of {self.budget / 1024:.0f} KiB")
 
-class MalformedRequest(ValueError): pass
+cache_hits = lib_metrics.counter("prime_cache_hits_total", "isPrime answers found in the cache")
+cache_misses = lib_metrics.counter("prime_cache_misses_total", "isPrime answers not in the cache")
+cache_evictions = lib_metrics.counter("prime_cache_evictions_total", "Numbers evicted from the cache")
+cache = ResultCache(CACHE_BYTES)
+lib_metrics.gauge("prime_cache_bytes", "Estimated memory taken by the cache", lambda: cache.size)
 
-async def prime_handler(peer: TcpPeer):
+def cache_key(n: int | float) -> int | None:
+	# The number as an int if it is worth caching: the sieve beats the cache below its limit
+	if isinstance(n, float):
+		if not n.is_integer():
+			return None
+		n = int(n)
+	return n if n >= SIEVE_LIMIT else None
+
+
+def init_pool_process():
+	# The pool forks from a process running the event loop: leave signals to the server
+	signal.set_wakeup_fd(-1)
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+def pool_process_main(conn: Connection):
+	init_pool_process()
 	while True:
 		try:
-			line = await peer.get_line()
+			n = conn.recv()
 		except EOFError:
-			break
-		
+			return
+		conn.send(is_prime(n))
+
+class PoolProcess:
+	# Forked, since spawned processes would re-run this script, server included
+	process: multiprocessing.Process
+	conn: Connection
+	
+	def __init__(self):
+		self.conn, child_conn = multiprocessing.Pipe()
+		self.process = multiprocessing.get_context("fork").Process(target=pool_process_main, args=(child_conn,), daemon=True)
+		self.process.start()
+		child_conn.close()
+	
+	async def run(self, n: int | float) -> bool:
+		loop = asyncio.get_running_loop()
+		readable = loop.create_future()
+		self.conn.send(n)
+		loop.add_reader(self.conn.fileno(), lambda: readable.done() or readable.set_result(None))
 		try:
+			await readable
+		finally:
+			loop.remove_reader(self.conn.fileno())
+		return self.conn.recv()
+	
+	def kill(self):
+		self.process.kill()
+		self.conn.close()
+
+class PrimePool:
+	# Processes testing large numbers, one at a time each. The time budget of a request
+	# only starts once a process picks it up, so waiting behind another client's huge
+	# numbers does not count against it. A process still busy when the budget runs out
+	# is killed and replaced, as a single pow() on a huge number cannot be interrupted.
+	slots: asyncio.Semaphore # for requests running in a process, the others wait in line
+	idle: list[PoolProcess]
+	
+	def __init__(self, size: int):
+		self.slots = asyncio.Semaphore(size)
+		self.idle = []
+	
+	async def is_prime(self, n: int | float) -> bool | None:
+		# None if over the time budget
+		async with self.slots:
+			process = self.idle.pop() if len(self.idle) > 0 else PoolProcess() # forked on first use
 			try:
-				req = json.loads(line)
-			except json.JSONDecodeError:
-				raise MalformedRequest("invalid JSON")
-			for field in ["method", "number"]:
-				if field not in req:
-					raise MalformedRequest(f"missing required field '{field}'")
-			if req["method"] != "isPrime":
-				raise MalformedRequest("invalid method, expected 'isPrime'")
-			n = req["number"]
-			if isinstance(n, bool) or (not isinstance(n, int) and not isinstance(n, float)):
-				raise MalformedRequest("invalid number, expected integer or float")
+				prime = await asyncio.wait_for(process.run(n), TIME_BUDGET)
+			except asyncio.TimeoutError:
+				process.kill()
+				return None
+			except BaseException: # cancelled as the peer is gone, don't keep working for nobody
+				process.kill()
+				raise
+			self.idle.append(process)
+			return prime
+
+pool: PrimePool | None = None
+
+def get_pool() -> PrimePool:
+	# Created on first use, so that each worker process gets its own
+	global pool
+	if pool is None:
+		pool = PrimePool(POOL_SIZE)
+	return pool
+
+def shutdown_pool():
+	# Don't wait for a pool process still busy with a huge number before exiting
+	for process in multiprocessing.active_children():
+		process.kill()
+
+def bit_length(n: int | float) -> int:
+	if isinstance(n, float):
+		return int(n).bit_length() if n.is_integer() else 0
+	return n.bit_length()
+
+async def is_prime_offloaded(peer: TcpPeer, n: int | float, key: int | None, offloads: asyncio.Semaphore) -> str:
+	try:
+		prime = await get_pool().is_prime(n)
+	finally:
+		offloads.release()
+	if prime is None:
+		peer.warn(f"isPrime of a {bit_length(n)}-bit number took over {TIME_BUDGET}s")
+		return json.dumps({ "error": f"time budget of {TIME_BUDGET}s exceeded" })
+	if key is not None:
+		cache.put(key, prime)
+	peer.debug(Lazy("isPrime({}) == {} (offloaded)".format, n, prime))
+	return json.dumps({ "method": "isPrime", "prime": prime })
+
+
+class Responses:
+	# Sends the responses to pipelined requests in request order, even when offloaded
+	# ones finish out of order. Lines go out right away while nothing is pending.
+	peer: TcpPeer
+	pending: deque # response lines, or tasks resolving to them
+	sender: asyncio.Task | None
+	
+	def __init__(self, peer: TcpPeer):
+		self.peer = peer
+		self.pending = deque()
+		self.sender = None
+	
+	def add(self, res: str | asyncio.Task):
+		if len(self.pending) == 0 and isinstance(res, str):
+			self.peer.send_line(res)
+			return
+		self.pending.append(res)
+		if self.sender is None:
+			self.sender = asyncio.create_task(self.send_pending())
+	
+	async def send_pending(self):
+		while len(self.pending) > 0:
+			res = self.pending[0]
+			if not isinstance(res, str):
+				res = await res
+			self.pending.popleft()
+			self.peer.send_line(res)
+		self.sender = None
+	
+	async def flush(self):
+		if self.sender is not None:
+			await self.sender
+	
+	def cancel(self):
+		for res in self.pending:
+			if not isinstance(res, str):
+				res.cancel()
+		if self.sender is not None:
+			self.sender.cancel()
+
+
+async def prime_handler(peer: TcpPeer):
+	responses = Responses(peer)
+	offloads = asyncio.Semaphore(MAX_OFFLOADS) # released by is_prime_offloaded
+	hits, misses, evictions = cache.hits, cache.misses, cache.evictions
+	try:
+		async for line in peer.lines():
+			try:
+				try:
+					req = json.loads(line)
+				except ValueError: # also raised for integers over Python's digit limit
+					raise MalformedRequest("invalid JSON")
+				for field in ["method", "number"]:
+					if field not in req:
+						raise MalformedRequest(f"missing required field '{field}'")
+				if req["method"] != "isPrime":
+					raise MalformedRequest("invalid method, expected 'isPrime'")
+				n = req["number"]
+				if isinstance(n, bool) or (not isinstance(n, int) and not isinstance(n, float)):
+					raise MalformedRequest("invalid number, expected integer or float")
 			
-		except MalformedRequest as err:
-			peer.warn(f"Got malformed request ({err}):")
-			peer.warn("  " + repr(line))
-			res = { "error": str(err) }
-			peer.send_line(json.dumps(res))
-		else:
-			res = { "method": "isPrime", "prime": is_prime(n) }
-			peer.log(f"isPrime({n}) == {res['prime']}")
-			peer.send_line(json.dumps(res))
-
-serve_tcp(prime_handler)
+			except MalformedRequest as err:
+				peer.warn(f"Got malformed request ({err}):")
+				peer.warn("  " + repr(line))
+				res = { "error": str(err) }
+				responses.add(json.dumps(res))
+			else:
+				key = cache_key(n)
+				prime = cache.get(key) if key is not None else None
+				if prime is not None:
+					peer.debug(Lazy("isPrime({}) == {} (cached)".format, n, prime))
+					responses.add(json.dumps({ "method": "isPrime", "prime": prime }))
+				elif bit_length(n) > OFFLOAD_BITS:
+					await offloads.acquire() # stops reading further requests meanwhile
+					responses.add(asyncio.create_task(is_prime_offloaded(peer, n, key, offloads)))
+				else:
+					prime = is_prime(n)
+					if key is not None:
+						cache.put(key, prime)
+					peer.debug(Lazy("isPrime({}) == {}".format, n, prime))
+					responses.add(json.dumps({ "method": "isPrime", "prime": prime }))
+		
+		await responses.flush()
+	finally:
+		responses.cancel()
+		hits, misses, evictions = cache.hits - hits, cache.misses - misses, cache.evictions - evictions
+		if hits + misses > 0:
+			peer.log(f"Cache: {hits} hits, {misses} misses, {evictions} evictions (overall: {cache.stats()})")
+
+async def on_stop(_server: TcpServer):
+	# In each worker, which exits right after
+	shutdown_pool()
+	log("Cache:", cache.stats())
+
+serve_tcp(prime_handler, coalesce=True, on_stop=on_stop)
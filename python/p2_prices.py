@@ -1,29 +1,228 @@
-from typing import Tuple
 from lib_aserve import TcpPeer, serve_tcp
-from bisect import insort, bisect_left, bisect_right
+from array import array
+from bisect import bisect_left, bisect_right
+import heapq
+from itertools import groupby
+from operator import itemgetter
+import sys
+
+BLOCK_SIZE = 512 # prices per block, full blocks get split in two
+INT_SIZE = 32 # bytes per Python int in the block indexes (block sums can exceed 2^31)
+
+
+class Fenwick:
+	# Prefix sums over a list of values, with O(log n) updates
+	tree: list[int]
+	
+	def __init__(self, values: list[int]):
+		self.tree = [0] + values
+		for i in range(1, len(self.tree)):
+			j = i + (i & -i)
+			if j < len(self.tree):
+				self.tree[j] += self.tree[i]
+	
+	def add(self, i: int, delta: int):
+		i += 1
+		while i < len(self.tree):
+			self.tree[i] += delta
+			i += i & -i
+	
+	def append(self, value: int):
+		# Adds a value at the end, in O(log n): its node also sums the values it covers before it
+		i = len(self.tree)
+		self.tree.append(value + self.prefix(i - 1) - self.prefix(i - (i & -i)))
+	
+	def prefix(self, i: int) -> int:
+		# Sum of the first i values
+		total = 0
+		while i > 0:
+			total += self.tree[i]
+			i -= i & -i
+		return total
+	
+	def range(self, i: int, j: int) -> int:
+		# Sum of values i to j excluded
+		return self.prefix(j) - self.prefix(i) if i < j else 0
+
+
+class PriceStore:
+	# Prices sorted by timestamp in blocks of at most BLOCK_SIZE, with Fenwick trees
+	# over the blocks' sums and sizes. Range queries bisect down to the blocks at both
+	# ends of the range and sum them as a whole, the blocks in between come from the
+	# Fenwick trees: O(log n) on top of the bounded cost of summing a block.
+	#
+	# Timestamps and prices are kept in separate arrays of 32-bit ints, 8 bytes per
+	# price. Inserts are appended to an unsorted tail, which only gets sorted into the
+	# blocks by the next query: inserts arriving in timestamp order are just appended
+	# to the last blocks, others are inserted in place, or merged all at once if many.
+	times: list[array]
+	prices: list[array]
+	firsts: list[int] # first timestamp of each block
+	block_sums: list[int]
+	sums: Fenwick
+	counts: Fenwick
+	tail_times: array
+	tail_prices: array
+	tail_sorted: bool
+	size: int # prices in the blocks, not counting the tail
+	
+	def __init__(self):
+		self.times = []
+		self.prices = []
+		self.firsts = []
+		self.block_sums = []
+		self.tail_times = array("i")
+		self.tail_prices = array("i")
+		self.tail_sorted = True
+		self.size = 0
+		self.reindex()
+	
+	def __len__(self):
+		return self.size + len(self.tail_times)
+	
+	def reindex(self):
+		self.sums = Fenwick(self.block_sums.copy())
+		self.counts = Fenwick([len(times) for times in self.times])
+	
+	def insert(self, timestamp: int, price: int):
+		if len(self.tail_times) > 0 and timestamp < self.tail_times[-1]:
+			self.tail_sorted = False
+		self.tail_times.append(timestamp)
+		self.tail_prices.append(price)
+	
+	def insert_many(self, times: tuple[int, ...], prices: tuple[int, ...]):
+		if self.tail_sorted:
+			after_tail = len(self.tail_times) == 0 or times[0] >= self.tail_times[-1]
+			self.tail_sorted = after_tail and list(times) == sorted(times)
+		self.tail_times.extend(times)
+		self.tail_prices.extend(prices)
+	
+	def sort_tail(self):
+		tail_times, tail_prices = self.tail_times, self.tail_prices
+		if len(tail_times) == 0:
+			return
+		self.tail_times, self.tail_prices = array("i"), array("i")
+		if not self.tail_sorted:
+			order = sorted(range(len(tail_times)), key=tail_times.__getitem__)
+			tail_times = array("i", [tail_times[i] for i in order])
+			tail_prices = array("i", [tail_prices[i] for i in order])
+			self.tail_sorted = True
+		
+		if self.size == 0 or tail_times[0] >= self.times[-1][-1]:
+			self.extend(tail_times, tail_prices)
+		elif len(tail_times) * 8 > self.size:
+			self.merge(tail_times, tail_prices)
+		else:
+			for timestamp, price in zip(tail_times, tail_prices):
+				self.insert_sorted(timestamp, price)
+	
+	def extend(self, times: array, prices: array):
+		# Appends prices that all come at or after the last one
+		i = 0
+		if self.size > 0 and len(self.times[-1]) < BLOCK_SIZE:
+			i = BLOCK_SIZE - len(self.times[-1])
+			added = sum(prices[:i])
+			self.times[-1].extend(times[:i])
+			self.prices[-1].extend(prices[:i])
+			self.block_sums[-1] += added
+			self.sums.add(len(self.times) - 1, added)
+			self.counts.add(len(self.times) - 1, len(times[:i]))
+		for j in range(i, len(times), BLOCK_SIZE):
+			self.times.append(times[j : j + BLOCK_SIZE])
+			self.prices.append(prices[j : j + BLOCK_SIZE])
+			self.firsts.append(times[j])
+			self.block_sums.append(sum(self.prices[-1]))
+			self.sums.append(self.block_sums[-1])
+			self.counts.append(len(self.times[-1]))
+		self.size += len(times)
+	
+	def merge(self, times: array, prices: array):
+		# Rebuilds the blocks from the current prices and sorted new ones, in O(n)
+		old = ((t, p) for block_times, block_prices in zip(self.times, self.prices)
+			for t, p in zip(block_times, block_prices))
+		merged = list(heapq.merge(old, zip(times, prices), key=lambda x: x[0]))
+		self.times, self.prices, self.firsts, self.block_sums = [], [], [], []
+		self.size = 0
+		self.reindex()
+		self.extend(array("i", [t for t, _ in merged]), array("i", [p for _, p in merged]))
+	
+	def insert_sorted(self, timestamp: int, price: int):
+		b = max(0, bisect_right(self.firsts, timestamp) - 1)
+		times, prices = self.times[b], self.prices[b]
+		i = bisect_right(times, timestamp)
+		times.insert(i, timestamp)
+		prices.insert(i, price)
+		self.firsts[b] = times[0]
+		self.block_sums[b] += price
+		self.size += 1
+		if len(times) <= BLOCK_SIZE:
+			self.sums.add(b, price)
+			self.counts.add(b, 1)
+			return
+		
+		half = len(times) // 2
+		self.times.insert(b + 1, times[half:])
+		self.prices.insert(b + 1, prices[half:])
+		del times[half:]
+		del prices[half:]
+		self.firsts.insert(b + 1, self.times[b + 1][0])
+		moved = sum(self.prices[b + 1])
+		self.block_sums[b] -= moved
+		self.block_sums.insert(b + 1, moved)
+		self.reindex()
+	
+	def mean(self, min_time: int, max_time: int) -> int:
+		# Truncated mean of the prices between both timestamps included, 0 if none
+		self.sort_tail()
+		if min_time > max_time or self.size == 0:
+			return 0
+		# Equal timestamps may straddle blocks, so start from the block before the
+		# first one starting at min_time or later
+		b1 = max(0, bisect_left(self.firsts, min_time) - 1)
+		b2 = bisect_right(self.firsts, max_time) - 1
+		if b2 < 0:
+			return 0
+		i1 = bisect_left(self.times[b1], min_time)
+		i2 = bisect_right(self.times[b2], max_time)
+		if b1 == b2:
+			total = sum(self.prices[b1][i1:i2])
+			count = max(0, i2 - i1)
+		else:
+			total = sum(self.prices[b1][i1:]) + self.sums.range(b1 + 1, b2) + sum(self.prices[b2][:i2])
+			count = len(self.times[b1]) - i1 + self.counts.range(b1 + 1, b2) + i2
+		return int(total / count) if count > 0 else 0
+	
+	def memory(self) -> int:
+		# Estimated bytes taken by the store
+		arrays = [*self.times, *self.prices, self.tail_times, self.tail_prices]
+		lists = [self.times, self.prices, self.firsts, self.block_sums, self.sums.tree, self.counts.tree]
+		return (sum(sys.getsizeof(a) for a in arrays) + sum(sys.getsizeof(l) for l in lists)
+			+ INT_SIZE * (4 * len(self.times) + 2))
+
 
 async def price_handler(peer: TcpPeer):
-	prices: list[Tuple[int, int]] = []
+	prices = PriceStore()
 	
 	while True:
 		try:
-			ty, arg1, arg2 = await peer.get_struct("!cii")
+			await peer.drain()
+			records = await peer.get_structs("!cii")
 		except EOFError:
 			break
 		
-		if ty == b"I":
-			timestamp, price = arg1, arg2
-			peer.log(f"Inserting price {price} at timestamp {timestamp}")
-			insort(prices, (timestamp, price), key=lambda x: x[0])
-		elif ty == b"Q":
-			min_time, max_time = arg1, arg2
-			peer.log(f"Querying mean between {min_time} and {max_time}")
-			i1 = bisect_left(prices, min_time, key=lambda x: x[0])
-			i2 = bisect_right(prices, max_time, key=lambda x: x[0])
-			selected = [p for (t,p) in prices[i1:i2]]
-			mean = int(sum(selected) / len(selected)) if len(selected) > 0 else 0
-			peer.send_struct("!i", mean)
-		else:
-			peer.warn("Invalid message type:", repr(ty))
+		# Consecutive inserts are stored in one go, queries are answered in order
+		for ty, group in groupby(records, key=itemgetter(0)):
+			if ty == b"I":
+				_, times, new_prices = zip(*group)
+				peer.debug("Inserting", len(times), "prices")
+				prices.insert_many(times, new_prices)
+			elif ty == b"Q":
+				for _, min_time, max_time in group:
+					peer.debug("Querying mean between", min_time, "and", max_time)
+					peer.send_struct("!i", prices.mean(min_time, max_time))
+			else:
+				peer.warn("Invalid message type:", repr(ty))
+	
+	peer.end(f"Session ended with {len(prices)} prices in {prices.memory() / 1024:.1f} KiB")
 
-serve_tcp(price_handler)
+serve_tcp(price_handler, coalesce=True)
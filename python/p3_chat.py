@@ -1,13 +1,149 @@
-from lib_aserve import TcpPeer, log, serve_tcp, shorten
+from lib_aserve import BROADCAST_MAX_BUFFER, Broadcast, TcpPeer, TcpServer, log, serve_tcp, shorten, worker_count
 from lib_color import *
+from lib_pubsub import Subscriber, start_broker, stop_broker
+import asyncio
+import os
+import tempfile
 
-users: dict[TcpPeer, str] = {}
+MAX_BUFFER = int(os.environ.get("CHAT_MAX_BUFFER", BROADCAST_MAX_BUFFER)) # bytes queued per user
+SLOW_POLICY = os.environ.get("CHAT_SLOW_POLICY", "disconnect") # or "drop", for users over MAX_BUFFER
+WORKERS = worker_count() # with several, the room is shared through a broker process
+BROKER_PATH = os.environ.get("CHAT_BROKER_PATH",
+	os.path.join(tempfile.gettempdir(), f"p3_chat_{os.getpid()}.sock"))
+
+users: dict[TcpPeer, str] = {} # users connected to this process
+fanout = Broadcast(MAX_BUFFER, SLOW_POLICY)
 
 def broadcast(msg, except_peer=None):
 	log(f"{CYAN}Broadcasting:{RESET}", shorten(msg))
-	for peer in users.keys():
-		if peer is not except_peer:
-			peer.send_line(msg)
+	fanout.send_line(users.keys(), msg, except_peer)
+
+
+class LocalRoom:
+	# All users in this process
+	async def join(self, peer: TcpPeer, name: str):
+		peer.send_line("* The room contains: " + ", ".join(name for name in users.values()))
+		broadcast(f"* {name} has entered the room")
+		users[peer] = name
+	
+	def say(self, peer: TcpPeer, line: str):
+		broadcast(f"[{users[peer]}] {line}", except_peer=peer)
+	
+	def leave(self, peer: TcpPeer):
+		name = users.pop(peer)
+		broadcast(f"* {name} has left the room")
+
+
+class SharedRoom:
+	# Users spread over the worker processes. Joins, messages and leaves are published
+	# to the broker and only acted upon when it relays them back: every worker applies
+	# the same events in the same order, to its copy of the member list and to its own
+	# users, so that all of them agree on who is in the room at any point.
+	#
+	# Events are lines: "J <member> <name>", "M <member> <text>", "L <member>", and
+	# "W <pid>" for the members of a worker that went away. Members are "<pid>.<peer id>".
+	#
+	# A worker started after the others (restarted after a crash) first asks them for
+	# their members with "S <pid>". Each answers with "P <member> <name>" for each of
+	# its users, then "D <pid> <own pid>", and the new worker only starts listening
+	# once all of them did. Members being removed are left out, since their leave
+	# event may reach the broker before the answer does.
+	members: dict[str, str] # member → name, users of all workers in order of arrival
+	local: dict[str, TcpPeer] # member → peer, users of this worker
+	joining: dict[str, asyncio.Future]
+	leaving: set[str] # local members whose leave event was not relayed back yet
+	synced: set[str] # pids of the workers that sent their members
+	sync_done: asyncio.Future
+	subscriber: Subscriber
+	server: TcpServer
+	
+	def __init__(self):
+		self.members = {}
+		self.local = {}
+		self.joining = {}
+		self.leaving = set()
+		self.synced = set()
+		self.subscriber = Subscriber(self.on_event, self.on_broker_lost)
+	
+	async def connect(self, server: TcpServer):
+		self.server = server
+		self.sync_done = asyncio.get_running_loop().create_future()
+		await self.subscriber.connect(BROKER_PATH, will=f"W {os.getpid()}")
+		if self.subscriber.others > 0:
+			self.subscriber.publish(f"S {os.getpid()}")
+			await self.sync_done
+			log(f"Got {len(self.members)} members from {len(self.synced)} workers")
+	
+	def on_broker_lost(self):
+		log(f"{BRIGHT_RED}Lost the connection to the broker")
+		self.server.stop()
+	
+	@staticmethod
+	def member(peer: TcpPeer) -> str:
+		return f"{os.getpid()}.{peer.id}"
+	
+	async def join(self, peer: TcpPeer, name: str):
+		member = self.member(peer)
+		self.local[member] = peer
+		self.joining[member] = asyncio.get_running_loop().create_future()
+		self.subscriber.publish(f"J {member} {name}")
+		await self.joining[member]
+	
+	def say(self, peer: TcpPeer, line: str):
+		self.subscriber.publish(f"M {self.member(peer)} {line}")
+	
+	def leave(self, peer: TcpPeer):
+		self.leaving.add(self.member(peer))
+		self.subscriber.publish(f"L {self.member(peer)}")
+	
+	def on_event(self, event: str):
+		kind, member, arg = (event.split(" ", 2) + [""])[:3]
+		if kind == "J":
+			peer = self.local.get(member)
+			if peer is not None:
+				peer.send_line("* The room contains: " + ", ".join(self.members.values()))
+			broadcast(f"* {arg} has entered the room")
+			self.members[member] = arg
+			if peer is not None:
+				users[peer] = arg
+				self.joining.pop(member).set_result(None)
+		elif kind == "M":
+			if member in self.members:
+				broadcast(f"[{self.members[member]}] {arg}", except_peer=self.local.get(member))
+		elif kind == "L":
+			self.remove(member)
+		elif kind == "W":
+			for gone in [m for m in self.members if m.startswith(member + ".")]:
+				self.remove(gone)
+			self.on_synced(member)
+		elif kind == "S" and member != str(os.getpid()):
+			for local in self.local:
+				if local in self.members and local not in self.leaving:
+					self.subscriber.publish(f"P {local} {self.members[local]}")
+			self.subscriber.publish(f"D {member} {os.getpid()}")
+		elif kind == "P":
+			self.members.setdefault(member, arg)
+		elif kind == "D" and member == str(os.getpid()):
+			self.on_synced(arg)
+	
+	def on_synced(self, pid: str):
+		# A worker that dies before answering will never do so: its will counts instead
+		self.synced.add(pid)
+		if len(self.synced) >= self.subscriber.others and not self.sync_done.done():
+			self.sync_done.set_result(None)
+	
+	def remove(self, member: str):
+		name = self.members.pop(member, None)
+		if name is None:
+			return
+		peer = self.local.pop(member, None)
+		if peer is not None:
+			del users[peer]
+			self.leaving.discard(member)
+		broadcast(f"* {name} has left the room")
+
+
+room = SharedRoom() if WORKERS > 1 else LocalRoom()
 
 async def chat_handler(peer: TcpPeer):
 	peer.send_line("Welcome to budgetchat! What shall I call you?")
@@ -18,19 +154,22 @@ async def chat_handler(peer: TcpPeer):
 		peer.end("Sent invalid username:", repr(name))
 		return
 	
-	peer.send_line("* The room contains: " + ", ".join(name for name in users.values()))
-	broadcast(f"* {name} has entered the room")
-	
-	users[peer] = name
+	await room.join(peer, name)
 	
 	while True:
 		try:
 			line = await peer.get_line()
 		except EOFError:
 			break
-		broadcast(f"[{name}] {line}", except_peer=peer)
+		room.say(peer, line)
 	
-	del users[peer]
-	broadcast(f"* {name} has left the room")
+	room.leave(peer)
 
-serve_tcp(chat_handler)
+if isinstance(room, SharedRoom):
+	broker = start_broker(BROKER_PATH)
+	try:
+		serve_tcp(chat_handler, coalesce=True, workers=WORKERS, on_start=room.connect)
+	finally:
+		stop_broker(broker, BROKER_PATH)
+else:
+	serve_tcp(chat_handler, coalesce=True, single_worker=True)
@@ -1,28 +1,49 @@
-from lib_aserve import UdpPeer, serve_udp, shorten
+from lib_aserve import Addr, app_logger, get_addr_str, log, serve_udp, shorten
 from lib_color import *
+from lib_kvlog import FLUSH_INTERVAL, SNAPSHOT_LOG_BYTES, KvLog
+from lib_kvstore import KvStore
+from lib_log import INFO
+import lib_metrics
+import os
+from typing import Callable, MutableMapping
 
-values: dict[bytes, bytes] = {}
+VERSION = b"pyxyne's db"
+DB_DIR = os.environ.get("DB_DIR") # persist the values in this directory, in memory only if unset
+DB_FLUSH_INTERVAL = float(os.environ.get("DB_FLUSH_INTERVAL", FLUSH_INTERVAL)) # seconds between log writes
+DB_SNAPSHOT_BYTES = int(os.environ.get("DB_SNAPSHOT_BYTES", SNAPSHOT_LOG_BYTES)) # log size triggering a snapshot
+DB_MAX_BYTES = int(os.environ.get("DB_MAX_BYTES", 256 * 1024 * 1024)) # memory for the values, evicting past it, 0 for no limit
 
-async def db_handler(peer: UdpPeer):
-	while True:
-		try:
-			msg = await peer.get_dgram()
-		except EOFError:
-			break
-		if b"=" in msg: # insert
-			[key, val] = msg.split(b"=", maxsplit=1)
-			if key == "version":
-				peer.log(f"{YELLOW}Ignored insert into 'version'")
-			else:
-				peer.log(f"Inserted {repr(key)}: {shorten(repr(val))}")
-				values[key] = val
-		else: # retrieve
-			key = msg
-			if key == b"version":
-				val = b"pyxyne's db"
-			else:
-				val = values.get(key, b"")
-			peer.log(f"Retrieved {repr(key)}: {shorten(repr(val))}")
-			peer.send_dgram(key + b"=" + val)
+values: MutableMapping[bytes, bytes] = KvStore(DB_MAX_BYTES) if DB_MAX_BYTES > 0 else {}
+kvlog = KvLog(DB_DIR, DB_FLUSH_INTERVAL, DB_SNAPSHOT_BYTES) if DB_DIR is not None else None
+if kvlog is not None:
+	kvlog.load(values)
+if isinstance(values, KvStore):
+	values.pin(b"version", VERSION)
+else:
+	values[b"version"] = VERSION
+lib_metrics.gauge("p4_keys", "Keys in the database", lambda: len(values))
 
-serve_udp(db_handler)
+def db_handler(msg: bytes, addr: Addr, reply: Callable[[bytes], None]):
+	if b"=" in msg: # insert
+		[key, val] = msg.split(b"=", maxsplit=1)
+		if key == b"version":
+			if app_logger.enabled(INFO):
+				log(get_addr_str(addr), f"{YELLOW}Ignored insert into 'version'")
+		else:
+			if app_logger.enabled(INFO):
+				log(get_addr_str(addr), f"Inserted {repr(key)}: {shorten(repr(val))}")
+			values[key] = val
+			if kvlog is not None:
+				kvlog.append(key, val)
+	else: # retrieve
+		key = msg
+		val = values.get(key, b"")
+		if app_logger.enabled(INFO):
+			log(get_addr_str(addr), f"Retrieved {repr(key)}: {shorten(repr(val))}")
+		reply(key + b"=" + val)
+
+serve_udp(db_handler, stateless=True, single_worker=True)
+if isinstance(values, KvStore):
+	log(f"Store: {values.stats()}")
+if kvlog is not None:
+	kvlog.close()
@@ -1,39 +1,237 @@
-from socket import AF_INET
-from lib_aserve import TcpPeer, serve_tcp
+from socket import AF_INET, SOCK_STREAM
+from lib_aserve import Lazy, TcpPeer, TcpServer, log, serve_tcp
 from lib_color import *
+import lib_metrics
 import asyncio
+from collections import deque
+import os
 import re
+import time
+
+UPSTREAM_HOST = os.environ.get("PROXY_UPSTREAM_HOST", "chat.protohackers.com")
+UPSTREAM_PORT = int(os.environ.get("PROXY_UPSTREAM_PORT", 16963))
+DNS_TTL = float(os.environ.get("PROXY_DNS_TTL", 300)) # seconds a resolved upstream address is reused
+POOL_SIZE = int(os.environ.get("PROXY_POOL_SIZE", 4)) # upstream connections dialed ahead of clients, 0 to dial on demand
+POOL_MAX_IDLE = float(os.environ.get("PROXY_POOL_MAX_IDLE", 60)) # seconds before a dialed connection is replaced
+DIAL_RETRY_DELAY = 1 # seconds before dialing ahead again after a failure
+
+Upstream = tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+ttfb_seconds = lib_metrics.histogram("proxy_ttfb_seconds", "Time from a client connecting to its first byte from upstream")
+pool_hits = lib_metrics.counter("proxy_pool_hits_total", "Sessions given an upstream connection dialed ahead")
+pool_misses = lib_metrics.counter("proxy_pool_misses_total", "Sessions that had to dial upstream themselves")
+dns_lookups = lib_metrics.counter("proxy_dns_lookups_total", "Resolutions of the upstream host")
+
+
+class Resolver:
+	# Caches the upstream addresses for DNS_TTL, or until none of them can be connected to
+	host: str
+	port: int
+	ttl: float
+	addrs: list[str]
+	expires: float
+	
+	def __init__(self, host: str, port: int, ttl: float):
+		self.host = host
+		self.port = port
+		self.ttl = ttl
+		self.addrs = []
+		self.expires = 0
+	
+	async def resolve(self) -> list[str]:
+		if time.monotonic() >= self.expires:
+			infos = await asyncio.get_running_loop().getaddrinfo(self.host, self.port,
+				family=AF_INET, type=SOCK_STREAM) # force ipv4. ipv6 is fucky for some reason
+			self.addrs = list(dict.fromkeys(info[4][0] for info in infos))
+			self.expires = time.monotonic() + self.ttl
+			dns_lookups.inc()
+		return self.addrs
+	
+	async def dial(self) -> Upstream:
+		addrs = await self.resolve()
+		for i, addr in enumerate(addrs):
+			try:
+				return await asyncio.open_connection(addr, self.port)
+			except OSError:
+				if i == len(addrs) - 1:
+					self.expires = 0
+					raise
+		raise OSError(f"no address for {self.host}")
+
+class UpstreamPool:
+	# Upstream connections dialed ahead of time and handed to new clients, which then
+	# get the chat server's welcome without waiting for DNS and a handshake. Refilled
+	# in the background as they are taken. Each one is watched while it waits: what
+	# the chat server sends meanwhile is kept for the client, and a connection that is
+	# closed, or idle for POOL_MAX_IDLE as the chat server may have given up on it, is
+	# dropped and another is dialed.
+	resolver: Resolver
+	size: int
+	max_idle: float
+	ready: deque[tuple[Upstream, bytearray, asyncio.Task]] # (connection, received meanwhile, watcher)
+	dialing: set[asyncio.Task]
+	
+	def __init__(self, resolver: Resolver, size: int, max_idle: float):
+		self.resolver = resolver
+		self.size = size
+		self.max_idle = max_idle
+		self.ready = deque()
+		self.dialing = set()
+	
+	async def start(self, _server: TcpServer):
+		self.refill()
+	
+	def refill(self):
+		while len(self.ready) + len(self.dialing) < self.size:
+			task = asyncio.create_task(self.dial_ahead())
+			self.dialing.add(task)
+			task.add_done_callback(self.dialing.discard)
+	
+	async def dial_ahead(self):
+		try:
+			conn = await self.resolver.dial()
+		except OSError as e:
+			log(f"{YELLOW}Could not dial upstream ahead: {e}")
+			await asyncio.sleep(DIAL_RETRY_DELAY) # counted as dialing meanwhile, not retried at once
+			self.dialing.discard(asyncio.current_task()) # not to be counted by refill
+			self.refill()
+			return
+		received = bytearray()
+		self.ready.append((conn, received, asyncio.create_task(self.watch(conn, received))))
+	
+	async def watch(self, conn: Upstream, received: bytearray):
+		# Cancelled when the connection is taken, which leaves unread data in the reader
+		reader, writer = conn
+		deadline = time.monotonic() + self.max_idle
+		try:
+			while True:
+				buf = await asyncio.wait_for(reader.read(RELAY_CHUNK), deadline - time.monotonic())
+				if len(buf) == 0:
+					break
+				received += buf
+		except (OSError, asyncio.TimeoutError):
+			pass
+		self.ready.remove((conn, received, asyncio.current_task()))
+		writer.close()
+		self.refill()
+	
+	async def get(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter, bytes]:
+		# Also returns what upstream already sent, to be relayed first
+		while len(self.ready) > 0:
+			(reader, writer), received, watcher = self.ready.popleft()
+			watcher.cancel()
+			await asyncio.gather(watcher, return_exceptions=True) # stops reading before the client does
+			if not reader.at_eof() and not writer.is_closing() and reader.exception() is None:
+				self.refill()
+				pool_hits.inc()
+				return reader, writer, bytes(received)
+			writer.close()
+		self.refill()
+		pool_misses.inc()
+		return *await self.resolver.dial(), b""
+
+pool = UpstreamPool(Resolver(UPSTREAM_HOST, UPSTREAM_PORT, DNS_TTL), POOL_SIZE, POOL_MAX_IDLE)
+
+
+## Boguscoin rewriting
+
+TONYS_ADDRESS = b"7YWHMfk9JZe0LM0g1ZauHuiSxhI"
+ADDRESS = re.compile(rb"(^|(?<=[ \n]))7[a-zA-Z0-9]{25,34}(?=[ \n])") # in a span starting and ending a word
+WHOLE_ADDRESS = re.compile(rb"7[a-zA-Z0-9]{25,34}")
+ADDRESS_PREFIX = re.compile(rb"(7[a-zA-Z0-9]{0,34})?")
+DELIMITER = re.compile(rb"[ \n]")
+RELAY_CHUNK = 64 * 1024
+
+class Rewriter:
+	# Replaces Boguscoin addresses in a stream as it goes, with the same result as
+	# applying rb"(^|(?<= ))7[a-zA-Z0-9]{25,34}($|(?= ))" to each line: an address is a
+	# word, delimited by spaces and line ends, of 26 to 35 characters starting with a
+	# 7. Each chunk is forwarded up to its last delimiter, rewritten by a regex; the
+	# word after it is held back only while it could still become an address, so at
+	# most 35 bytes are ever kept.
+	carry: bytes # start of a word that may be an address
+	in_word: bool # the chunk starts in the middle of a word that cannot be one
+	replaced: int
+	
+	def __init__(self):
+		self.carry = b""
+		self.in_word = False
+		self.replaced = 0
+	
+	def feed(self, chunk: bytes) -> bytes:
+		data = self.carry + chunk if len(self.carry) > 0 else chunk
+		out = []
+		if self.in_word:
+			m = DELIMITER.search(data)
+			if m is None:
+				return data
+			out.append(data[: m.end()])
+			data = data[m.end() :]
+			self.in_word = False
+		end = max(data.rfind(b" "), data.rfind(b"\n")) + 1
+		if end > 0:
+			rewritten, n = ADDRESS.subn(TONYS_ADDRESS, data[:end])
+			self.replaced += n
+			out.append(rewritten)
+		rest = data[end:]
+		if ADDRESS_PREFIX.fullmatch(rest):
+			self.carry = rest
+		else:
+			out.append(rest)
+			self.carry = b""
+			self.in_word = True
+		return b"".join(out)
+	
+	def end(self) -> bytes:
+		# At EOF, the held back word is followed by the end of the last line
+		rest, self.carry = self.carry, b""
+		if WHOLE_ADDRESS.fullmatch(rest):
+			self.replaced += 1
+			return TONYS_ADDRESS
+		return rest
+
 
 async def proxy_handler(peer: TcpPeer):
+	start = time.perf_counter()
 	peer.debug("Connecting to chat server...")
-	reader, writer = await asyncio.open_connection("chat.protohackers.com", 16963,
-		family=AF_INET) # force ipv4. ipv6 is fucky for some reason
+	reader, writer, received = await pool.get()
 	peer.debug("Connection established")
 	
-	def rewrite(b: bytes) -> bytes:
-		b2 = re.sub(rb"(^|(?<= ))7[a-zA-Z0-9]{25,34}($|(?= ))", b"7YWHMfk9JZe0LM0g1ZauHuiSxhI", b)
-		if b != b2:
-			peer.debug("Replaced", b, "with", b2)
-		return b2
-	
 	async def upstream():
+		rewriter = Rewriter()
 		while True:
 			try:
-				buf = await peer.get_raw_line()
+				buf = bytes(await peer.get_bytes())
 			except EOFError:
 				break
-			peer.log("<-", buf)
-			writer.write(rewrite(buf))
+			writer.write(rewriter.feed(buf))
+			try:
+				await writer.drain()
+			except ConnectionError:
+				break
+		writer.write(rewriter.end())
+		peer.debug("Replaced", rewriter.replaced, "addresses going upstream")
 		writer.close()
 		reader.feed_eof()
 	
 	async def downstream():
-		while True:
-			buf = await reader.readline()
-			if len(buf) == 0:
-				break
-			peer.log("->", buf)
-			peer.send_bytes(rewrite(buf))
+		rewriter = Rewriter()
+		first = True
+		buf = received if len(received) > 0 else await reader.read(RELAY_CHUNK)
+		while len(buf) > 0:
+			if first:
+				ttfb = time.perf_counter() - start
+				ttfb_seconds.observe(ttfb)
+				peer.debug(Lazy("First byte from upstream after {:.1f}ms".format, ttfb * 1000))
+				first = False
+			peer.send_bytes(rewriter.feed(buf))
+			try:
+				await peer.drain()
+			except EOFError:
+				return
+			buf = await reader.read(RELAY_CHUNK)
+		peer.send_bytes(rewriter.end())
+		peer.debug("Replaced", rewriter.replaced, "addresses going downstream")
 		peer.send_eof()
 		peer.on_eof()
 	
@@ -43,4 +241,4 @@ async def proxy_handler(peer: TcpPeer):
 	await writer.wait_closed()
 	peer.debug("All connections are closed")
 
-serve_tcp(proxy_handler, backlog=10)
+serve_tcp(proxy_handler, backlog=10, on_start=pool.start)
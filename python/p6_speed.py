@@ -5,6 +5,7 @@ import struct
 from typing import Dict, Tuple
 from lib_aserve import TcpPeer, serve_tcp, shorten
 from lib_color import *
+import lib_metrics
 
 class ProtocolError(Exception): pass
 
@@ -14,10 +15,16 @@ road_dispatchers: Dict[int, set[TcpPeer]] = defaultdict(set) # road → set(peer
 pending_tickets: Dict[int, list[bytes]] = defaultdict(list) # road → list(ticket messages)
 ticketed_on_days: Dict[bytes, set[int]] = defaultdict(set) # plate → days ticketed
 
+lib_metrics.gauge("speed_pending_tickets", "Tickets waiting for a dispatcher",
+	lambda: sum(len(tickets) for tickets in pending_tickets.values()))
+lib_metrics.gauge("speed_dispatchers", "Connected dispatchers per road",
+	lambda: { road: len(disps) for road, disps in road_dispatchers.items() if len(disps) > 0 }, label="road")
+tickets_issued = lib_metrics.counter("speed_tickets_total", "Tickets issued")
+
 async def speed_handler(peer: TcpPeer):
 	async def read_str() -> bytes:
 		len = await peer.get_struct("!B", True)
-		return await peer.get_n_bytes(len, True)
+		return bytes(await peer.get_n_bytes(len, True))
 	
 	def err(msg: str):
 		raise ProtocolError(msg)
@@ -38,6 +45,7 @@ async def speed_handler(peer: TcpPeer):
 			ticketed_on_days[plate].add(day)
 		
 		peer.log(f"{YELLOW}Sending ticket: {repr(plate)} {road} {mile1} {timestamp1} {mile2} {timestamp2} {speed}")
+		tickets_issued.inc()
 		
 		msg = struct.pack("!BB", 0x21, len(plate)) + plate \
 			+ struct.pack("!HHIHIH", road, mile1, timestamp1, mile2, timestamp2, speed)
@@ -130,4 +138,6 @@ async def speed_handler(peer: TcpPeer):
 	if heartbeat_task is not None:
 		heartbeat_task.cancel()
 
-serve_tcp(speed_handler, backlog=150)
+BUSY_MSG = b"server busy"
+serve_tcp(speed_handler, backlog=150, single_worker=True,
+	max_peers=1000, reject_msg=bytes([0x10, len(BUSY_MSG)]) + BUSY_MSG)
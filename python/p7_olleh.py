@@ -2,11 +2,14 @@ import asyncio
 from typing import Dict
 from lib_aserve import UdpPeer, serve_udp, shorten
 from lib_color import *
+import lib_metrics
 
 retrans_timeout = 3
 expiry_timeout = 60
 
 sessions: Dict[int, "Session"] = {}
+lib_metrics.gauge("lrcp_sessions", "Open LRCP sessions", lambda: len(sessions))
+retransmissions = lib_metrics.counter("lrcp_retransmissions_total", "Data retransmitted after a timeout")
 
 def encode(s: str):
 	return s.replace("\\", "\\\\").replace("/", "\\/")
@@ -28,6 +31,7 @@ class Session:
 			if self.acknowledged < self.sent:
 				data = self.unacknowledged
 				self.peer.log(f"[{self.id}] retransmitting last {self.sent - self.acknowledged} bytes")
+				retransmissions.inc()
 				chunk_size = 400
 				for chunk_i in range(len(data) // chunk_size + 1):
 					chunk = data[chunk_i*chunk_size:(chunk_i+1)*chunk_size]
@@ -195,4 +199,4 @@ async def olleh_handler(peer: UdpPeer):
 		except InvalidMsg as e:
 			peer.warn(f"invalid message: {e}")
 
-serve_udp(olleh_handler, timeout=expiry_timeout)
+serve_udp(olleh_handler, timeout=expiry_timeout, single_worker=True)
@@ -1,6 +1,7 @@
 import asyncio
 from typing import Any, Callable, Coroutine, Generic, TypeVar
 from lib_aserve import serve_tcp, TcpPeer
+import lib_metrics
 import json
 from collections import defaultdict
 
@@ -81,6 +82,12 @@ Job = tuple[int, Any] # (job_id, job)
 queues: dict[str, MaxHeap[Job]] = {}
 worked_on: dict[int, tuple[int, str, Job, int]] = {} # job_id -> peer_id, queue, job, pri
 
+lib_metrics.gauge("job_queue_depth", "Jobs waiting in each queue",
+	lambda: { name: len(queue) for name, queue in queues.items() }, label="queue")
+lib_metrics.gauge("job_queue_waiting_clients", "Clients waiting on each queue",
+	lambda: { name: len(queue.waiting) for name, queue in queues.items() }, label="queue")
+lib_metrics.gauge("jobs_in_progress", "Jobs being worked on", lambda: len(worked_on))
+
 def get_queue(name: str):
 	if name not in queues:
 		queues[name] = MaxHeap(name)
@@ -100,12 +107,7 @@ async def job_handler(peer: TcpPeer):
 			return x
 		raise BadRequest("invalid job id")
 	
-	while True:
-		try:
-			line = await peer.get_line()
-		except EOFError:
-			break
-		
+	async for line in peer.lines():
 		try:
 			try:
 				req = json.loads(line)
@@ -228,4 +230,6 @@ async def job_handler(peer: TcpPeer):
 			del worked_on[job_id]
 			queues[queue_name].add((job_id, job), pri)
 
-serve_tcp(job_handler, backlog=1000, debug=False)
+BUSY_MSG = json.dumps({ "status": "error", "error": "server busy" }).encode("utf-8") + b"\n"
+serve_tcp(job_handler, backlog=1000, debug=False, coalesce=True, single_worker=True,
+	max_peers=5000, reject_msg=BUSY_MSG)